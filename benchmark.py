@@ -3,18 +3,19 @@ import uuid
 import timeit
 import argparse
 import contextlib
+import threading
 from functools import partial
 
 from pymongo import MongoClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import event
 
 from vakt import (
     MemoryStorage, DENY_ACCESS, ALLOW_ACCESS,
     Policy, RegexChecker, RulesChecker, Guard, Inquiry,
 )
+from vakt.policy import TYPE_STRING_BASED
 from vakt.storage.mongo import MongoStorage
-from vakt.storage.sql import SQLStorage
+from vakt.storage.sql import SQLStorage, create_session
 from vakt.storage.sql.migrations import SQLMigrationSet
 from vakt.rules import operator, logic, list, net
 
@@ -23,6 +24,10 @@ from vakt.rules import operator, logic, list, net
 LINE_LEN = 80
 overall_policies_created = 0
 similar_regexp_policies_created = 0
+sql_statements_executed = 0
+sql_rows_fetched = 0
+sql_rows_counting_time = 0
+counting_sql_rows = False
 
 
 # Define and parse possible arguments
@@ -44,7 +49,18 @@ regex_group.add_argument('--same', type=int, default=0,
 regex_group.add_argument('--cache', type=int,
                          help="number of LRU-cache for RegexChecker (default: RegexChecker's default cache-size)")
 
+concurrency_group = parser.add_argument_group('concurrency related')
+concurrency_group.add_argument('-t', '--threads', type=int, nargs='+',
+                               help='numbers of threads to measure decisions throughput with, ex: 1 2 4 8')
+concurrency_group.add_argument('--decisions', type=int, default=1000,
+                               help='number of decisions made by all threads together (default: %(default)d)')
+concurrency_group.add_argument('--pool-size', dest='pool_size', type=int,
+                               help='size of connection pool for sql storage (default: max number of threads)')
+
 ARGS = parser.parse_args()
+if ARGS.threads and ARGS.storage == 'sql' and ':memory:' in ARGS.sql_dsn:
+    # each connection to in-memory database has its own database
+    parser.error('concurrency benchmark needs a database shared by connections, ex: sqlite:////tmp/vakt.db')
 
 
 def rand_string():
@@ -138,13 +154,17 @@ def get_inquiry():
     return Inquiry(action='get', subject='xo', resource='library:books:1234', context={'ip': '127.0.0.1'})
 
 
-def populate_storage(store):
+def populate_storage(store, batch=1000):
     global overall_policies_created
+    policies = []
     for x in range(ARGS.policies_number):
-        policy = gen_policy()
-        store.add(policy)
+        policies.append(gen_policy())
         overall_policies_created += 1
+        if len(policies) >= batch:
+            store.add_many(policies)
+            policies = []
         yield
+    store.add_many(policies)
 
 
 def print_generation(generator, factor=10, line_len=LINE_LEN):
@@ -162,6 +182,24 @@ def print_generation(generator, factor=10, line_len=LINE_LEN):
     print()
 
 
+def count_sql_statement(conn, cursor, statement, parameters, context, executemany):
+    """
+    Count executed statements and, while `counting_sql_rows` is on, rows that SELECT statements return.
+    Rows are counted by running the statement once more wrapped in COUNT(*), time it takes is tracked
+    to be subtracted from the measured decision time.
+    """
+    global sql_statements_executed, sql_rows_fetched, sql_rows_counting_time
+    sql_statements_executed += 1
+    if not counting_sql_rows or executemany or not statement.lstrip().upper().startswith('SELECT'):
+        return
+    start = timeit.default_timer()
+    counter = cursor.connection.cursor()
+    counter.execute('SELECT COUNT(*) FROM (%s) AS counted_rows' % statement, parameters)
+    sql_rows_fetched += counter.fetchone()[0]
+    counter.close()
+    sql_rows_counting_time += timeit.default_timer() - start
+
+
 @contextlib.contextmanager
 def get_storage():
     if ARGS.storage == 'mongo':
@@ -172,34 +210,100 @@ def get_storage():
         client[db_name][collection].delete_many({})
         client.close()
     elif ARGS.storage == 'sql':
-        engine = create_engine(ARGS.sql_dsn)
-        sql_session = scoped_session(sessionmaker(bind=engine))
-        storage = SQLStorage(scoped_session=sql_session)
+        # SQLite opens a new connection for each session: it has no pool to size
+        if ARGS.threads and not ARGS.sql_dsn.startswith('sqlite'):
+            sql_session = create_session(ARGS.sql_dsn, pool_size=ARGS.pool_size or max(ARGS.threads))
+        else:
+            sql_session = create_session(ARGS.sql_dsn)
+        event.listen(sql_session.bind, 'after_cursor_execute', count_sql_statement)
+        # each operation gets its own short-lived session, so no transaction is left open between them
+        storage = SQLStorage(scoped_session=sql_session, session_per_operation=True)
         migration = SQLMigrationSet(storage)
         migration.up()
+        sql_session.remove()
         yield storage
-        # todo - why is there left an uncommitted transaction?
-        sql_session.commit()
         migration.down()
+        sql_session.remove()
     else:
         yield MemoryStorage()
 
 
+def count_mongo_candidates(st, checker, inquiry):
+    """
+    Count candidate Policies that MongoStorage finds for the inquiry on each generation of MongoDB servers.
+    Returns list of (description, number of candidates).
+    """
+    server_version = st.db_server_version
+    scanned = sum(1 for _ in st.collection.find({'type': TYPE_STRING_BASED}, projection=['_id']))
+    counts = [('full scan of string-based policies', scanned)]
+    try:
+        st.db_server_version = (4, 0, 0)
+        counts.append(('MongoDB < 4.2 (prefixes + client-side regexes)',
+                       sum(1 for _ in st.find_for_inquiry(inquiry, checker))))
+    finally:
+        st.db_server_version = server_version
+    if server_version >= (4, 2, 0):
+        counts.append(('MongoDB >= 4.2 (prefixes + $regexMatch)',
+                       sum(1 for _ in st.find_for_inquiry(inquiry, checker))))
+    return counts
+
+
+def measure_throughput(guard, threads_number):
+    """
+    Make ARGS.decisions decisions with the given number of threads. Returns decisions per second.
+    """
+    inquiries = [get_inquiry() for _ in range(ARGS.decisions)]
+    chunks = [inquiries[i::threads_number] for i in range(threads_number)]
+
+    def decide(chunk):
+        for inquiry in chunk:
+            guard.is_allowed(inquiry=inquiry)
+
+    threads = [threading.Thread(target=decide, args=(chunk,)) for chunk in chunks]
+    start = timeit.default_timer()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return ARGS.decisions / (timeit.default_timer() - start)
+
+
 if __name__ == '__main__':
     with get_storage() as st:
         print('=' * LINE_LEN)
         print('Populating %s with Policies' % st.__class__.__name__)
         print_generation(partial(populate_storage, st), int(ARGS.policies_number / 100 * 1), LINE_LEN)
         print('START BENCHMARK!')
+        sql_statements_executed = 0
+        counting_sql_rows = True
         start = timeit.default_timer()
         checker = get_checker()
         inq = get_inquiry()
         allowed = Guard(st, checker).is_allowed(inquiry=inq)
-        stop = timeit.default_timer()
+        stop = timeit.default_timer() - sql_rows_counting_time
+        counting_sql_rows = False
         print('Number of unique Policies in DB: {:,}'.format(overall_policies_created))
         print('Among them Policies with the same regexp pattern: {:,}'.format(similar_regexp_policies_created))
         print('Checker used: %s' % checker.__class__.__name__)
         # print('Inquiry looks like: %s' % vars(inq))
         print('Decision for 1 Inquiry took: %0.4f seconds' % (stop - start))
+        if ARGS.storage == 'sql':
+            print('SQL statements executed for the decision: {:,}'.format(sql_statements_executed))
+            print('SQL rows fetched for the decision: {:,}'.format(sql_rows_fetched))
         print('Inquiry passed the guard? %s' % allowed)
+        # candidates are the rows that the storage returns for the decision, Guard checks each of them
+        candidates = sum(1 for _ in st.find_for_inquiry(inq, checker))
+        print('Candidate Policies returned by storage for the decision: {:,}'.format(candidates))
+        if ARGS.storage == 'mongo' and isinstance(checker, RegexChecker):
+            print('-' * LINE_LEN)
+            print('Candidate Policies fetched for the Inquiry:')
+            for description, number in count_mongo_candidates(st, checker, inq):
+                print('{:>50}: {:,}'.format(description, number))
+        if ARGS.threads:
+            print('-' * LINE_LEN)
+            print('Throughput of %d decisions:' % ARGS.decisions)
+            guard = Guard(st, checker)
+            for threads_number in ARGS.threads:
+                rate = measure_throughput(guard, threads_number)
+                print('{:>4} threads: {:,.1f} decisions per second'.format(threads_number, rate))
         print('=' * LINE_LEN)
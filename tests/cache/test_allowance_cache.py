@@ -1,11 +1,43 @@
 from vakt.storage.memory import MemoryStorage
 from vakt import Policy, Inquiry, RulesChecker, ALLOW_ACCESS
-from vakt.cache import create_cached_guard
+import threading
+import multiprocessing
+
+import pytest
+
+from vakt.cache import create_cached_guard, LRUCache, ShardedLRUCache, TTLCache, TinyLFUCache, MMapCache
 from vakt.rules import Eq
 
 
+def check_in_other_process(path, queue):
+    cache = MMapCache(path=path)
+    func = cache.wrap(lambda inquiry: inquiry.subject == 'Jim')
+    queue.put([func(Inquiry(subject='Max')), func(Inquiry(subject='Jim'))])
+    queue.put(tuple(cache.info()))
+    cache.close()
+
+
 class TestAllowanceCache:
 
+    @pytest.mark.parametrize('backend', [
+        LRUCache(maxsize=256),
+        ShardedLRUCache(maxsize=256, shards=4),
+        TTLCache(maxsize=256, ttl=60),
+        TinyLFUCache(maxsize=256),
+    ])
+    def test_custom_backend(self, backend):
+        guard, storage, cache = create_cached_guard(MemoryStorage(), RulesChecker(), cache=backend)
+        assert backend is cache.cache
+        storage.add(Policy(1, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Max')], effect=ALLOW_ACCESS))
+        inq1 = Inquiry(action='get', resource='book', subject='Max')
+        inq2 = Inquiry(action='get', resource='book', subject='Jim')
+        assert [True, True, False, False, True] == [guard.is_allowed(i) for i in (inq1, inq1, inq2, inq2, inq1)]
+        assert (3, 2, 256, 2, 0) == tuple(cache.info())
+        storage.add(Policy(2, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Jim')], effect=ALLOW_ACCESS))
+        assert 1 == cache.info().currsize
+        assert [True, True] == [guard.is_allowed(i) for i in (inq1, inq2)]
+        assert 4 == cache.info().hits
+
     def test_same_inquiries_are_cached(self):
         guard, storage, cache = create_cached_guard(MemoryStorage(), RulesChecker(), maxsize=256)
         p1 = Policy(1, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Max')], effect=ALLOW_ACCESS)
@@ -22,36 +54,287 @@ class TestAllowanceCache:
         assert 2 == cache.info().misses
         assert 2 == cache.info().currsize
 
-    def test_cache_is_invalidated_on_policy_change(self):
-        def assert_after_modification():
-            assert 0 == cache.info().hits
-            assert 0 == cache.info().misses
-            assert 0 == cache.info().currsize
-            assert not guard.is_allowed(inq1)
-            assert not guard.is_allowed(inq1)
-            assert guard.is_allowed(inq2)
-            assert guard.is_allowed(inq2)
-            assert guard.is_allowed(inq2)
-            assert 3 == cache.info().hits
-            assert 2 == cache.info().misses
-            assert 2 == cache.info().currsize
-
+    def test_cache_is_invalidated_on_in_place_policy_change(self):
         inq1 = Inquiry(action='get', resource='book', subject='Max')
         inq2 = Inquiry(action='get', resource='book', subject='Jim')
         guard, storage, cache = create_cached_guard(MemoryStorage(), RulesChecker(), maxsize=256)
         p1 = Policy(1, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Max')], effect=ALLOW_ACCESS)
-        p2 = Policy(2, actions=[Eq('get')], resources=[Eq('magazine')], subjects=[Eq('Max')], effect=ALLOW_ACCESS)
         storage.add(p1)
         assert guard.is_allowed(inq1)
         assert guard.is_allowed(inq1)
         assert 1 == cache.info().hits
         assert 1 == cache.info().misses
         assert 1 == cache.info().currsize
-        # start modifications
+        # old state of the policy is lost, so everything is invalidated
         p1.subjects = [Eq('Jim')]
         storage.update(p1)
-        assert_after_modification()
+        assert 0 == cache.info().hits
+        assert 0 == cache.info().misses
+        assert 0 == cache.info().currsize
+        assert not guard.is_allowed(inq1)
+        assert not guard.is_allowed(inq1)
+        assert guard.is_allowed(inq2)
+        assert guard.is_allowed(inq2)
+        assert guard.is_allowed(inq2)
+        assert 3 == cache.info().hits
+        assert 2 == cache.info().misses
+        assert 2 == cache.info().currsize
+
+    def test_only_inquiries_fitting_changed_policies_are_invalidated(self):
+        inq1 = Inquiry(action='get', resource='book', subject='Max')
+        inq2 = Inquiry(action='get', resource='book', subject='Jim')
+        inq3 = Inquiry(action='get', resource='magazine', subject='Max')
+        guard, storage, cache = create_cached_guard(MemoryStorage(), RulesChecker(), maxsize=256)
+        storage.add(Policy(1, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Max')], effect=ALLOW_ACCESS))
+        assert [True, False, False] == [guard.is_allowed(i) for i in (inq1, inq2, inq3)]
+        assert 3 == cache.info().currsize
+        # policy for magazines doesn't change answers about books
+        p2 = Policy(2, actions=[Eq('get')], resources=[Eq('magazine')], subjects=[Eq('Max')], effect=ALLOW_ACCESS)
         storage.add(p2)
-        assert_after_modification()
-        storage.delete(p2)
-        assert_after_modification()
+        assert 2 == cache.info().currsize
+        assert [True, False, True] == [guard.is_allowed(i) for i in (inq1, inq2, inq3)]
+        assert 2 == cache.info().hits
+        assert 4 == cache.info().misses
+        # both former and new subjects of the policy are invalidated
+        storage.update(Policy(1, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Jim')],
+                              effect=ALLOW_ACCESS))
+        assert 1 == cache.info().currsize
+        assert [False, True, True] == [guard.is_allowed(i) for i in (inq1, inq2, inq3)]
+        assert 3 == cache.info().hits
+        assert 6 == cache.info().misses
+        storage.delete(2)
+        assert 2 == cache.info().currsize
+        assert [False, True, False] == [guard.is_allowed(i) for i in (inq1, inq2, inq3)]
+        storage.delete_many([1, 2])
+        assert [False, False, False] == [guard.is_allowed(i) for i in (inq1, inq2, inq3)]
+        assert 3 == cache.info().currsize
+
+    def test_cache_is_invalidated_when_many_policies_are_changed(self):
+        inq1 = Inquiry(action='get', resource='book', subject='Max')
+        inq2 = Inquiry(action='get', resource='book', subject='Jim')
+        guard, storage, cache = create_cached_guard(MemoryStorage(), RulesChecker(), maxsize=256,
+                                                    max_changed_policies=2)
+        assert [False, False] == [guard.is_allowed(i) for i in (inq1, inq2)]
+        assert 2 == cache.info().currsize
+        # policies don't fit any cached Inquiry, but there are too many of them to check
+        storage.add_many([Policy(i, actions=[Eq('get')], resources=[Eq('magazine')]) for i in range(2)])
+        assert 2 == cache.info().currsize
+        storage.add_many([Policy(i, actions=[Eq('get')], resources=[Eq('magazine')]) for i in range(2, 5)])
+        assert 0 == cache.info().currsize
+        assert [False, False] == [guard.is_allowed(i) for i in (inq1, inq2)]
+        assert 2 == cache.info().misses
+
+
+class TestLRUCache:
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        calls = []
+        func = cache.wrap(lambda x: calls.append(x) or x * 2)
+        assert [2, 4, 2, 6, 2, 4] == [func(x) for x in (1, 2, 1, 3, 1, 2)]
+        assert [1, 2, 3, 2] == calls
+        assert (2, 4, 2, 2, 2) == tuple(cache.info())
+
+    def test_invalidate_where(self):
+        cache = LRUCache(maxsize=None)
+        func = cache.wrap(lambda x: x)
+        for x in range(6):
+            func(x)
+        cache.invalidate_where(lambda x: x % 2 == 0)
+        assert 3 == cache.info().currsize
+        assert 6 == cache.info().misses
+        func(1)
+        func(2)
+        assert 1 == cache.info().hits
+        assert 7 == cache.info().misses
+
+    def test_results_computed_during_invalidation_are_not_cached(self):
+        cache = LRUCache(maxsize=10)
+
+        def func(x):
+            cache.invalidate_where(lambda _: True)
+            return x
+        cached = cache.wrap(func)
+        cached(1)
+        assert 0 == cache.info().currsize
+
+
+class TestTTLCache:
+
+    def test_results_expire(self):
+        now = [100.0]
+        cache = TTLCache(maxsize=10, ttl=5, timer=lambda: now[0])
+        calls = []
+        func = cache.wrap(lambda x: calls.append(x) or x)
+        func(1)
+        now[0] += 3
+        func(2)
+        func(1)
+        now[0] += 3
+        func(1)
+        func(2)
+        assert [1, 2, 1] == calls
+        assert (2, 3, 10, 2, 1) == tuple(cache.info())
+
+
+class TestShardedLRUCache:
+
+    def test_results_are_spread_over_shards(self):
+        cache = ShardedLRUCache(maxsize=8, shards=4)
+        func = cache.wrap(lambda x: x * 2)
+        assert [0, 2, 4, 6, 8, 10, 12, 14] == [func(x) for x in range(8)]
+        assert [2, 2, 2, 2] == [s.info().currsize for s in cache.shards]
+        func(8)
+        assert [0, 9, 8, 8, 1] == list(cache.info())
+        cache.invalidate_where(lambda x: x > 3)
+        assert 3 == cache.info().currsize
+        cache.invalidate()
+        assert (0, 0, 8, 0, 0) == tuple(cache.info())
+
+    def test_is_thread_safe(self):
+        cache = ShardedLRUCache(maxsize=64, shards=4)
+        func = cache.wrap(lambda x: x)
+        errors = []
+
+        def work(start):
+            try:
+                for i in range(2000):
+                    assert (start + i) % 100 == func((start + i) % 100)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(i * 7,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert [] == errors
+        info = cache.info()
+        assert 8 * 2000 == info.hits + info.misses
+        assert 64 == info.currsize
+
+
+class TestTinyLFUCache:
+
+    def test_frequent_results_survive_scan(self):
+        cache = TinyLFUCache(maxsize=100)
+        func = cache.wrap(lambda x: x)
+        hot = list(range(50))
+        for _ in range(5):
+            for x in hot:
+                func(x)
+        for x in range(1000, 3000):
+            func(x)
+        hits = cache.info().hits
+        for x in hot:
+            func(x)
+        # hot results in the protected segment aren't evicted by keys seen once
+        assert cache.info().hits - hits >= 45
+        assert 100 == cache.info().currsize
+        assert cache.info().evictions > 0
+
+    def test_lru_cache_is_flushed_by_scan(self):
+        cache = LRUCache(maxsize=100)
+        func = cache.wrap(lambda x: x)
+        for _ in range(5):
+            for x in range(50):
+                func(x)
+        for x in range(1000, 3000):
+            func(x)
+        hits = cache.info().hits
+        for x in range(50):
+            func(x)
+        assert hits == cache.info().hits
+
+    def test_invalidate_where(self):
+        cache = TinyLFUCache(maxsize=10)
+        func = cache.wrap(lambda x: x)
+        for x in range(10):
+            func(x)
+            func(x)
+        assert 10 == cache.info().currsize
+        cache.invalidate_where(lambda x: x % 2 == 0)
+        assert 5 == cache.info().currsize
+        func(1)
+        func(2)
+        assert 11 == cache.info().hits
+
+
+class TestMMapCache:
+
+    @pytest.fixture
+    def path(self, tmpdir):
+        return str(tmpdir.join('cache'))
+
+    def test_answers_are_shared(self, path):
+        c1 = MMapCache(path=path, maxsize=64)
+        c2 = MMapCache(path=path, maxsize=128)
+        f1 = c1.wrap(lambda inquiry: inquiry.subject == 'Max')
+        f2 = c2.wrap(lambda inquiry: inquiry.subject != 'Max')
+        assert f1(Inquiry(subject='Max'))
+        assert not f1(Inquiry(subject='Jim'))
+        assert f2(Inquiry(subject='Max'))
+        assert not f2(Inquiry(subject='Jim'))
+        assert f2(Inquiry(subject='Sam'))
+        assert (0, 2, 64, 3, 0) == tuple(c1.info())
+        assert (2, 1, 64, 3, 0) == tuple(c2.info())
+        c1.invalidate()
+        assert 0 == c2.info().currsize
+        assert not f2(Inquiry(subject='Max'))
+        assert 1 == c2.info().currsize
+
+    def test_answers_are_shared_between_processes(self, path):
+        cache = MMapCache(path=path, maxsize=64)
+        func = cache.wrap(lambda inquiry: inquiry.subject == 'Max')
+        func(Inquiry(subject='Max'))
+        ctx = multiprocessing.get_context('spawn')
+        queue = ctx.Queue()
+        proc = ctx.Process(target=check_in_other_process, args=(path, queue))
+        proc.start()
+        assert [True, True] == queue.get(timeout=30)
+        assert (1, 1, 64, 2, 0) == queue.get(timeout=30)
+        proc.join()
+
+    def test_slots_are_overwritten_when_full(self, path):
+        cache = MMapCache(path=path, maxsize=4)
+        calls = []
+        func = cache.wrap(lambda inquiry: calls.append(inquiry.subject) or True)
+        for i in range(20):
+            func(Inquiry(subject=str(i)))
+        assert 4 == cache.info().currsize
+        assert 16 == cache.info().evictions
+        assert 20 == len(calls)
+
+    def test_only_booleans_are_cached(self, path):
+        cache = MMapCache(path=path, maxsize=4)
+        func = cache.wrap(lambda inquiry: None)
+        assert None is func(Inquiry())
+        assert None is func(Inquiry())
+        assert (0, 2, 4, 0, 0) == tuple(cache.info())
+
+    def test_torn_slots_are_misses(self, path):
+        cache = MMapCache(path=path, maxsize=4)
+        func = cache.wrap(lambda inquiry: True)
+        func(Inquiry(subject='Max'))
+        assert 1 == cache.info().currsize
+        idx = cache._find(cache._digest(Inquiry(subject='Max')), cache._generation())
+        cache._buf[cache._offset(idx) + 16] ^= 0xff
+        assert 0 == cache.info().currsize
+        func(Inquiry(subject='Max'))
+        assert 0 == cache.info().hits
+
+    def test_not_a_cache_file(self, path):
+        with open(path, 'wb') as f:
+            f.write(b'foo' * 100)
+        with pytest.raises(ValueError):
+            MMapCache(path=path)
+
+    def test_with_guard(self, path):
+        guard, storage, cache = create_cached_guard(MemoryStorage(), RulesChecker(), cache=MMapCache(path=path))
+        storage.add(Policy(1, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Max')], effect=ALLOW_ACCESS))
+        inq = Inquiry(action='get', resource='book', subject='Max')
+        assert guard.is_allowed(inq)
+        assert guard.is_allowed(inq)
+        assert 1 == cache.info().hits
+        storage.delete(1)
+        assert not guard.is_allowed(inq)
+        assert (0, 1, 65536, 1, 0) == tuple(cache.info())
@@ -7,7 +7,7 @@ from vakt.storage.mongo import MongoStorage
 from vakt import Policy, Inquiry, RulesChecker
 from vakt.cache import EnfoldCache
 from vakt.exceptions import PolicyExistsError
-from ..helper import MemoryStorageYieldingExample2
+from ..helper import MemoryStorageYieldingExample2, MemoryStorageFilteringExample
 
 
 class TestEnfoldCache:
@@ -82,6 +82,35 @@ class TestEnfoldCache:
         assert [p1] == back_storage.get_all(1000, 0)
         assert [p1] == cache_storage.get_all(1000, 0)
 
+    def test_batch_methods_ok(self):
+        cache_storage = MemoryStorage()
+        back_storage = MemoryStorage()
+        ec = EnfoldCache(back_storage, cache=cache_storage)
+        p1 = Policy(1)
+        p2 = Policy(2)
+        p3 = Policy(3)
+        ec.add_many(p for p in [p1, p2, p3])
+        assert [p1, p2, p3] == cache_storage.get_all(100, 0)
+        assert [p1, p2, p3] == back_storage.get_all(100, 0)
+        p1_new = Policy(1, description='foo')
+        ec.update_many(p for p in [p1_new])
+        assert [p1_new, p2, p3] == cache_storage.get_all(100, 0)
+        assert [p1_new, p2, p3] == back_storage.get_all(100, 0)
+        ec.delete_many(uid for uid in [1, 3])
+        assert [p2] == cache_storage.get_all(100, 0)
+        assert [p2] == back_storage.get_all(100, 0)
+
+    def test_add_many_fail(self):
+        cache_storage = MemoryStorage()
+        back_storage = MemoryStorage()
+        ec = EnfoldCache(back_storage, cache=cache_storage)
+        p1 = Policy(1)
+        ec.add(p1)
+        with pytest.raises(PolicyExistsError):
+            ec.add_many([Policy(2), Policy(1)])
+        assert [p1] == back_storage.get_all(1000, 0)
+        assert [p1] == cache_storage.get_all(1000, 0)
+
     def test_update_return_value(self):
         cache_storage = MemoryStorage()
         back_storage = MemoryStorage()
@@ -211,13 +240,10 @@ class TestEnfoldCache:
         assert p2 == ec.get(2)
         assert 0 == log_mock.warning.call_count
         log_mock.reset_mock()
-        # test we won't return any inexistent policies
+        # test we won't return any inexistent policies and populated cache answers for them itself
+        back_storage.add(Policy(3))
         assert ec.get(3) is None
-        log_mock.warning.assert_called_with(
-            '%s cache miss for get Policy with UID=%s. Trying to get it from backend storage',
-            'EnfoldCache',
-            3
-        )
+        assert 0 == log_mock.warning.call_count
 
     @pytest.mark.parametrize('storage', [
         MemoryStorage(),
@@ -315,6 +341,26 @@ class TestEnfoldCache:
         assert [p4, p5] == list(ec.retrieve_all(batch=1))
         assert [p4, p5] == list(ec.retrieve_all())
 
+    def test_retrieve_all_is_lazy(self):
+        cache_storage = MemoryStorage()
+        ec = EnfoldCache(MemoryStorage(), cache=cache_storage)
+        ec.add_many([Policy(1), Policy(2), Policy(3)])
+        read = []
+
+        def retrieve_all(*args, **kwargs):
+            for policy in [Policy(1), Policy(2), Policy(3)]:
+                read.append(policy.uid)
+                yield policy
+        cache_storage.retrieve_all = retrieve_all
+        found = ec.retrieve_all(batch=2)
+        assert [1] == read
+        assert 1 == next(found).uid
+        assert [2, 3] == [p.uid for p in found]
+        assert [1, 2, 3] == read
+        cache_storage.retrieve_all = Mock(return_value=iter([]))
+        assert [] == list(ec.retrieve_all())
+        assert (1, 1, 0, True) == tuple(ec.info())
+
     @pytest.mark.parametrize('storage', [
         MemoryStorage(),
         MemoryStorageYieldingExample2(),
@@ -354,6 +400,21 @@ class TestEnfoldCache:
         assert 1 == log_mock.warning.call_count
         log_mock.reset_mock()
 
+    @patch('vakt.cache.log')
+    def test_find_for_inquiries(self, log_mock):
+        cache_storage = MemoryStorageFilteringExample()
+        back_storage = MemoryStorageFilteringExample()
+        p1 = Policy(1, subjects=['Max'])
+        p2 = Policy(2, subjects=['Jim'])
+        back_storage.add_many([p1, p2])
+        cache_storage.add(p1)
+        ec = EnfoldCache(back_storage, cache=cache_storage, populate=False)
+        inquiries = [Inquiry(subject=x) for x in ('Jim', 'Max', 'Nina')]
+        assert [(1, p1), (0, p2)] == list(ec.find_for_inquiries(inquiries, RulesChecker()))
+        log_mock.warning.assert_called_once_with(
+            '%s cache miss for find_for_inquiries. Trying %d inquiries from backend storage', 'EnfoldCache', 2
+        )
+
     @patch('vakt.cache.log')
     def test_find_for_inquiry_for_populated_cache(self, log_mock):
         cache_storage = MemoryStorage()
@@ -425,3 +486,45 @@ class TestEnfoldCache:
         # make sure we do not have cache misses
         assert 0 == log_mock.warning.call_count
         log_mock.reset_mock()
+
+    def test_empty_results_of_populated_cache_are_served_from_cache(self):
+        back_storage = MemoryStorage()
+        p1 = Policy(1, subjects=['Max'])
+        back_storage.add(p1)
+        ec = EnfoldCache(back_storage, cache=MemoryStorageFilteringExample())
+        back_storage.get = back_storage.get_all = back_storage.retrieve_all = Mock(side_effect=Exception('backend'))
+        back_storage.find_for_inquiry = back_storage.find_for_inquiries = back_storage.get
+        assert [p1] == list(ec.find_for_inquiry(Inquiry(subject='Max'), RulesChecker()))
+        assert [] == list(ec.find_for_inquiry(Inquiry(subject='Jim'), RulesChecker()))
+        assert [(1, p1)] == list(ec.find_for_inquiries([Inquiry(subject='Jim'), Inquiry(subject='Max')]))
+        assert ec.get(2) is None
+        assert [] == ec.get_all(10, 5)
+        assert (2, 4, 0, True) == tuple(ec.info())
+
+    def test_info_for_non_populated_cache(self):
+        back_storage = MemoryStorageFilteringExample()
+        p1, p2 = Policy(1, subjects=['Max']), Policy(2, subjects=['Jim'])
+        back_storage.add_many([p1, p2])
+        ec = EnfoldCache(back_storage, cache=MemoryStorageFilteringExample(), populate=False)
+        ec.cache.add(p1)
+        assert p2 == ec.get(2)
+        assert p1 == ec.get(1)
+        inquiries = [Inquiry(subject=x) for x in ('Jim', 'Max', 'Nina')]
+        assert [(1, p1), (0, p2)] == list(ec.find_for_inquiries(inquiries, RulesChecker()))
+        assert (2, 3, 3, False) == tuple(ec.info())
+        ec.cache.delete(1)
+        ec.populate()
+        assert [] == list(ec.find_for_inquiry(Inquiry(subject='Nina'), RulesChecker()))
+        assert (2, 4, 3, True) == tuple(ec.info())
+
+    def test_cache_is_not_populated_after_failed_modification(self):
+        cache_storage = MemoryStorage()
+        back_storage = MemoryStorage()
+        ec = EnfoldCache(back_storage, cache=cache_storage)
+        assert ec.info().populated
+        cache_storage.add = Mock(side_effect=Exception('foo'))
+        with pytest.raises(Exception):
+            ec.add(Policy(1))
+        assert not ec.info().populated
+        assert 1 == ec.get(1).uid
+        assert (0, 1, 1, False) == tuple(ec.info())
@@ -605,6 +605,65 @@ def test_is_allowed_for_inquiry_match_rules(desc, policy, inquiry, result):
     assert result == g.is_allowed(inquiry), 'Failed for case: ' + desc
 
 
+def test_is_allowed_many():
+    class CountingStorage(MemoryStorage):
+        calls = 0
+
+        def find_for_inquiries(self, inquiries, checker=None):
+            self.calls += 1
+            return super().find_for_inquiries(inquiries, checker)
+
+    st = CountingStorage()
+    st.add(Policy('1', effect=ALLOW_ACCESS, subjects=['Max', 'Nina'], actions=['<read|update>'], resources=['<.*>']))
+    st.add(Policy('2', effect=DENY_ACCESS, subjects=['Max'], actions=['update'], resources=['secret']))
+    g = Guard(st, RegexChecker())
+    inquiries = [
+        Inquiry(subject='Max', action='read', resource='secret'),
+        Inquiry(subject='Max', action='update', resource='secret'),
+        Inquiry(subject='Nina', action='update', resource='secret'),
+        Inquiry(subject='Jim', action='read', resource='book'),
+    ]
+    assert [True, False, True, False] == g.is_allowed_many(iter(inquiries))
+    assert [g.is_allowed(i) for i in inquiries] == g.is_allowed_many(inquiries)
+    assert 2 == st.calls
+    assert [] == g.is_allowed_many([])
+
+
+def test_is_allowed_with_policies_found_fitting_by_storage():
+    class FittingStorage(MemoryStorage):
+        def find_fitting_for_inquiry(self, inquiry, checker=None):
+            policies = list(self.find_for_inquiry(inquiry, checker))
+            # pretend that storage has matched policies by subjects only
+            fitting = [p for p in policies if inquiry.subject in p.subjects]
+            return [p for p in fitting if not p.context], [p for p in fitting if p.context]
+
+        def find_for_inquiry(self, inquiry, checker=None):
+            return self.retrieve_all()
+
+    st = FittingStorage()
+    st.add(Policy('1', effect=ALLOW_ACCESS, subjects=['Max'], actions=['get']))
+    st.add(Policy('2', effect=ALLOW_ACCESS, subjects=['Nina'], actions=['get'], resources=['<.*>'],
+                  context={'ip': CIDR('127.0.0.1')}))
+    st.add(Policy('3', subjects=['Jim'], actions=['get']))
+    st.add(Policy('4', effect=ALLOW_ACCESS, subjects=['Jim'], actions=['get']))
+    g = Guard(st, RegexChecker())
+    # fitting policies aren't checked by the checker again
+    assert g.is_allowed(Inquiry(subject='Max', action='put'))
+    assert g.is_allowed(Inquiry(subject='Nina', action='get', context={'ip': '127.0.0.1'}))
+    assert not g.is_allowed(Inquiry(subject='Nina', action='get', context={'ip': '127.0.0.2'}))
+    assert not g.is_allowed(Inquiry(subject='Nina', action='put', context={'ip': '127.0.0.1'}))
+    assert not g.is_allowed(Inquiry(subject='Jim', action='get'))
+    assert not g.is_allowed(Inquiry(subject='Sam', action='get'))
+
+
+def test_is_allowed_many_if_unexpected_exception_raised():
+    class BadMemoryStorage(MemoryStorage):
+        def find_for_inquiries(self, inquiries, checker=None):
+            raise Exception('This is test class that raises errors')
+    g = Guard(BadMemoryStorage(), RegexChecker())
+    assert [False, False] == g.is_allowed_many([Inquiry(subject='foo'), Inquiry(subject='bar')])
+
+
 @pytest.mark.skipif(sys.version_info <= (3, 5, 99), reason='unpredictable sorting order inquiry fields on python3.5')
 @pytest.mark.parametrize('inquiry, result, expect_message', [
     (
@@ -20,9 +20,16 @@ class MemoryStorageYieldingExample2(MemoryStorageYieldingExample):
             yield p
 
 
+class MemoryStorageFilteringExample(MemoryStorage):
+    def find_for_inquiry(self, inquiry, checker=None):
+        return [p for p in super().find_for_inquiry(inquiry, checker) if inquiry.subject in p.subjects]
+
+
 class CountObserver(Observer):
     def __init__(self):
         self.count = 0
+        self.changes = None
 
-    def update(self):
+    def update(self, changes=None):
         self.count += 1
+        self.changes = changes
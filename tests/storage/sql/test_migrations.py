@@ -1,10 +1,17 @@
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import sessionmaker, scoped_session
 
-from vakt.storage.sql import SQLStorage
-from vakt.storage.sql.migrations import SQLMigrationSet, Migration0To1x3x0
-from vakt.storage.sql.model import Base, PolicyActionModel, PolicySubjectModel, PolicyResourceModel, PolicyModel
+from vakt.guard import Inquiry
+from vakt.parser import get_literal_prefix
+from vakt.policy import Policy
+from vakt.storage.policy_cache import get_etag
+from vakt.rules.operator import Eq
+from vakt.storage.sql import SQLStorage, migrations
+from vakt.storage.sql.migrations import SQLMigrationSet, Migration0To1x3x0, Migration1x3x0To1x6x0, \
+    MigrationCheckpointModel
+from vakt.storage.sql.model import Base, PolicyActionModel, PolicySubjectModel, PolicyResourceModel, PolicyModel, \
+    PolicyNgramModel, PolicyRuleTokenModel
 
 from . import create_test_sql_engine
 
@@ -35,9 +42,9 @@ class TestSQLMigrationSet:
     def test_up_and_down(self, migration_set):
         migration_set.save_applied_number(0)
         migration_set.up()
-        assert 1 == migration_set.last_applied()
+        assert 2 == migration_set.last_applied()
         migration_set.up()
-        assert 1 == migration_set.last_applied()
+        assert 2 == migration_set.last_applied()
         migration_set.down()
         assert 0 == migration_set.last_applied()
         migration_set.down()
@@ -83,3 +90,160 @@ class TestMigration0To1x3x0:
         assert not Base.metadata.tables[PolicySubjectModel.__tablename__].exists(engine)
         assert not Base.metadata.tables[PolicyResourceModel.__tablename__].exists(engine)
         assert not Base.metadata.tables[PolicyActionModel.__tablename__].exists(engine)
+
+
+@pytest.mark.sql_integration
+class TestMigration1x3x0To1x6x0:
+
+    @pytest.yield_fixture
+    def engine(self):
+        engine = create_engine('sqlite:///:memory:', echo=False)
+        yield engine
+
+    @pytest.yield_fixture
+    def storage(self, engine):
+        session = scoped_session(sessionmaker(bind=engine))
+        storage = SQLStorage(scoped_session=session)
+        Migration0To1x3x0(storage).up()
+        yield storage
+        session.remove()
+        Base.metadata.drop_all(engine)
+
+    @pytest.yield_fixture
+    def migration(self, storage):
+        yield Migration1x3x0To1x6x0(storage, batch_size=2)
+
+    @staticmethod
+    def columns(engine):
+        return [
+            model.__tablename__ + '.' + c['name']
+            for model in (PolicyModel, PolicySubjectModel, PolicyResourceModel, PolicyActionModel)
+            for c in inspect(engine).get_columns(model.__tablename__)
+            if c['name'] in ('doc', 'etag') or c['name'].endswith('_prefix')
+        ]
+
+    @staticmethod
+    def indexes(engine):
+        return [
+            i['name']
+            for model in (PolicySubjectModel, PolicyResourceModel, PolicyActionModel)
+            for i in inspect(engine).get_indexes(model.__tablename__)
+            if i['column_names'][0] == 'uid' or i['column_names'][0].endswith('_prefix')
+        ]
+
+    def test_order(self, migration):
+        assert 2 == migration.order
+
+    def test_down_and_up(self, migration, engine):
+        migration.down()
+        assert [] == self.columns(engine)
+        assert [] == self.indexes(engine)
+        assert not PolicyNgramModel.__table__.exists(engine)
+        assert not PolicyRuleTokenModel.__table__.exists(engine)
+        migration.down()
+        migration.up()
+        assert PolicyNgramModel.__table__.exists(engine)
+        assert PolicyRuleTokenModel.__table__.exists(engine)
+        assert ['vakt_policies.doc', 'vakt_policies.etag', 'vakt_policy_subjects.subject_prefix',
+                'vakt_policy_resources.resource_prefix', 'vakt_policy_actions.action_prefix'] == self.columns(engine)
+        assert ['ix_vakt_policy_subjects_subject_prefix', 'ix_vakt_policy_subjects_uid',
+                'ix_vakt_policy_resources_resource_prefix', 'ix_vakt_policy_resources_uid',
+                'ix_vakt_policy_actions_action_prefix', 'ix_vakt_policy_actions_uid'] == sorted(
+            self.indexes(engine), key=lambda x: ['subjects', 'resources', 'actions'].index(x.split('_')[3]))
+        migration.up()
+        assert 5 == len(self.columns(engine))
+
+    def test_up_fills_docs(self, migration, storage):
+        for i in range(5):
+            storage.add(Policy(str(i), subjects=['<[a-z]+>', 'Max'], actions=['get'], description=str(i)))
+        storage.session.query(PolicyModel).update({'doc': None, 'etag': None}, synchronize_session=False)
+        storage.session.commit()
+        # policies without doc are still readable
+        assert '3' == storage.get('3').description
+        assert 5 == len(list(storage.find_for_inquiry(Inquiry())))
+        migration.up()
+        assert 0 == storage.session.query(PolicyModel).filter(PolicyModel.doc.is_(None)).count()
+        for i in range(5):
+            model = storage.session.query(PolicyModel).get(str(i))
+            assert get_etag(model.doc) == model.etag
+            policy = Policy.from_json(model.doc)
+            assert str(i) == policy.description
+            assert ['<[a-z]+>', 'Max'] == policy.subjects
+            assert ['get'] == policy.actions
+
+    def test_up_fills_prefixes(self, migration, storage):
+        storage.add(Policy('1', subjects=['Max<[a-z]+>', 'Max'], actions=['<.*>'], resources=[r'books:<\d+>']))
+        session = storage.session
+        session.query(PolicySubjectModel).update({'subject_prefix': None}, synchronize_session=False)
+        session.query(PolicyResourceModel).update({'resource_prefix': None}, synchronize_session=False)
+        session.query(PolicyActionModel).update({'action_prefix': None}, synchronize_session=False)
+        session.commit()
+        migration.up()
+        assert [('Max<[a-z]+>', 'Max'), ('Max', None)] == \
+            session.query(PolicySubjectModel.subject_string, PolicySubjectModel.subject_prefix).all()
+        assert [('',)] == session.query(PolicyActionModel.action_prefix).all()
+        assert [('books:',)] == session.query(PolicyResourceModel.resource_prefix).all()
+
+    def test_up_fills_prefixes_when_empty_prefix_is_stored_as_null(self, migration, storage, monkeypatch):
+        for i in range(5):
+            storage.add(Policy(str(i), subjects=['<.*>'], actions=['<[a-z]+>'], resources=[r'books:<\d+>']))
+        session = storage.session
+        session.query(PolicySubjectModel).update({'subject_prefix': None}, synchronize_session=False)
+        session.query(PolicyActionModel).update({'action_prefix': None}, synchronize_session=False)
+        session.commit()
+        # simulate databases (e.g. Oracle) that store empty strings as NULL
+        monkeypatch.setattr(migrations, 'get_literal_prefix', lambda *args: get_literal_prefix(*args) or None)
+        reports = []
+        migration.report = lambda p: reports.append((p.name, p.processed))
+        migration.up()
+        assert [(None,)] * 5 == session.query(PolicySubjectModel.subject_prefix).all()
+        assert [(None,)] * 5 == session.query(PolicyActionModel.action_prefix).all()
+        assert ('Migration #2 up: filling subject prefixes', 5) in reports
+        assert ('Migration #2 up: filling action prefixes', 5) in reports
+
+    def test_up_fills_ngrams(self, migration, storage, engine):
+        for i in range(5):
+            storage.add(Policy(str(i), subjects=['Max'], actions=['get'], resources=['book%d' % i]))
+        storage.add(Policy('5', subjects=[{'name': Eq('Max')}]))
+        PolicyNgramModel.__table__.drop(engine)
+        migration.up()
+        ngrams = storage.session.query(PolicyNgramModel.uid, PolicyNgramModel.field, PolicyNgramModel.ngram).all()
+        assert 5 * 5 == len(ngrams)
+        assert [('3', 'actions', 'get'), ('3', 'resources', 'boo'), ('3', 'resources', 'ok3'),
+                ('3', 'resources', 'ook'), ('3', 'subjects', 'Max')] == sorted(x for x in ngrams if x[0] == '3')
+
+    def test_up_resumes_filling_after_interruption(self, migration, storage, engine, monkeypatch):
+        for i in range(5):
+            storage.add(Policy(str(i), subjects=['Max'], actions=['get'], resources=['book%d' % i]))
+        PolicyNgramModel.__table__.drop(engine)
+        to_db = PolicyModel._policy_ngrams_to_db
+
+        def fail_on_third(policy):
+            if policy.uid == '3':
+                raise RuntimeError('interrupted')
+            return to_db(policy)
+        monkeypatch.setattr(PolicyModel, '_policy_ngrams_to_db', fail_on_third)
+        with pytest.raises(RuntimeError):
+            migration.up()
+        storage.session.rollback()
+        assert '1' == storage.session.query(MigrationCheckpointModel).get('vakt_policy_ngrams').last_uid
+        assert ['0', '1'] == sorted(set(uid for uid, in storage.session.query(PolicyNgramModel.uid)))
+        monkeypatch.setattr(PolicyModel, '_policy_ngrams_to_db', to_db)
+        reports = []
+        migration.report = lambda p: reports.append((p.name, p.processed))
+        migration.up()
+        assert ['0', '1', '2', '3', '4'] == sorted(set(uid for uid, in storage.session.query(PolicyNgramModel.uid)))
+        assert [] == storage.session.query(MigrationCheckpointModel).all()
+        assert [('Migration #2 up: filling ngrams', 2), ('Migration #2 up: filling ngrams', 3)] == reports
+
+    def test_up_fills_rule_tokens(self, migration, storage, engine):
+        for i in range(5):
+            storage.add(Policy(str(i), subjects=[{'name': Eq('Max%d' % i)}], actions=[Eq('get')]))
+        storage.add(Policy('5', subjects=['Max']))
+        PolicyRuleTokenModel.__table__.drop(engine)
+        migration.up()
+        tokens = storage.session.query(PolicyRuleTokenModel.uid, PolicyRuleTokenModel.field,
+                                       PolicyRuleTokenModel.token).all()
+        assert 5 * 3 == len(tokens)
+        assert [('3', 'actions', '["eq", null, "get"]'), ('3', 'resources', '*'),
+                ('3', 'subjects', '["eq", "name", "Max3"]')] == sorted(x for x in tokens if x[0] == '3')
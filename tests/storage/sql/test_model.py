@@ -48,6 +48,7 @@ def policy__model_assert(policy_model, policy):
                range(len(policy_model.actions)))
 
     assert policy_model.context == json.dumps(policy_dict["context"])
+    assert policy_model.doc == policy_json
 
 
 class TestModel:
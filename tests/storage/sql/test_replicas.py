@@ -0,0 +1,27 @@
+from sqlalchemy import create_engine, text
+
+from vakt.storage.sql.replicas import RoundRobinSelector, LeastLatencySelector
+
+
+def test_round_robin_selector():
+    selector = RoundRobinSelector()
+    assert [0, 1, 2, 0, 1] == [selector.select(['a', 'b', 'c']) for _ in range(5)]
+    assert [0, 0] == [selector.select(['a']) for _ in range(2)]
+
+
+def test_least_latency_selector():
+    engines = [create_engine('sqlite:///:memory:') for _ in range(3)]
+    selector = LeastLatencySelector(weight=0.5)
+    assert 0 == selector.select(engines)
+    assert [0.0, 0.0, 0.0] == [selector.latencies[e] for e in engines]
+    engines[0].execute(text('select 1'))
+    assert selector.latencies[engines[0]] > 0
+    # replicas without measurements are selected first
+    assert 1 == selector.select(engines)
+    selector.latencies.update({engines[0]: 0.3, engines[1]: 0.1, engines[2]: 0.2})
+    assert 1 == selector.select(engines)
+    # latency is a moving average of statements durations
+    selector.latencies[engines[1]] = 10.0
+    engines[1].execute(text('select 1'))
+    assert 5.0 <= selector.latencies[engines[1]] < 5.1
+    assert 2 == selector.select(engines)
@@ -1,11 +1,14 @@
 import operator
 import random
+import time
 import types
 import unittest
 import uuid
 from operator import attrgetter
 
 import pytest
+from sqlalchemy import event, create_engine
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from vakt.checker import StringExactChecker, StringFuzzyChecker, RegexChecker, RulesChecker
@@ -15,10 +18,12 @@ from vakt.guard import Inquiry, Guard
 from vakt.policy import Policy
 from vakt.rules.logic import Any
 from vakt.rules.operator import Eq
-from vakt.rules.string import Equal
+from vakt.rules.string import Equal, StartsWith
+from vakt.rules.list import In
 from vakt.storage.memory import MemoryStorage
-from vakt.storage.sql import SQLStorage
-from vakt.storage.sql.model import Base
+from vakt.storage.sql import SQLStorage, create_session, _create_sqlite_regexp_function
+from vakt.storage.sql.model import Base, PolicyModel, PolicyNgramModel, PolicyRuleTokenModel, PolicySubjectModel
+from vakt.storage.sql.replicas import LeastLatencySelector
 
 from . import create_test_sql_engine
 
@@ -34,9 +39,9 @@ class TestSQLStorage:
         yield session
         Base.metadata.drop_all(engine)
 
-    @pytest.yield_fixture
-    def st(self, session):
-        yield SQLStorage(scoped_session=session)
+    @pytest.yield_fixture(params=[False, True], ids=['shared-session', 'session-per-operation'])
+    def st(self, session, request):
+        yield SQLStorage(scoped_session=session, session_per_operation=request.param)
         session.remove()
 
     def test_add(self, st):
@@ -172,7 +177,7 @@ class TestSQLStorage:
         assert expect_number == len(found)
 
     @pytest.mark.parametrize('dialect, expect_number', [
-        ('sqlite', 7),
+        ('sqlite', 5),
         ('mysql', 5),
         ('postgresql', 5),
     ])
@@ -193,6 +198,52 @@ class TestSQLStorage:
         found = list(found)
         assert expect_number == len(found)
 
+    def test_sqlite_regexp_function_is_registered_once(self, st, session):
+        if st.dialect != 'sqlite':
+            pytest.skip('skipping for %s dialect' % st.dialect)
+        SQLStorage(scoped_session=session)
+        engine = session.bind.engine
+        assert event.contains(engine, 'checkout', _create_sqlite_regexp_function)
+        st.add(Policy('1', subjects=['<[mM]ax>'], actions=['get'], resources=['book<s?>']))
+        assert ['1'] == [p.uid for p in st.find_for_inquiry(Inquiry(subject='Max', action='get', resource='book'),
+                                                            RegexChecker())]
+        assert [] == list(st.find_for_inquiry(Inquiry(subject='Max', action='get', resource='boo'), RegexChecker()))
+
+    @pytest.mark.parametrize('supports_regex', [True, False])
+    def test_regex_checker_filters_by_literal_prefix(self, st, supports_regex):
+        st._supports_regex_operator = lambda: supports_regex
+        st.add(Policy('1', subjects=['Max<[a-z]+>'], actions=['<.*>'], resources=['books:<\\d+>']))
+        st.add(Policy('2', subjects=['Bob<[a-z]+>', 'Max'], actions=['get'], resources=['books:<\\d+>']))
+        st.add(Policy('3', subjects=['Max<[a-z]+>'], actions=['<.*>'], resources=['comics:<\\d+>']))
+        found = st.find_for_inquiry(Inquiry(subject='Maxim', action='get', resource='books:12'), RegexChecker())
+        assert ['1'] == [p.uid for p in found]
+        found = st.find_for_inquiry(Inquiry(subject='Max', action='get', resource='books:12'), RegexChecker())
+        expected = ['2'] if supports_regex else ['1', '2']
+        assert expected == sorted(p.uid for p in found)
+        # elements stored without prefix aren't excluded
+        st.session.query(PolicySubjectModel).update({'subject_prefix': None}, synchronize_session=False)
+        st.session.commit()
+        found = st.find_for_inquiry(Inquiry(subject='Maxim', action='get', resource='books:12'), RegexChecker())
+        expected = ['1'] if supports_regex else ['1', '2']
+        assert expected == sorted(p.uid for p in found)
+
+    @pytest.mark.parametrize('supports_regex', [True, False])
+    def test_regex_checker_with_non_string_inquiry_fields(self, st, supports_regex):
+        st._supports_regex_operator = lambda: supports_regex
+        st.add(Policy('1', subjects=['<.*>'], actions=['get'], resources=['<.*>']))
+        st.add(Policy('2', subjects=['Max'], actions=['get'], resources=['<.*>']))
+        found = st.find_for_inquiry(Inquiry(subject={'name': 'Max'}, action='get', resource='book'), RegexChecker())
+        assert ['1'] == [p.uid for p in found]
+        found = st.find_for_inquiry(Inquiry(subject='Max', action='get', resource=['book']), RegexChecker())
+        assert ['1', '2'] == sorted(p.uid for p in found)
+
+    def test_exact_string_checker_with_non_string_inquiry_fields(self, st):
+        st.add(Policy('1', subjects=['Max'], actions=['get'], resources=['book']))
+        st.add(Policy('2', subjects=[{'name': Eq('Max')}]))
+        inquiry = Inquiry(subject={'name': 'Max'}, action='get', resource='book')
+        assert [] == list(st.find_for_inquiry(inquiry, StringExactChecker()))
+        assert not Guard(st, StringExactChecker()).is_allowed(inquiry)
+
     def test_find_for_inquiry_with_exact_string_checker(self, st):
         st.add(Policy('1', subjects=['max', 'bob'], actions=['get'], resources=['books', 'comics', 'magazines']))
         st.add(Policy('2', subjects=['maxim'], actions=['get'], resources=['books', 'comics', 'magazines']))
@@ -223,6 +274,72 @@ class TestSQLStorage:
         assert 1 == len(found)
         assert '3' == found[0].uid
 
+    @pytest.mark.parametrize('subject, expected', [
+        ('50%', ['1']),
+        ('%', ['1']),
+        ('0_o', ['2']),
+        ('_', ['2']),
+        ('5', ['1', '3']),
+        ('s0x', []),
+    ])
+    def test_find_for_inquiry_with_fuzzy_string_checker_escapes_wildcards(self, st, subject, expected):
+        st.add(Policy('1', subjects=['discount 50%'], actions=['get'], resources=['books']))
+        st.add(Policy('2', subjects=['o0_o0'], actions=['get'], resources=['books']))
+        st.add(Policy('3', subjects=['5s0o'], actions=['get'], resources=['books']))
+        found = st.find_for_inquiry(Inquiry(subject=subject, action='get', resource='books'), StringFuzzyChecker())
+        assert expected == sorted(p.uid for p in found)
+
+    def test_ngrams_are_maintained(self, st):
+        def ngrams():
+            return sorted(st.session.query(PolicyNgramModel.uid, PolicyNgramModel.field, PolicyNgramModel.ngram)
+                          .filter(PolicyNgramModel.uid.isnot(None)))
+        st.add(Policy('1', subjects=['abcd', 'bcd'], actions=['get']))
+        st.add(Policy('2', subjects=[Eq('abcd')], actions=[Eq('get')]))
+        assert [('1', 'actions', 'get'), ('1', 'subjects', 'abc'), ('1', 'subjects', 'bcd')] == ngrams()
+        st.update(Policy('1', subjects=['xyz'], resources=['<.*>']))
+        assert [('1', 'resources', '.*>'), ('1', 'resources', '<.*'), ('1', 'subjects', 'xyz')] == ngrams()
+        st.add_many([Policy('3', actions=['put'])])
+        st.update_many([Policy('3', actions=['post'])])
+        assert [('3', 'actions', 'ost'), ('3', 'actions', 'pos')] == [x for x in ngrams() if x[0] == '3']
+        st.delete_many(['1', '3'])
+        assert [] == ngrams()
+
+    def test_rule_tokens_are_maintained(self, st):
+        def tokens():
+            return st.session.query(PolicyRuleTokenModel.uid, PolicyRuleTokenModel.field,
+                                    PolicyRuleTokenModel.element_idx, PolicyRuleTokenModel.groups_count,
+                                    PolicyRuleTokenModel.group_idx, PolicyRuleTokenModel.token) \
+                .filter(PolicyRuleTokenModel.field == 'subjects') \
+                .order_by(PolicyRuleTokenModel.id).all()
+        st.add(Policy('1', subjects=['abcd']))
+        st.add(Policy('2', subjects=[{'name': Eq('Max'), 'role': In('admin')}, Any()]))
+        assert [('2', 'subjects', 0, 2, 0, '["eq", "name", "Max"]'),
+                ('2', 'subjects', 0, 2, 1, '["eq", "role", "admin"]'),
+                ('2', 'subjects', 1, 0, None, '*')] == tokens()
+        st.update(Policy('2', subjects=[Eq('Max')]))
+        assert [('2', 'subjects', 0, 1, 0, '["eq", null, "Max"]')] == tokens()
+        st.update_many([Policy('2', subjects=[{'team': StartsWith('dev')}])])
+        assert [('2', 'subjects', 0, 1, 0, '["prefix", "team", "dev"]')] == tokens()
+        st.delete_many(['2'])
+        assert [] == tokens()
+
+    def test_rules_checker_excludes_policies_by_constraints(self, st):
+        st.add_many([
+            Policy('1', subjects=[{'name': Eq('Max'), 'role': In('admin', 'owner')}], actions=[Eq('get')]),
+            Policy('2', subjects=[{'name': Eq('Max')}, {'name': Eq('Jim')}], actions=[{'method': StartsWith('ge')}]),
+            Policy('3', subjects=[{'name': Eq('Jim'), 'role': In('admin', 'owner')}], actions=[Eq('get')]),
+            Policy('4', subjects=[{'name': Equal('jim', ci=True)}], actions=[Equal('GET', ci=True)]),
+            Policy('5', subjects=[{'name': Eq('Max')}], actions=[Eq('put')]),
+            Policy('6', subjects=[{'name': Eq('Max')}], actions=[Eq('get')], resources=[Eq('books')]),
+            Policy('7', subjects=['Jim'], actions=['get']),
+        ])
+        inquiry = Inquiry(subject={'name': 'Jim', 'role': 'admin'}, action='get', resource='books')
+        assert ['3', '4'] == sorted(p.uid for p in st.find_for_inquiry(inquiry, RulesChecker()))
+        inquiry = Inquiry(subject={'name': 'Jim'}, action={'method': 'get'}, resource='books')
+        assert ['2', '4'] == sorted(p.uid for p in st.find_for_inquiry(inquiry, RulesChecker()))
+        inquiry = Inquiry(subject={'name': 'Max', 'role': 'owner'}, action='get', resource='books')
+        assert ['1', '4', '6'] == sorted(p.uid for p in st.find_for_inquiry(inquiry, RulesChecker()))
+
     @pytest.mark.parametrize('policies, inquiry, expected_reference', [
         (
             [
@@ -302,6 +419,61 @@ class TestSQLStorage:
         found_uids.sort()
         assertions.assertListEqual(['1', '2', '5'], found_uids)
 
+    def test_find_for_inquiry_decodes_only_cache_misses(self, st, session):
+        st.add_many([Policy(str(i), subjects=['Max'], actions=['get'], resources=['book%d' % i]) for i in range(3)])
+        inquiry = Inquiry(subject='Max', action='get', resource='book')
+        found = list(st.find_for_inquiry(inquiry, StringFuzzyChecker()))
+        assert ['0', '1', '2'] == sorted(p.uid for p in found)
+        again = list(st.find_for_inquiry(inquiry, StringFuzzyChecker()))
+        assert all(any(p is x for x in found) for p in again)
+        st.update(Policy('1', subjects=['Max'], actions=['get'], resources=['book1'], description='new'))
+        again = {p.uid: p for p in st.find_for_inquiry(inquiry, StringFuzzyChecker())}
+        assert 'new' == again['1'].description
+        assert again['0'] in found
+        assert again['1'] not in found
+        # cache is bounded
+        st = SQLStorage(scoped_session=session, cache_size=2)
+        assert 3 == len(list(st.find_for_inquiry(inquiry, StringFuzzyChecker())))
+        assert 2 == len(st.cache._policies)
+        # cache is turned off
+        st = SQLStorage(scoped_session=session, cache_size=0)
+        found = list(st.find_for_inquiry(inquiry, StringFuzzyChecker()))
+        assert 3 == len(found)
+        assert not set(map(id, found)).intersection(map(id, st.find_for_inquiry(inquiry, StringFuzzyChecker())))
+
+    @pytest.mark.parametrize('checker', [
+        None, RegexChecker(), StringExactChecker(), StringFuzzyChecker(), RulesChecker(),
+    ])
+    @pytest.mark.parametrize('cache_size', [0, 100])
+    def test_find_for_inquiries(self, st, session, monkeypatch, checker, cache_size):
+        st = SQLStorage(scoped_session=session, cache_size=cache_size)
+        st.add_many([
+            Policy('1', subjects=['Max', 'Jim'], actions=['get', 'list'], resources=['book<[0-9]>']),
+            Policy('2', subjects=['<[MJ].*>'], actions=['get'], resources=['book1', 'book2']),
+            Policy('3', subjects=['Nina'], actions=['list'], resources=['book<.*>']),
+            Policy('4', subjects=[Eq('Max'), Eq('Nina')], actions=[Eq('get')], resources=[Eq('book1')]),
+            Policy('5', subjects=['Max', 'Nina'], actions=['get'], resources=['book1']),
+        ])
+        inquiries = [
+            Inquiry(subject=s, action=a, resource=r)
+            for s in ('Max', 'Nina', 'Sam') for a in ('get', 'list') for r in ('book1', 'book')
+        ]
+        statements = []
+        event.listen(session.bind, 'before_cursor_execute', lambda *args: statements.append(args))
+        # another storage, so that its cache doesn't affect the checked one
+        other = SQLStorage(scoped_session=session)
+        expected = [(i, p.uid) for i, inq in enumerate(inquiries) for p in other.find_for_inquiry(inq, checker)]
+        assert expected
+        del statements[:]
+        assert sorted(expected) == sorted((i, p.uid) for i, p in st.find_for_inquiries(iter(inquiries), checker))
+        # one query for all the candidates and one more for documents of not cached ones
+        assert (1 if cache_size == 0 else 2) == len(statements)
+        del statements[:]
+        monkeypatch.setattr('vakt.storage.sql.MAX_INQUIRIES_IN_QUERY', 5)
+        assert sorted(expected) == sorted((i, p.uid) for i, p in st.find_for_inquiries(inquiries, checker))
+        assert 3 == len([s for s in statements if 'UNION ALL' in s[2]])
+        assert [] == list(st.find_for_inquiries([], checker))
+
     def test_find_for_inquiry_with_unknown_checker(self, st):
         st.add(Policy('1'))
         inquiry = Inquiry(subject='sam', action='get', resource='books')
@@ -353,11 +525,80 @@ class TestSQLStorage:
         st.delete('1')
         assert None is st.get('1')
 
+    def test_delete_commits_and_deletes_elements(self, st):
+        st.add(Policy('1', subjects=['max'], actions=['get'], resources=['<.*>']))
+        st.add(Policy('2', subjects=['max'], actions=['get'], resources=['<.*>']))
+        st.delete('1')
+        st.session.rollback()
+        assert None is st.get('1')
+        assert ['2'] == [uid for (uid,) in st.session.query(PolicySubjectModel.uid)]
+
     def test_delete_nonexistent(self, st):
         uid = str('non-existent-id')
         st.delete(uid)
         assert None is st.get(uid)
 
+    def test_add_many(self, st):
+        st.add_many([
+            Policy('1', subjects=['max'], actions=['get', 'put'], resources=['<books|comics>']),
+            Policy(2, subjects=[Eq('max')], context={'secret': Equal('foo')}),
+        ])
+        assert ['get', 'put'] == st.get('1').actions
+        assert ['<books|comics>'] == st.get('1').resources
+        assert isinstance(st.get('2').context['secret'], Equal)
+        inquiry = Inquiry(subject='max', action='put', resource='books')
+        assert ['1'] == [p.uid for p in st.find_for_inquiry(inquiry, StringFuzzyChecker())]
+        st.add_many([])
+        assert 2 == len(list(st.get_all(100, 0)))
+
+    def test_add_many_existing(self, st):
+        st.add(Policy('1', description='foo'))
+        with pytest.raises(PolicyExistsError) as e:
+            st.add_many([Policy('2'), Policy('1', description='bar')])
+        assert 'Conflicting UID = 1' == str(e.value)
+        with pytest.raises(PolicyExistsError) as e:
+            st.add_many([Policy('3'), Policy('3')])
+        assert 'Conflicting UID = 3' == str(e.value)
+        assert ['1'] == [p.uid for p in st.get_all(100, 0)]
+        assert 'foo' == st.get('1').description
+
+    def test_update_many(self, st):
+        st.add_many([Policy('1', actions=['get']), Policy('2', actions=['get']), Policy('3', actions=['get'])])
+        st.update_many([
+            Policy('1', actions=['put'], description='foo'),
+            Policy('3', actions=['post', 'put'], description='bar'),
+            Policy('4', actions=['put']),
+        ])
+        assert ['put'] == st.get('1').actions
+        assert ['get'] == st.get('2').actions
+        assert ['post', 'put'] == st.get('3').actions
+        assert 'bar' == st.get('3').description
+        assert st.get('4') is None
+        st.update_many([])
+
+    def test_delete_many(self, st):
+        st.add_many([Policy(str(i), actions=['get']) for i in range(5)])
+        st.delete_many(['1', '3', 'non-existent-id'])
+        assert ['0', '2', '4'] == [p.uid for p in st.get_all(100, 0)]
+        st.delete_many([])
+        assert 3 == len(list(st.get_all(100, 0)))
+
+    @pytest.mark.parametrize('batch', [1, 3, 7, 20, 21, 100])
+    def test_retrieve_all(self, st, batch):
+        st.add_many([Policy(str(i), actions=['get']) for i in range(21)])
+        assert sorted(map(str, range(21))) == [p.uid for p in st.retrieve_all(batch)]
+        assert [] == list(st.retrieve_all(0))
+
+    def test_retrieve_all_uses_keyset_pagination(self, st):
+        st.add_many([Policy(str(i), actions=['get']) for i in range(5)])
+        policies, token = st._get_batch(2, None)
+        assert (['0', '1'], '1') == ([p.uid for p in policies], token)
+        st.delete('0')
+        policies, token = st._get_batch(2, token)
+        assert (['2', '3'], '3') == ([p.uid for p in policies], token)
+        policies, token = st._get_batch(2, token)
+        assert (['4'], None) == ([p.uid for p in policies], token)
+
     @pytest.mark.parametrize('effect', [
         ALLOW_ACCESS,
         DENY_ACCESS,
@@ -373,3 +614,140 @@ class TestSQLStorage:
         st.update(policy)
         policy_back = st.get('1')
         assert effect == policy_back.effect
+
+    def test_session_per_operation_removes_session(self, session):
+        st = SQLStorage(scoped_session=session, session_per_operation=True)
+        st.add(Policy('1', subjects=['max'], actions=['get'], resources=['books']))
+        assert not session.registry.has()
+        st.add_many([Policy('2', subjects=['max'], actions=['get'], resources=['comics'])])
+        assert not session.registry.has()
+        assert '1' == st.get('1').uid
+        assert not session.registry.has()
+        found = st.find_for_inquiry(Inquiry(subject='max', action='get', resource='books'), RegexChecker())
+        assert '1' == next(found).uid
+        # all found policies are fetched at once, so transaction isn't left open while they are iterated
+        assert not session.registry.has()
+        inquiry = Inquiry(subject='max', action='get', resource='comics')
+        assert [(0, '2')] == [(i, p.uid) for i, p in st.find_for_inquiries([inquiry], StringExactChecker())]
+        assert not session.registry.has()
+        assert ['1', '2'] == [p.uid for p in st.get_all(10, 0)]
+        assert ['1', '2'] == [p.uid for p in st.retrieve_all(1)]
+        assert not session.registry.has()
+        st.update(Policy('1', subjects=['sam']))
+        st.update_many([Policy('2', subjects=['sam'])])
+        st.delete('1')
+        st.delete_many(['2'])
+        assert not session.registry.has()
+        assert [] == list(st.get_all(10, 0))
+
+    def test_session_per_operation_reads_in_read_only_transaction(self, session, monkeypatch):
+        st = SQLStorage(scoped_session=session, session_per_operation=True)
+        st.add(Policy('1', subjects=['max'], actions=['get'], resources=['books']))
+        statements = []
+
+        def replace_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+            # SQLite doesn't support read-only transactions, so pretend it does
+            if statement == 'SET TRANSACTION READ ONLY':
+                return 'SELECT 1', ()
+            return statement, parameters
+
+        event.listen(session.bind, 'before_cursor_execute', replace_statement, retval=True)
+        try:
+            monkeypatch.setattr('vakt.storage.sql.READ_ONLY_TRANSACTION_DIALECTS', (st.dialect,))
+            assert '1' == st.get('1').uid
+            assert ['1'] == [p.uid for p in st.find_for_inquiry(Inquiry(subject='max'))]
+            st.delete('1')
+            assert ['SET TRANSACTION READ ONLY', 'SET TRANSACTION READ ONLY'] == [
+                s for s in statements if not s.startswith(('SELECT', 'DELETE'))
+            ]
+            # only reads start with it
+            assert 'SET TRANSACTION READ ONLY' == statements[0]
+            assert not statements[-1].startswith('SET')
+        finally:
+            event.remove(session.bind, 'before_cursor_execute', replace_statement)
+
+
+def test_create_session(tmpdir):
+    session = create_session('sqlite:///%s' % tmpdir.join('vakt.db'), pool_size=3, max_overflow=0,
+                             poolclass=QueuePool)
+    assert isinstance(session.bind.pool, QueuePool)
+    assert 3 == session.bind.pool.size()
+    session = create_session('sqlite:///:memory:')
+    Base.metadata.create_all(session.bind)
+    st = SQLStorage(scoped_session=session)
+    st.add(Policy('1'))
+    assert '1' == st.get('1').uid
+
+
+@pytest.mark.sql_integration
+class TestSQLStorageReadReplicas:
+
+    @pytest.yield_fixture
+    def sessions(self, tmpdir):
+        # files of SQLite databases stand in for the primary database and its replicas
+        sessions = []
+        for name in ('primary', 'replica1', 'replica2'):
+            engine = create_engine('sqlite:///%s' % tmpdir.join(name + '.db'))
+            Base.metadata.create_all(engine)
+            session = scoped_session(sessionmaker(bind=engine))
+            # replication isn't there, so policy of the same uid differs by its description in each database
+            SQLStorage(scoped_session=session).add(Policy('1', subjects=['max'], description=name))
+            sessions.append(session)
+        yield sessions
+        for session in sessions:
+            session.remove()
+
+    @staticmethod
+    def read(st):
+        return st.get('1').description
+
+    @pytest.mark.parametrize('session_per_operation', [False, True])
+    def test_reads_are_routed_to_replicas_in_turn(self, sessions, session_per_operation):
+        st = SQLStorage(scoped_session=sessions[0], read_sessions=sessions[1:],
+                        session_per_operation=session_per_operation)
+        assert ['replica1', 'replica2', 'replica1'] == [self.read(st) for _ in range(3)]
+        assert ['replica2'] == [p.description for p in st.get_all(10, 0)]
+        assert ['replica1'] == [p.description for p in st.retrieve_all()]
+        assert ['replica2'] == [p.description for p in st.find_for_inquiry(Inquiry(subject='max'))]
+        assert [(0, 'replica1')] == [(i, p.description) for i, p in st.find_for_inquiries([Inquiry()])]
+        if session_per_operation:
+            assert not any(s.registry.has() for s in sessions)
+
+    def test_writes_go_to_primary_and_reads_follow_within_window(self, sessions, monkeypatch):
+        clock = [100.0]
+        monkeypatch.setattr('vakt.storage.sql.time.monotonic', lambda: clock[0])
+        st = SQLStorage(scoped_session=sessions[0], read_sessions=sessions[1:], read_your_writes_window=5)
+        assert 'replica1' == self.read(st)
+        st.update(Policy('1', subjects=['max'], description='updated'))
+        assert 'updated' == sessions[0].query(PolicyModel.description).scalar()
+        assert ['replica1', 'replica2'] == [s.query(PolicyModel.description).scalar() for s in sessions[1:]]
+        assert ['updated', 'updated'] == [self.read(st) for _ in range(2)]
+        clock[0] += 4.9
+        assert 'updated' == self.read(st)
+        clock[0] += 0.2
+        assert 'replica2' == self.read(st)
+        st.add(Policy('2'))
+        assert 'updated' == self.read(st)
+        # window can be turned off
+        st.read_your_writes_window = 0
+        st.delete('2')
+        assert 'replica1' == self.read(st)
+
+    def test_without_replicas_reads_go_to_primary(self, sessions):
+        st = SQLStorage(scoped_session=sessions[0])
+        assert ['primary', 'primary'] == [self.read(st) for _ in range(2)]
+
+    def test_least_latency_selector(self, sessions):
+        selector = LeastLatencySelector()
+        st = SQLStorage(scoped_session=sessions[0], read_sessions=sessions[1:], read_selector=selector)
+        assert 0 == selector.select([s.bind for s in sessions[1:]])
+
+        def slow_down(*args):
+            time.sleep(0.01)
+
+        # selector already listens to the statements, so this delay is measured as a part of them
+        event.listen(sessions[1].bind, 'before_cursor_execute', slow_down)
+        # each replica is tried first and then the fastest one is used
+        assert ['replica1', 'replica2', 'replica2', 'replica2'] == [self.read(st) for _ in range(4)]
+        assert ['replica2'] == [p.description for p in st.find_for_inquiry(Inquiry(subject='max'))]
@@ -1,9 +1,11 @@
 import pytest
 from operator import attrgetter
 
+from vakt.storage.abc import Storage
 from vakt.storage.memory import MemoryStorage
 from vakt.policy import Policy
-from ..helper import MemoryStorageYieldingExample
+from vakt.guard import Inquiry
+from ..helper import MemoryStorageYieldingExample, MemoryStorageFilteringExample
 
 
 @pytest.mark.parametrize('st', [
@@ -32,3 +34,67 @@ def test_retrieve_all_for_returning_storage(st):
     res = list(st.retrieve_all(100000))
     assert 5 == len(res)
     assert expected_ids == sorted(map(attrgetter('uid'), res))
+
+
+class KeysetMemoryStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.get_all_calls = 0
+
+    def get_all(self, limit, offset):
+        self.get_all_calls += 1
+        return super().get_all(limit, offset)
+
+    def _get_batch(self, limit, token):
+        uids = sorted(uid for uid in self.policies if token is None or uid > token)[:limit]
+        if len(uids) < limit:
+            return [self.policies[uid] for uid in uids], None
+        return [self.policies[uid] for uid in uids], uids[-1]
+
+
+def test_retrieve_all_uses_continuation_tokens():
+    st = KeysetMemoryStorage()
+    for uid in ['d', 'a', 'e', 'c', 'b']:
+        st.add(Policy(uid))
+    for i in range(1, 7):
+        assert ['a', 'b', 'c', 'd', 'e'] == list(map(attrgetter('uid'), Storage.retrieve_all(st, i)))
+    assert 0 == st.get_all_calls
+
+
+def test_retrieve_all_default_batch_pages_through_get_all():
+    st = KeysetMemoryStorage()
+    for uid in ['a', 'b', 'c']:
+        st.add(Policy(uid))
+    batch, token = Storage._get_batch(st, 2, None)
+    assert ['a', 'b'] == list(map(attrgetter('uid'), batch))
+    assert 2 == token
+    batch, token = Storage._get_batch(st, 2, token)
+    assert ['c'] == list(map(attrgetter('uid'), batch))
+    assert 4 == token
+    assert 2 == st.get_all_calls
+
+
+def test_batch_methods_default_implementation():
+    st = KeysetMemoryStorage()
+    Storage.add_many(st, [Policy('a'), Policy('b', description='foo'), Policy('c')])
+    assert ['a', 'b', 'c'] == sorted(st.policies)
+    Storage.update_many(st, [Policy('a', description='bar'), Policy('b', description='baz')])
+    assert 'bar' == st.get('a').description
+    assert 'baz' == st.get('b').description
+    Storage.delete_many(st, ['a', 'c', 'x'])
+    assert ['b'] == sorted(st.policies)
+
+
+def test_find_fitting_for_inquiry_default_implementation():
+    st = MemoryStorageFilteringExample()
+    st.add(Policy('a', subjects=['Max']))
+    assert None is st.find_fitting_for_inquiry(Inquiry(subject='Max'))
+
+
+def test_find_for_inquiries_default_implementation():
+    st = MemoryStorageFilteringExample()
+    p1, p2 = Policy('a', subjects=['Max', 'Jim']), Policy('b', subjects=['Jim'])
+    st.add_many([p1, p2])
+    inquiries = [Inquiry(subject='Jim'), Inquiry(subject='Nina'), Inquiry(subject='Max')]
+    assert [(0, p1), (0, p2), (2, p1)] == sorted(st.find_for_inquiries(iter(inquiries)), key=lambda x: (x[0], x[1].uid))
+    assert [] == list(st.find_for_inquiries([]))
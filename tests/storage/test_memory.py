@@ -1,3 +1,5 @@
+import threading
+
 import pytest
 
 from vakt.storage.memory import MemoryStorage
@@ -117,3 +119,100 @@ def test_delete(st):
     st.delete('1')
     assert None is st.get('1')
     st.delete('1000000')
+
+
+def test_find_for_inquiry_returns_snapshot_not_affected_by_mutations(st):
+    st.add(Policy('1'))
+    st.add(Policy('2'))
+    found = st.find_for_inquiry(Inquiry())
+    st.add(Policy('3'))
+    st.delete('1')
+    st.update(Policy('2', description='foo'))
+    assert ['1', '2'] == [p.uid for p in found]
+    assert None is [p for p in found if p.uid == '2'][0].description
+    assert ['2', '3'] == sorted(p.uid for p in st.find_for_inquiry(Inquiry()))
+    assert 'foo' == st.get('2').description
+
+
+def test_snapshot_is_reused_until_mutation(st):
+    st.add(Policy('1'))
+    first = st.find_for_inquiry(Inquiry())
+    assert first is st.find_for_inquiry(Inquiry())
+    st.delete('10000')
+    assert first is st.find_for_inquiry(Inquiry())
+    st.add(Policy('2'))
+    assert first is not st.find_for_inquiry(Inquiry())
+
+
+def test_concurrent_reads_and_writes(st):
+    errors = []
+
+    def write(prefix):
+        try:
+            for i in range(300):
+                uid = '%s-%d' % (prefix, i)
+                st.add(Policy(uid))
+                st.update(Policy(uid, description='foo'))
+                if i % 2:
+                    st.delete(uid)
+        except Exception as e:
+            errors.append(e)
+
+    def read():
+        try:
+            for _ in range(300):
+                for p in st.find_for_inquiry(Inquiry()):
+                    assert p.uid
+                st.get_all(10, 5)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(x,)) for x in 'abc'] + \
+              [threading.Thread(target=read) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [] == errors
+    assert 450 == len(list(st.find_for_inquiry(Inquiry())))
+
+
+def test_retrieve_all_streams_snapshot(st):
+    for i in range(5):
+        st.add(Policy(str(i)))
+    gen = st.retrieve_all(2)
+    assert '0' == next(gen).uid
+    st.delete('4')
+    st.add(Policy('5'))
+    assert ['1', '2', '3', '4'] == [p.uid for p in gen]
+    assert ['0', '1', '2', '3', '5'] == [p.uid for p in st.retrieve_all(2)]
+    assert [] == list(st.retrieve_all(0))
+    with pytest.raises(ValueError):
+        list(st.retrieve_all(-1))
+
+
+def test_add_many(st):
+    st.add(Policy('1'))
+    st.add_many(Policy(str(i)) for i in range(2, 5))
+    assert ['1', '2', '3', '4'] == [p.uid for p in st.retrieve_all()]
+    with pytest.raises(PolicyExistsError) as e:
+        st.add_many([Policy('5'), Policy('3')])
+    assert 'Conflicting UID = 3' == str(e.value)
+    with pytest.raises(PolicyExistsError) as e:
+        st.add_many([Policy('6'), Policy('6')])
+    assert 'Conflicting UID = 6' == str(e.value)
+    # nothing is added if any policy fails
+    assert None is st.get('5')
+    assert None is st.get('6')
+    st.add_many([])
+    assert 4 == len(st.get_all(100, 0))
+
+
+def test_update_many_and_delete_many(st):
+    st.add_many([Policy('1'), Policy('2'), Policy('3')])
+    st.update_many([Policy('1', description='foo'), Policy('3', description='bar')])
+    assert ['foo', None, 'bar'] == [p.description for p in st.retrieve_all()]
+    st.delete_many(['1', '3', '100'])
+    assert ['2'] == [p.uid for p in st.retrieve_all()]
+    st.delete_many([])
+    assert ['2'] == [p.uid for p in st.retrieve_all()]
@@ -1,7 +1,7 @@
 from abc import abstractmethod
 import pytest
 
-from vakt.storage.migration import Migration, MigrationSet, Migrator
+from vakt.storage.migration import Migration, MigrationSet, Migrator, MigrationProgress
 
 
 # SETUP
@@ -128,3 +128,17 @@ def test_migrator_down_with_number(db, expect_data, expect_saved_version, number
     m.down(number)
     assert expect_data == db['data']
     assert expect_saved_version == db['ver']
+
+
+def test_migration_progress(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('vakt.storage.migration.time.monotonic', lambda: now[0])
+    reports = []
+    progress = MigrationProgress('Migration #1 up', lambda p: reports.append((p.processed, p.failed, p.rate)))
+    assert 0.0 == progress.rate
+    now[0] = 102.0
+    progress.advance(100)
+    now[0] = 104.0
+    progress.advance(100, 2)
+    assert [(100, 0, 50.0), (200, 2, 50.0)] == reports
+    MigrationProgress('Migration #1 up').advance(1)
@@ -0,0 +1,235 @@
+import os
+import multiprocessing
+from operator import attrgetter
+
+import pytest
+
+from vakt.storage.mmap import MMapStorage
+from vakt.policy import Policy
+from vakt.guard import Inquiry, Guard
+from vakt.checker import StringExactChecker, StringFuzzyChecker, RegexChecker, RulesChecker
+from vakt.effects import ALLOW_ACCESS
+from vakt.exceptions import PolicyExistsError, UnknownCheckerType, ReadOnlyStorageError
+from vakt.rules.operator import Eq
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('policies'))
+
+
+@pytest.fixture
+def st(path):
+    return MMapStorage(path, writer=True)
+
+
+def read_uids(path, queue):
+    queue.put(sorted(p.uid for p in MMapStorage(path).retrieve_all()))
+
+
+def test_add(st):
+    st.add(Policy('1', description='foo'))
+    assert '1' == st.get('1').uid
+    assert 'foo' == st.get('1').description
+    st.add(Policy('2', actions=[Eq('get'), Eq('put')], subjects=[Eq('max')], resources=[{'books': Eq('Harry')}]))
+    assert '2' == st.get('2').uid
+    assert 2 == len(st.get('2').actions)
+    assert isinstance(st.get('2').subjects[0], Eq)
+    assert 'Harry' == st.get('2').resources[0]['books'].val
+
+
+def test_policy_create_existing(st):
+    st.add(Policy('1', description='foo'))
+    with pytest.raises(PolicyExistsError):
+        st.add(Policy('1', description='bar'))
+
+
+def test_get(st):
+    st.add(Policy('1'))
+    st.add(Policy(2, description='some text'))
+    st.add(Policy('юникод', description='ключ'))
+    assert '1' == st.get('1').uid
+    assert 2 == st.get(2).uid
+    assert 'some text' == st.get(2).description
+    assert 'ключ' == st.get('юникод').description
+    assert st.get('2') is None
+    assert st.get('3') is None
+
+
+@pytest.mark.parametrize('limit, offset, result', [
+    (500, 0, 200),
+    (101, 1, 101),
+    (500, 50, 150),
+    (200, 1, 199),
+    (0, 0, 0),
+    (0, 100, 0),
+    (5, 4, 5),
+    (200, 300, 0),
+])
+def test_get_all(st, limit, offset, result):
+    for i in range(200):
+        st.add(Policy(str(i)))
+    assert result == len(st.get_all(limit, offset))
+
+
+def test_get_all_with_incorrect_args(st):
+    with pytest.raises(ValueError):
+        st.get_all(-1, 90)
+    with pytest.raises(ValueError):
+        st.get_all(0, -34)
+
+
+def test_retrieve_all(st):
+    for uid in ['c', 'a', 'b']:
+        st.add(Policy(uid))
+    assert ['a', 'b', 'c'] == list(map(attrgetter('uid'), st.retrieve_all(2)))
+
+
+@pytest.mark.parametrize('checker, inquiry, expect', [
+    (None, Inquiry(action='get', subject='max', resource='book'), ['1', '2', '3', '4']),
+    (StringExactChecker(), Inquiry(action='get', subject='max', resource='book'), ['1']),
+    (StringExactChecker(), Inquiry(action='get', subject='bob', resource='book'), []),
+    (StringFuzzyChecker(), Inquiry(action='ge', subject='ax', resource='bo'), ['1', '2']),
+    (StringFuzzyChecker(), Inquiry(action='ge', subject='на', resource='bo'), ['2']),
+    (RegexChecker(), Inquiry(action='get', subject='max', resource='book'), ['1', '2', '3']),
+    (RulesChecker(), Inquiry(action='get', subject='max', resource='book'), ['4']),
+])
+def test_find_for_inquiry(st, checker, inquiry, expect):
+    st.add(Policy('1', actions=['get'], subjects=['max'], resources=['book']))
+    st.add(Policy('2', actions=['<get|put>'], subjects=['Maxine', 'нина'], resources=['books']))
+    st.add(Policy('3', actions=['put'], subjects=['<.*>'], resources=['book']))
+    st.add(Policy('4', actions=[Eq('get')], subjects=[Eq('max')], resources=[Eq('book')]))
+    assert expect == sorted(p.uid for p in st.find_for_inquiry(inquiry, checker))
+
+
+def test_find_for_inquiry_with_unknown_checker(st):
+    st.add(Policy('1'))
+    with pytest.raises(UnknownCheckerType):
+        list(st.find_for_inquiry(Inquiry(), Inquiry()))
+
+
+def test_update_and_delete(st):
+    st.add(Policy('1', description='foo'))
+    st.add(Policy('2'))
+    st.update(Policy('1', description='bar'))
+    assert 'bar' == st.get('1').description
+    st.update(Policy('100', description='bar'))
+    assert st.get('100') is None
+    st.delete('2')
+    assert st.get('2') is None
+    st.delete('1000000')
+    assert ['1'] == [p.uid for p in st.get_all(10, 0)]
+
+
+def test_batch_methods_publish_once(path, st):
+    st.add_many([Policy('1'), Policy('2'), Policy('3')])
+    assert 2 == st._read_generation()
+    with pytest.raises(PolicyExistsError):
+        st.add_many([Policy('4'), Policy('1')])
+    with pytest.raises(PolicyExistsError):
+        st.add_many([Policy('4'), Policy('4')])
+    st.update_many([Policy('1', description='foo'), Policy('2', description='bar'), Policy('5')])
+    assert 3 == st._read_generation()
+    st.delete_many(['1', '3', '5'])
+    assert 4 == st._read_generation()
+    st.delete_many(['100'])
+    assert 4 == st._read_generation()
+    assert [('2', 'bar')] == [(p.uid, p.description) for p in MMapStorage(path).get_all(10, 0)]
+
+
+def test_bulk_publishes_once(path, st):
+    reader = MMapStorage(path)
+    with st.bulk():
+        for i in range(100):
+            st.add(Policy(str(i)))
+        with st.bulk():
+            st.update(Policy('0', description='foo'))
+        st.delete_many(['1', '2'])
+        st.delete('3')
+        assert 1 == st._read_generation()
+        assert [] == reader.get_all(10, 0)
+    assert 2 == st._read_generation()
+    assert 97 == len(reader.get_all(100, 0))
+    assert 'foo' == reader.get('0').description
+    # changes made before an error are published as well
+    with pytest.raises(PolicyExistsError):
+        with st.bulk():
+            st.add(Policy('100'))
+            st.add(Policy('100'))
+    assert 3 == st._read_generation()
+    assert reader.get('100') is not None
+    with st.bulk():
+        pass
+    assert 3 == st._read_generation()
+    with pytest.raises(ReadOnlyStorageError):
+        with reader.bulk():
+            pass
+
+
+def test_reader_sees_writer_changes(path, st):
+    reader = MMapStorage(path)
+    assert [] == reader.get_all(10, 0)
+    st.add(Policy('1', actions=['get'], subjects=['max'], resources=['book'], effect=ALLOW_ACCESS))
+    guard = Guard(reader, StringExactChecker())
+    assert guard.is_allowed(Inquiry(action='get', subject='max', resource='book'))
+    st.update(Policy('1', actions=['put'], subjects=['max'], resources=['book'], effect=ALLOW_ACCESS))
+    assert not guard.is_allowed(Inquiry(action='get', subject='max', resource='book'))
+    st.delete('1')
+    assert reader.get('1') is None
+
+
+def test_reader_can_not_mutate(path, st):
+    reader = MMapStorage(path)
+    with pytest.raises(ReadOnlyStorageError):
+        reader.add(Policy('1'))
+    with pytest.raises(ReadOnlyStorageError):
+        reader.update(Policy('1'))
+    with pytest.raises(ReadOnlyStorageError):
+        reader.delete('1')
+
+
+def test_reader_of_inexistent_storage(path):
+    with pytest.raises(FileNotFoundError):
+        MMapStorage(path)
+
+
+def test_writer_restores_published_policies(path, st):
+    st.add(Policy('1', description='foo'))
+    st.add(Policy('2', context={'a': Eq(1)}))
+    st2 = MMapStorage(path, writer=True)
+    assert ['1', '2'] == [p.uid for p in st2.get_all(10, 0)]
+    with pytest.raises(PolicyExistsError):
+        st2.add(Policy('1'))
+    st2.add(Policy('3'))
+    assert ['1', '2', '3'] == [p.uid for p in MMapStorage(path).get_all(10, 0)]
+
+
+def test_stale_data_files_are_removed(path, st):
+    for i in range(5):
+        st.add(Policy(str(i)))
+    data_files = sorted(f for f in os.listdir(os.path.dirname(path)) if f != 'policies')
+    assert ['policies.5', 'policies.6'] == data_files
+
+
+def test_decoded_policies_cache(path, st):
+    reader = MMapStorage(path, cache_size=2)
+    for i in range(3):
+        st.add(Policy(str(i)))
+    assert reader.get('0') is reader.get('0')
+    list(reader.get_all(3, 0))
+    assert 2 == len(reader._decoded)
+    # unchanged policies stay decoded across generations
+    p = reader.get('2')
+    st.add(Policy('3'))
+    assert p is reader.get('2')
+
+
+def test_reader_in_another_process(path, st):
+    st.add(Policy('1'))
+    st.add(Policy('2'))
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=read_uids, args=(path, queue))
+    proc.start()
+    assert ['1', '2'] == queue.get(timeout=30)
+    proc.join()
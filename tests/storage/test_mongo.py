@@ -6,14 +6,18 @@ import unittest
 from operator import attrgetter
 
 import pytest
+from unittest.mock import MagicMock
 from pymongo import MongoClient
 from bson.objectid import ObjectId
 
 from vakt.storage.mongo import *
+from vakt.storage.mongo import _element_may_fit
+from vakt.parser import compile_regex
 from vakt.storage.memory import MemoryStorage
 from vakt.effects import ALLOW_ACCESS
 from vakt.policy import Policy
-from vakt.rules.string import Equal
+from vakt.rules.string import Equal, StartsWith
+from vakt.rules.list import In
 from vakt.rules.logic import Any
 from vakt.rules.operator import Eq
 from vakt.exceptions import PolicyExistsError, UnknownCheckerType
@@ -93,6 +97,25 @@ class TestMongoStorage:
         assert 2 == st.get(2).uid
         assert 'some text' == st.get(2).description
 
+    def test_policies_are_stored_as_dicts_and_read_without_query_fields(self, st):
+        policies = [
+            Policy('1', subjects=['<[Mm]ax>', 'sally'], actions=['get'], context={'ip': Eq('127.0.0.1')}),
+            Policy('2', subjects=[{'name': Eq('Max'), 'role': In('admin')}], actions=[StartsWith('get')]),
+        ]
+        st.add_many(policies)
+        for policy in policies:
+            doc = st.collection.find_one(policy.uid)
+            assert set(st.read_projection).intersection(doc)
+            assert policy.to_dict() == {k: v for k, v in doc.items() if k not in st.read_projection and
+                                        k not in ('_id', 'etag')}
+            doc = st.collection.find_one(policy.uid, projection=st.read_projection)
+            assert not set(st.read_projection).intersection(doc)
+            assert policy.to_json(sort=True) == st.get(policy.uid).to_json(sort=True)
+        assert ['subjects_compiled_regex', 'subjects_literal_prefix', 'subjects_rule_constraints',
+                'subjects_rule_tokens'] == \
+            sorted(k for k in st.read_projection if k.startswith('subjects'))
+        assert all(v is False for v in st.read_projection.values())
+
     def test_get_nonexistent(self, st):
         assert None is st.get(123456789)
 
@@ -320,6 +343,23 @@ class TestMongoStorage:
         assert reference_answer == Guard(st, RegexChecker()).is_allowed(inquiry), \
             'Mongo storage should give the same answers as reference'
 
+    def test_find_for_inquiry_with_regex_checker_restricts_by_literal_prefix(self, st):
+        st.add(Policy('1', subjects=['Max<[a-z]+>'], actions=['<.*>'], resources=[r'books:<\d+>']))
+        st.add(Policy('2', subjects=['Bob<[a-z]+>', 'Jim'], actions=['get'], resources=[r'books:<\d+>']))
+        st.add(Policy('3', subjects=['Max<[a-z]+>'], actions=['<.*>'], resources=[r'comics:<\d+>']))
+        pipeline = st._create_filter(Inquiry(subject='Maxim', action='get', resource='books:12'), RegexChecker())[0]
+        assert {'$in': ['', 'M', 'Ma', 'Max', 'Maxi', 'Maxim', None]} == \
+            pipeline[0]['$match']['subjects_literal_prefix']
+        found = st.find_for_inquiry(Inquiry(subject='Maxim', action='get', resource='books:12'), RegexChecker())
+        assert ['1'] == [p.uid for p in found]
+        found = st.find_for_inquiry(Inquiry(subject='Jim', action='get', resource='books:12'), RegexChecker())
+        assert ['2'] == [p.uid for p in found]
+        assert 'subjects_literal_prefix' not in vars(st.get('2'))
+        # policies stored without literal prefixes are still found
+        st.collection.update_many({}, {'$unset': {'subjects_literal_prefix': ''}})
+        found = st.find_for_inquiry(Inquiry(subject='Maxim', action='get', resource='books:12'), RegexChecker())
+        assert ['1'] == [p.uid for p in found]
+
     def test_find_for_inquiry_with_regex_checker_for_mongodb_prior_to_4_2(self, st):
         # mock db server version for this test
         st.db_server_version = (3, 4, 0)
@@ -329,12 +369,23 @@ class TestMongoStorage:
         st.add(Policy('3.1', subjects=['Jim'], actions=[r'del<\w+>'], resources=['server']))
         st.add(Policy('4', subjects=[{'stars': Eq(90)}, Eq('Max')]))
         st.add(Policy('5', subjects=[Eq('Jim'), Eq('Nina')]))
+        st.add(Policy('6', subjects=['<J.*>'], actions=['<delete|update>'], resources=['server']))
+        st.add(Policy('7', subjects=['Jim'], actions=['<get|update>'], resources=['server<s?>']))
         inquiry = Inquiry(subject='Jim', action='delete', resource='server')
-        found = st.find_for_inquiry(inquiry, RegexChecker())
-        found = list(found)
-        # should return all string-based polices, but not only matched ones
-        assert 4 == len(found)
-        assert ['1', '2', '3', '3.1'] == sorted(map(attrgetter('uid'), found))
+        # policies are narrowed by literal prefixes, regexes are matched before policies are decoded
+        q_filter = st._create_filter(inquiry, RegexChecker())[0]
+        assert {'$in': ['', 'J', 'Ji', 'Jim', None]} == q_filter['subjects_literal_prefix']
+        expected = ['3', '3.1', '6']
+        assert expected == sorted(map(attrgetter('uid'), st.find_for_inquiry(inquiry, RegexChecker())))
+        assert [(0, uid) for uid in expected] == sorted(
+            (i, p.uid) for i, p in st.find_for_inquiries([inquiry], RegexChecker()))
+        # policies without compiled regexes are left for RegexChecker to decide
+        st.collection.update_one({'_id': '7'}, {'$unset': {'actions_compiled_regex': ''}})
+        assert expected + ['7'] == sorted(map(attrgetter('uid'), st.find_for_inquiry(inquiry, RegexChecker())))
+        st.cache.maxsize = 0
+        found = list(st.find_for_inquiry(inquiry, RegexChecker()))
+        assert expected + ['7'] == sorted(map(attrgetter('uid'), found))
+        assert all('actions_compiled_regex' not in vars(p) for p in found)
 
     def test_find_for_inquiry_with_rules_checker(self, st):
         assertions = unittest.TestCase('__init__')
@@ -349,6 +400,126 @@ class TestMongoStorage:
         assert 3 == len(found)
         assertions.assertListEqual([1, 2, 5], list(map(operator.attrgetter('uid'), found)))
 
+    def test_find_for_inquiry_with_rules_checker_excludes_policies_by_constraints(self, st):
+        st.add_many([
+            Policy('1', subjects=[{'name': Eq('Max'), 'role': In('admin', 'owner')}], actions=[Eq('get')]),
+            Policy('2', subjects=[{'name': Eq('Max')}, {'name': Eq('Jim')}], actions=[{'method': StartsWith('ge')}]),
+            Policy('3', subjects=[{'name': Eq('Jim'), 'role': Any()}], actions=[Eq('get')]),
+            Policy('4', subjects=[{'name': Equal('jim', ci=True)}], actions=[Any()]),
+            Policy('5', subjects=[{'name': Eq('Max')}], actions=[Eq('put')]),
+            Policy('6', subjects=[{'name': Eq('Max')}], actions=[Eq('get')], resources=[Eq('books')]),
+            Policy('7', subjects=['Jim'], actions=['get']),
+        ])
+        inquiry = Inquiry(subject={'name': 'Jim', 'role': 'admin'}, action='get', resource='books')
+        assert ['3', '4'] == sorted(p.uid for p in st.find_for_inquiry(inquiry, RulesChecker()))
+        inquiry = Inquiry(subject={'name': 'Jim'}, action={'method': 'get'}, resource='books')
+        assert ['2', '4'] == sorted(p.uid for p in st.find_for_inquiry(inquiry, RulesChecker()))
+        inquiry = Inquiry(subject={'name': 'Max', 'role': 'owner'}, action='get', resource='books')
+        assert ['1', '4', '6'] == sorted(p.uid for p in st.find_for_inquiry(inquiry, RulesChecker()))
+        assert 'subjects_rule_constraints' not in vars(st.get('1'))
+        # policies saved without constraints are always candidates
+        st.collection.update_many({}, {'$unset': {'subjects_rule_constraints': '', 'subjects_rule_tokens': ''}})
+        inquiry = Inquiry(subject={'name': 'Jim'}, action='put', resource='books')
+        assert ['4', '5'] == sorted(p.uid for p in st.find_for_inquiry(inquiry, RulesChecker()))
+
+    @pytest.mark.parametrize('checker', [StringFuzzyChecker(), RegexChecker()])
+    def test_find_for_inquiry_decodes_only_cache_misses(self, st, checker):
+        st.add_many([Policy(str(i), subjects=['Max'], actions=['get'], resources=['book%d' % i]) for i in range(3)])
+        inquiry = Inquiry(subject='Max', action='get', resource='book') if isinstance(checker, StringFuzzyChecker) \
+            else Inquiry(subject='Max', action='get', resource='book1')
+        found = list(st.find_for_inquiry(inquiry, checker))
+        assert found
+        again = list(st.find_for_inquiry(inquiry, checker))
+        assert all(any(p is x for x in found) for p in again)
+        st.update(Policy('1', subjects=['Max'], actions=['get'], resources=['book1'], description='new'))
+        again = {p.uid: p for p in st.find_for_inquiry(inquiry, checker)}
+        assert 'new' == again['1'].description
+        assert again['1'] not in found
+        assert 'etag' not in vars(again['1'])
+        # cache is turned off
+        st.cache.maxsize = 0
+        found = list(st.find_for_inquiry(inquiry, checker))
+        assert not set(map(id, found)).intersection(map(id, st.find_for_inquiry(inquiry, checker)))
+
+    @pytest.mark.parametrize('checker', [
+        None, RegexChecker(), StringExactChecker(), StringFuzzyChecker(), RulesChecker(),
+    ])
+    def test_find_for_inquiries(self, st, checker):
+        st.add_many([
+            Policy('1', subjects=['Max', 'Jim'], actions=['get', 'list'], resources=['book<[0-9]>']),
+            Policy('2', subjects=['<[MJ].*>'], actions=['get'], resources=['book1', 'book2']),
+            Policy('3', subjects=['Nina'], actions=['list'], resources=['book<.*>']),
+            Policy('4', subjects=[Eq('Max'), Eq('Nina')], actions=[Eq('get')], resources=[Eq('book1')]),
+            Policy('5', subjects=['Max', 'Nina'], actions=['get'], resources=['book1']),
+        ])
+        inquiries = [
+            Inquiry(subject=s, action=a, resource=r)
+            for s in ('Max', 'Nina', 'Sam') for a in ('get', 'list') for r in ('book1', 'book')
+        ]
+        expected = [(i, p.uid) for i, inq in enumerate(inquiries) for p in st.find_for_inquiry(inq, checker)]
+        assert expected
+        assert sorted(expected) == sorted((i, p.uid) for i, p in st.find_for_inquiries(iter(inquiries), checker))
+        assert [] == list(st.find_for_inquiries([], checker))
+        # server that doesn't support $facet
+        st.db_server_version = (3, 2, 0)
+        assert sorted(expected) == sorted((i, p.uid) for i, p in st.find_for_inquiries(inquiries, checker))
+
+    @pytest.mark.parametrize('checker', [StringExactChecker(), StringFuzzyChecker(), RegexChecker()])
+    def test_find_fitting_for_inquiry_makes_the_same_decisions(self, st, checker):
+        st.add_many([
+            Policy('1', effect=ALLOW_ACCESS, subjects=['Max', '<Jim>'], actions=['get', '<list|put>'],
+                   resources=['book<[0-9]>', 'book']),
+            Policy('2', effect=ALLOW_ACCESS, subjects=['<[MN].*>'], actions=['get'], resources=['book1', 'books'],
+                   context={'ip': Eq('127.0.0.1')}),
+            Policy('3', subjects=['Nina'], actions=['list'], resources=['book<.*>']),
+            Policy('4', effect=ALLOW_ACCESS, subjects=['Nina', 'Sam'], actions=['<>', 'put'], resources=['<>']),
+            Policy('5', subjects=[Eq('Max')], actions=[Eq('get')], resources=[Eq('book1')]),
+            # elements with only one tag don't fit, and neither do the elements after them
+            Policy('6', effect=ALLOW_ACCESS, subjects=['Jim', 'Ma'], actions=['get<', 'put>', 'list'],
+                   resources=['book<.*>']),
+        ])
+        inquiries = [
+            Inquiry(subject=s, action=a, resource=r, context=c)
+            for s in ('Max', 'Jim', 'Nina', 'Sam', '<Jim>', 'Ma') for a in ('get', 'list', 'put', '', 'get<', 'put>')
+            for r in ('book1', 'book', 'books', '') for c in ({}, {'ip': '127.0.0.1'})
+        ]
+        expected = [Guard(st, checker).is_allowed(i) for i in inquiries]
+        assert any(expected)
+        assert None is st.find_fitting_for_inquiry(inquiries[0], checker)
+        st.server_side_decisions = True
+        assert expected == [Guard(st, checker).is_allowed(i) for i in inquiries]
+
+    def test_find_fitting_for_inquiry_returns_deciding_policies(self, st):
+        st.server_side_decisions = True
+        st.add_many([
+            Policy('1', effect=ALLOW_ACCESS, subjects=['Max'], actions=['get'], resources=['<book.*>']),
+            Policy('2', effect=ALLOW_ACCESS, subjects=['Max'], actions=['get'], resources=['book1'],
+                   context={'ip': Eq('127.0.0.1')}),
+            Policy('3', subjects=['<M.*>'], actions=['get'], resources=['book1']),
+            Policy('4', subjects=['Max'], actions=['<.*>'], resources=['book1']),
+        ])
+        fitting, candidates = st.find_fitting_for_inquiry(Inquiry(subject='Max', action='get', resource='book2'),
+                                                          RegexChecker())
+        assert (['1'], []) == ([p.uid for p in fitting], candidates)
+        fitting, candidates = st.find_fitting_for_inquiry(Inquiry(subject='Max', action='get', resource='book1'),
+                                                          RegexChecker())
+        assert 1 == len(fitting) and fitting[0].uid in ('3', '4')
+        assert [] == candidates
+        st.delete('3')
+        st.delete('4')
+        fitting, candidates = st.find_fitting_for_inquiry(Inquiry(subject='Max', action='get', resource='book1'),
+                                                          RegexChecker())
+        assert (['1'], ['2']) == ([p.uid for p in fitting], [p.uid for p in candidates])
+        # decoded policies are taken from the cache
+        again, _ = st.find_fitting_for_inquiry(Inquiry(subject='Max', action='get', resource='book1'), RegexChecker())
+        assert again[0] is fitting[0]
+        # not supported checkers, inquiries and servers
+        assert None is st.find_fitting_for_inquiry(Inquiry(subject='Max'), RulesChecker())
+        assert None is st.find_fitting_for_inquiry(Inquiry(subject={'name': 'Max'}), RegexChecker())
+        st.db_server_version = (4, 0, 0)
+        assert None is st.find_fitting_for_inquiry(Inquiry(subject='Max'), RegexChecker())
+        assert None is not st.find_fitting_for_inquiry(Inquiry(subject='Max'), StringExactChecker())
+
     def test_find_for_inquiry_with_unknown_checker(self, st):
         st.add(Policy('1'))
         inquiry = Inquiry(subject='sam', action='get', resource='books')
@@ -404,6 +575,55 @@ class TestMongoStorage:
         st.delete(uid)
         assert None is st.get(uid)
 
+    def test_add_many(self, st):
+        st.add_many([
+            Policy('1', subjects=['max'], actions=['get', 'put'], resources=['<books|comics>']),
+            Policy(2, subjects=[Eq('max')], context={'secret': Equal('foo')}),
+        ])
+        assert ['get', 'put'] == st.get('1').actions
+        assert isinstance(st.get(2).context['secret'], Equal)
+        inquiry = Inquiry(subject='max', action='put', resource='books')
+        assert ['1'] == [p.uid for p in st.find_for_inquiry(inquiry, StringFuzzyChecker())]
+        st.add_many([])
+        assert 2 == len(list(st.get_all(100, 0)))
+
+    def test_add_many_existing(self, st):
+        st.add(Policy('1', description='foo'))
+        with pytest.raises(PolicyExistsError) as e:
+            st.add_many([Policy('2'), Policy('1', description='bar')])
+        assert 'Conflicting UID = 1' == str(e.value)
+        assert 'foo' == st.get('1').description
+
+    def test_update_many(self, st):
+        st.add_many([Policy('1', actions=['get']), Policy('2', actions=['get']), Policy('3', actions=['get'])])
+        st.update_many([
+            Policy('1', actions=['put'], description='foo'),
+            Policy('3', actions=['post', 'put'], description='bar'),
+            Policy('4', actions=['put']),
+        ])
+        assert ['put'] == st.get('1').actions
+        assert ['get'] == st.get('2').actions
+        assert ['post', 'put'] == st.get('3').actions
+        assert st.get('4') is None
+        st.update_many([])
+
+    def test_delete_many(self, st):
+        st.add_many([Policy(str(i)) for i in range(5)])
+        st.delete_many(['1', '3', 'non-existent-id'])
+        assert ['0', '2', '4'] == [p.uid for p in st.get_all(100, 0)]
+        st.delete_many([])
+        assert 3 == len(list(st.get_all(100, 0)))
+
+    @pytest.mark.parametrize('batch', [1, 3, 7, 20, 21, 100])
+    def test_retrieve_all(self, st, batch):
+        st.add_many([Policy(str(i)) for i in range(21)])
+        assert sorted(map(str, range(21))) == [p.uid for p in st.retrieve_all(batch)]
+        assert [] == list(st.retrieve_all(0))
+
+    def test_retrieve_all_with_mixed_uid_types(self, st):
+        st.add_many([Policy(2), Policy('1'), Policy(1), Policy('b')])
+        assert [1, 2, '1', 'b'] == [p.uid for p in st.retrieve_all(batch=1)]
+
     def test_returned_condition(self, st):
         uid = str(uuid.uuid4())
         p = Policy(
@@ -418,3 +638,68 @@ class TestMongoStorage:
         context = st.get(uid).context
         assert context['secret'].satisfied('i-am-a-teacher')
         assert context['secret2'].satisfied('i-am-a-husband')
+
+
+@pytest.mark.parametrize('element, value, may_fit', [
+    ('Max', 'Max', True),
+    ('Max', 'Maxim', False),
+    ('<M.*>', 'Maxim', True),
+    ('<M.*>', 'Jim', False),
+    ('Max<[a-z]+>', 'Maxim', True),
+    ('Max<[a-z]+>', 'Max', False),
+    ('<Max', 'Max', True),
+    ('Max>', 'Jim', True),
+])
+def test_element_may_fit(element, value, may_fit):
+    pattern = compile_regex(element, '<', '>').pattern if '<' in element and '>' in element else element
+    assert may_fit == _element_may_fit(element, pattern, value)
+    if not may_fit:
+        assert not RegexChecker().fits(Policy('1', subjects=[element]), 'subjects', value)
+
+
+def test_find_for_inquiries_splits_facet_into_chunks(monkeypatch):
+    monkeypatch.setattr('vakt.storage.mongo.MAX_INQUIRIES_IN_FACET', 2)
+    st = MongoStorage(MagicMock(), DB_NAME, collection=COLLECTION)
+    st.db_server_version = (4, 2, 0)
+    # every inquiry of a chunk finds the policy whose uid is the subject of the inquiry
+    def subject(p):
+        return [c for c in p[0]['$match']['$and'] if 'subjects' in c][0]['subjects']['$elemMatch']['$eq']
+    st.collection.aggregate.side_effect = lambda pipeline: iter([{
+        name: [{'_id': subject(p), 'etag': 'x'}] for name, p in pipeline[1]['$facet'].items()
+    }])
+    st.collection.find.side_effect = lambda q_filter, **kwargs: iter([
+        {'_id': uid, 'etag': 'x', 'uid': uid, 'type': TYPE_STRING_BASED} for uid in q_filter['_id']['$in']
+    ])
+    inquiries = [Inquiry(subject=s, action='get', resource='book') for s in ('a', 'b', 'c', 'd', 'e')]
+    found = list(st.find_for_inquiries(inquiries, StringExactChecker()))
+    assert [(0, 'a'), (1, 'b'), (2, 'c'), (3, 'd'), (4, 'e')] == [(i, p.uid) for i, p in found]
+    assert 3 == st.collection.aggregate.call_count
+    assert [2, 2, 1] == [len(c[0][0][1]['$facet']) for c in st.collection.aggregate.call_args_list]
+
+
+def test_rules_checker_query_matches_candidates_by_indexed_tokens():
+    st = MongoStorage(MagicMock(), DB_NAME, collection=COLLECTION)
+    st.db_server_version = (4, 2, 0)
+    policies = [
+        Policy('1', subjects=[{'name': Eq('Max'), 'role': In('admin', 'owner')}], actions=[Eq('get')]),
+        Policy('2', subjects=[{'name': Eq('Max')}, {'name': Eq('Jim')}], actions=[{'method': StartsWith('ge')}]),
+        Policy('3', subjects=[{'name': Eq('Jim'), 'role': Any()}], actions=[Eq('get')]),
+        Policy('4', subjects=[{'name': Equal('jim', ci=True)}], actions=[Any()]),
+        Policy('5', subjects=[{'name': Eq('Max')}], actions=[Eq('put')]),
+        Policy('6', subjects=[{'name': Eq('Max')}], actions=[Eq('get')], resources=[Eq('books')]),
+    ]
+    docs = [st._prepare_doc(p) for p in policies]
+    assert ['*'] == docs[3]['subjects_rule_tokens']
+    assert ['["eq", null, "get"]'] == docs[0]['actions_rule_tokens']
+    inquiry = Inquiry(subject={'name': 'Jim', 'role': 'admin'}, action='get', resource='books')
+    q_filter, use_aggregation = st._create_filter(inquiry, RulesChecker())
+    assert not use_aggregation
+    # every token field is matched with a plain $in that can use its index
+    token_fields = [field for field in q_filter if field.endswith('_rule_tokens')]
+    assert ['actions_rule_tokens', 'subjects_rule_tokens', 'resources_rule_tokens'] == token_fields
+    assert all(None in q_filter[field]['$in'] for field in token_fields)
+    matched = [doc['_id'] for doc in docs
+               if all(set(doc[field]).intersection(q_filter[field]['$in']) for field in token_fields)]
+    # tokens are a looser prefilter: policies '3' and '4' are the candidates after $expr
+    # (see test_find_for_inquiry_with_rules_checker_excludes_policies_by_constraints)
+    assert ['1', '3', '4'] == matched
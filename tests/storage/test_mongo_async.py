@@ -0,0 +1,145 @@
+import asyncio
+import threading
+from operator import attrgetter
+from unittest.mock import MagicMock
+
+import pytest
+
+from vakt.storage.memory import MemoryStorage
+from vakt.policy import Policy
+from vakt.guard import Inquiry, Guard
+from vakt.effects import ALLOW_ACCESS
+from vakt.checker import RegexChecker
+from vakt.storage.mongo_async import AsyncMongoStorage
+from .test_mongo import DB_NAME, COLLECTION, create_client
+
+
+@pytest.fixture()
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_storage_is_created_without_server_round_trip(loop):
+    client = MagicMock()
+    client.server_info.return_value = {'version': '4.2.1'}
+    st = AsyncMongoStorage(client, 'db', max_concurrency=2)
+    assert not client.server_info.called
+    st.storage.collection.aggregate.return_value = iter([])
+    assert [] == loop.run_until_complete(st.find_for_inquiry(Inquiry(subject='Max'), RegexChecker()))
+    loop.run_until_complete(st.find_for_inquiry(Inquiry(subject='Max'), RegexChecker()))
+    assert 1 == client.server_info.call_count
+    assert (4, 2, 1) == st.storage.db_server_version
+    st.close()
+
+
+def test_find_for_inquiries_runs_queries_concurrently(loop):
+    # all the queries wait for each other, so they succeed only if they are run at once
+    barrier = threading.Barrier(3, timeout=5)
+
+    class WaitingStorage(MemoryStorage):
+        def _finds_inquiries_at_once(self, inquiries, checker):
+            return False
+
+        def find_for_inquiry(self, inquiry, checker=None):
+            barrier.wait()
+            return super().find_for_inquiry(inquiry, checker)
+
+    st = AsyncMongoStorage(MagicMock(), 'db', max_concurrency=3)
+    st.storage = WaitingStorage()
+    p1, p2 = Policy('1', subjects=['Max']), Policy('2', subjects=['Nina'])
+    loop.run_until_complete(st.add_many([p1, p2]))
+    inquiries = [Inquiry(subject='Max'), Inquiry(subject='Nina'), Inquiry(subject='Jim')]
+    found = loop.run_until_complete(st.find_for_inquiries(inquiries))
+    assert [(0, '1'), (0, '2'), (1, '1'), (1, '2'), (2, '1'), (2, '2')] == sorted((i, p.uid) for i, p in found)
+    assert [] == loop.run_until_complete(st.find_for_inquiries([]))
+    st.close()
+
+
+def test_find_for_inquiries_runs_chunks_concurrently(loop, monkeypatch):
+    monkeypatch.setattr('vakt.storage.mongo_async.MAX_INQUIRIES_IN_FACET', 2)
+    # all the chunks wait for each other, so they succeed only if they are run at once
+    barrier = threading.Barrier(3, timeout=5)
+    chunks = []
+
+    class WaitingStorage(MemoryStorage):
+        def _finds_inquiries_at_once(self, inquiries, checker):
+            return True
+
+        def find_for_inquiry(self, inquiry, checker=None):
+            raise AssertionError('inquiries must be found in chunks')
+
+        def find_for_inquiries(self, inquiries, checker=None):
+            chunks.append([i.subject for i in inquiries])
+            barrier.wait()
+            policies = list(self.retrieve_all())
+            return ((i, p) for i, inquiry in enumerate(inquiries) for p in policies if inquiry.subject in p.subjects)
+
+    st = AsyncMongoStorage(MagicMock(), 'db', max_concurrency=3)
+    st.storage = WaitingStorage()
+    loop.run_until_complete(st.add_many([Policy('1', subjects=['Max']), Policy('2', subjects=['Nina'])]))
+    inquiries = [Inquiry(subject=s) for s in ['Max', 'Nina', 'Jim', 'Nina', 'Max']]
+    found = loop.run_until_complete(st.find_for_inquiries(inquiries))
+    assert [(0, '1'), (1, '2'), (3, '2'), (4, '1')] == sorted((i, p.uid) for i, p in found)
+    assert [['Jim', 'Nina'], ['Max'], ['Max', 'Nina']] == sorted(chunks)
+    st.close()
+
+
+def test_read_methods_and_guard(loop):
+    st = AsyncMongoStorage(MagicMock(), 'db', server_side_decisions=True)
+    assert st.storage.server_side_decisions
+    st.storage = MemoryStorage()
+    run = loop.run_until_complete
+    run(st.add_many([Policy(str(i), effect=ALLOW_ACCESS, subjects=['Max'], actions=['<.*>'], resources=['<.*>'])
+                     for i in range(5)]))
+    assert ['0', '1', '2', '3', '4'] == sorted(p.uid for p in run(st.retrieve_all(batch=2)))
+    assert None is run(st.find_fitting_for_inquiry(Inquiry(subject='Max'), RegexChecker()))
+    guard = Guard(st.storage, RegexChecker())
+    assert run(st.run(guard.is_allowed, Inquiry(subject='Max', action='get', resource='book')))
+    assert not run(st.run(guard.is_allowed, Inquiry(subject='Jim', action='get', resource='book')))
+    st.close()
+
+
+@pytest.mark.integration
+class TestAsyncMongoStorage:
+
+    @pytest.fixture()
+    def st(self):
+        client = create_client()
+        st = AsyncMongoStorage(client, DB_NAME, collection=COLLECTION, max_concurrency=4)
+        yield st
+        st.close()
+        client[DB_NAME][COLLECTION].delete_many({})
+        client.close()
+
+    def test_crud(self, st, loop):
+        run = loop.run_until_complete
+        run(st.add(Policy('1', subjects=['Max'], actions=['get'], resources=['<book.*>'])))
+        run(st.add_many([Policy(str(i), subjects=['Jim']) for i in range(2, 5)]))
+        assert ['Max'] == run(st.get('1')).subjects
+        assert None is run(st.get('0'))
+        assert ['1', '2', '3', '4'] == sorted(map(attrgetter('uid'), run(st.get_all(10, 0))))
+        run(st.update(Policy('1', subjects=['Nina'], actions=['get'], resources=['<book.*>'])))
+        run(st.update_many([Policy('2', subjects=['Sam'])]))
+        assert ['Nina'] == run(st.get('1')).subjects
+        assert ['Sam'] == run(st.get('2')).subjects
+        run(st.delete('1'))
+        run(st.delete_many(['2', '3']))
+        assert ['4'] == [p.uid for p in run(st.get_all(10, 0))]
+
+    def test_find_for_inquiry(self, st, loop):
+        run = loop.run_until_complete
+        run(st.add_many([
+            Policy('1', subjects=['Max'], actions=['get'], resources=['<book.*>']),
+            Policy('2', subjects=['Nina'], actions=['get'], resources=['books']),
+        ]))
+        inquiries = [Inquiry(subject=s, action='get', resource='books') for s in ('Max', 'Nina', 'Jim')]
+        assert ['1'] == [p.uid for p in run(st.find_for_inquiry(inquiries[0], RegexChecker()))]
+        expected = [(i, p.uid) for i, inq in enumerate(inquiries)
+                    for p in st.storage.find_for_inquiry(inq, RegexChecker())]
+        assert expected == [(i, p.uid) for i, p in run(st.find_for_inquiries(inquiries, RegexChecker()))]
+        assert None is run(st.find_fitting_for_inquiry(inquiries[0], RegexChecker()))
+        st.storage.server_side_decisions = True
+        fitting, candidates = run(st.find_fitting_for_inquiry(inquiries[0], RegexChecker()))
+        assert (['1'], []) == ([p.uid for p in fitting], candidates)
@@ -1,11 +1,15 @@
 import json
 import re
+import logging
 import unittest
+from unittest.mock import MagicMock
 
 import pytest
 
 from vakt.storage.mongo import *
 from vakt.rules.base import Rule
+from vakt.storage.memory import MemoryStorage
+from vakt.rules.operator import Eq
 from vakt.guard import Inquiry, Guard
 from vakt import version_info
 from .test_mongo import DB_NAME, COLLECTION, MIGRATION_COLLECTION, create_client
@@ -30,12 +34,22 @@ class TestMongoMigrationSet:
         migration_set.save_applied_number(2)
         assert 2 == migration_set.last_applied()
 
+    def test_migrations_are_configured_by_set(self):
+        client = create_client()
+        storage = MongoStorage(client, DB_NAME, collection=COLLECTION)
+        report = print
+        migration_set = MongoMigrationSet(storage, MIGRATION_COLLECTION, batch_size=10, workers=4, report=report)
+        for m in migration_set.migrations():
+            assert (10, 4, report) == (m.batch_size, m.workers, m.report)
+            assert MIGRATION_COLLECTION == m.checkpoints.name
+        client.close()
+
     def test_up_and_down(self, migration_set):
         migration_set.save_applied_number(0)
         migration_set.up()
-        assert 4 == migration_set.last_applied()
+        assert 5 == migration_set.last_applied()
         migration_set.up()
-        assert 4 == migration_set.last_applied()
+        assert 5 == migration_set.last_applied()
         migration_set.down()
         assert 0 == migration_set.last_applied()
         migration_set.down()
@@ -579,12 +593,13 @@ class TestMigration1x2x0To1x4x0:
                 "subjects" : [ ], "type": 1, "uid" : 10 }
                 """,
                 """
-                { "_id" : 10, "actions" : [ ], "actions_compiled_regex" : [ ],
+                { "_id" : 10, "actions" : [ ], "actions_compiled_regex" : [ ], "actions_literal_prefix" : [ ],
                 "context" : { "name" : {"py/object": "vakt.rules.string.Equal", "val": "Max" },
                 "secret" : {"py/object": "vakt.rules.string.Equal", "val": "i-am-a-foo"} }, 
                 "description" : null, "effect" : "allow", "resources" : [ ],
-                "resources_compiled_regex" : [ ],
-                "subjects" : [ ], "subjects_compiled_regex" : [ ], "type": 1, "uid" : 10 }
+                "resources_compiled_regex" : [ ], "resources_literal_prefix" : [ ],
+                "subjects" : [ ], "subjects_compiled_regex" : [ ], "subjects_literal_prefix" : [ ],
+                "type": 1, "uid" : 10 }
                 """
             ),
             (
@@ -597,11 +612,12 @@ class TestMigration1x2x0To1x4x0:
                 """,
                 """
                 { "_id" : 20,
-                "actions" : [ "<.*>" ], "actions_compiled_regex" : [ "^(.*)$" ],
+                "actions" : [ "<.*>" ], "actions_compiled_regex" : [ "^(.*)$" ], "actions_literal_prefix" : [ "" ],
                 "context" : { "secret" : { "py/object": "vakt.rules.string.Equal", "val": "John"} },
                 "description" : "foo bar", "effect" : "allow",
                 "resources" : [ "<.*>" ], "resources_compiled_regex" : [ "^(.*)$" ],
-                "subjects" : [ "<.*>" ], "subjects_compiled_regex" : [ "^(.*)$" ],
+                "resources_literal_prefix" : [ "" ],
+                "subjects" : [ "<.*>" ], "subjects_compiled_regex" : [ "^(.*)$" ], "subjects_literal_prefix" : [ "" ],
                 "type": 1, "uid" : 20 }
                 """
             ),
@@ -614,10 +630,12 @@ class TestMigration1x2x0To1x4x0:
                 """,
                 """
                 { "_id" : 30, "actions" : [ "get", "list" ], "actions_compiled_regex" : [ "get", "list" ],
+                "actions_literal_prefix" : [ "get", "list" ],
                 "context" : {  }, "description" : "foo bar",
                 "effect" : "allow",
                 "resources" : [ "fax", "<[pP]rinter>" ], "resources_compiled_regex" : [ "fax", "^([pP]rinter)$" ],
-                "subjects" : [ "<.*>" ], "subjects_compiled_regex" : [ "^(.*)$" ],
+                "resources_literal_prefix" : [ "fax", "" ],
+                "subjects" : [ "<.*>" ], "subjects_compiled_regex" : [ "^(.*)$" ], "subjects_literal_prefix" : [ "" ],
                 "type": 1, "uid" : 30 }
                 """
             ),
@@ -629,9 +647,12 @@ class TestMigration1x2x0To1x4x0:
                 "type": 2, "uid" : 40 }
                 """,
                 """
-                { "_id" : 40, "actions" : [ ], "context" : { },
-                "description" : null, "effect" : "allow", "resources" : [ ],
+                { "_id" : 40, "actions" : [ ], "actions_rule_constraints" : [ [ ] ], "actions_rule_tokens" : [ "*" ],
+                "context" : { }, "description" : null, "effect" : "allow", "resources" : [ ],
+                "resources_rule_constraints" : [ [ ] ], "resources_rule_tokens" : [ "*" ],
                 "subjects" : [ { "name" : {"py/object": "vakt.rules.string.StartsWith", "val": "Max" } } ],
+                "subjects_rule_constraints" : [ [ [ "[\\"prefix\\", \\"name\\", \\"Max\\"]" ] ] ],
+                "subjects_rule_tokens" : [ "[\\"prefix\\", \\"name\\", \\"Max\\"]" ],
                 "type": 2, "uid" : 40 }
                 """
             ),
@@ -658,6 +679,8 @@ class TestMigration1x2x0To1x4x0:
         # test string contents of each doc
         for (doc, result_doc) in docs:
             new_doc = storage.collection.find_one({'uid': json.loads(doc)['uid']})
+            # etag is a hash of the whole policy, so it's checked separately
+            assert 40 == len(new_doc.pop('etag'))
             expected = result_doc.replace("\n", '').replace(' ', '')
             actual = json.dumps(new_doc, sort_keys=True).replace("\n", '').replace(' ', '')
             assert expected == actual
@@ -665,6 +688,42 @@ class TestMigration1x2x0To1x4x0:
         inq = Inquiry(action='get', resource='printer', subject='Max')
         assert 2 == len(list(storage.find_for_inquiry(inq, RegexChecker())))
 
+    def test_up_online(self, storage):
+        migration_set = MongoMigrationSet(storage, MIGRATION_COLLECTION, batch_size=2)
+        policies = [
+            Policy(1, effect=ALLOW_ACCESS, actions=['get'], resources=['<[pP]rinter>'], subjects=['Max<.*>']),
+            Policy(2, actions=['<.*>'], resources=['fax'], subjects=['<.*>']),
+            Policy(3, effect=ALLOW_ACCESS, subjects=[{'name': Eq('Max')}]),
+            Policy(4, effect=ALLOW_ACCESS, actions=['print'], resources=['printer'], subjects=['Maxim']),
+        ]
+        storage.add_many(policies[:3])
+        # documents as they were saved by 1.2.0
+        storage.collection.update_many({}, {'$unset': dict.fromkeys(
+            [storage.condition_field_compiled_name(f) for f in storage.condition_fields] +
+            [storage.condition_field_prefix_name(f) for f in storage.condition_fields] +
+            [storage.condition_field_constraints_name(f) for f in storage.condition_fields] + ['etag'], '')})
+        migration_set.save_applied_number(3)
+        inquiries = [
+            Inquiry(action=a, resource=r, subject='Maxim') for a in ('get', 'print') for r in ('printer', 'fax')
+        ]
+        try:
+            storage.online_migrations = migration_set.pending()
+            # collection has documents of both shapes, the ones that aren't converted yet are candidates
+            storage.add(policies[3])
+            assert [1, 2] == sorted(p.uid for p in storage.find_for_inquiry(inquiries[0], RegexChecker()))
+            reference = MemoryStorage()
+            reference.add_many(policies)
+            expected = [Guard(reference, RegexChecker()).is_allowed(i) for i in inquiries]
+            assert any(expected)
+            assert expected == [Guard(storage, RegexChecker()).is_allowed(i) for i in inquiries]
+            thread = migration_set.up_online()
+            thread.join()
+            assert [] == storage.online_migrations
+            assert 5 == migration_set.last_applied()
+            assert expected == [Guard(storage, RegexChecker()).is_allowed(i) for i in inquiries]
+        finally:
+            storage.database[MIGRATION_COLLECTION].delete_many({})
+
     def test_down(self, storage):
         assertions = unittest.TestCase('__init__')
         migration = Migration1x2x0To1x4x0(storage)
@@ -753,3 +812,162 @@ class TestMigration1x2x0To1x4x0:
         for (doc, expected_doc) in docs:
             new_doc = storage.collection.find_one({'uid': json.loads(doc)['uid']})
             assertions.assertDictEqual(json.loads(expected_doc), new_doc)
+
+
+def test_resave_policies_reports_malformed_docs(caplog):
+    storage = MongoStorage(MagicMock(), DB_NAME, collection=COLLECTION)
+    good = storage._prepare_doc(Policy(1, subjects=['Max<.*>']))
+    del good['etag']
+    storage.collection.find.return_value = iter([good, {'_id': 'bad', 'type': 1}])
+    migration = Migration1x4x0To1x6x0(storage)
+    migration.checkpoints = MagicMock(**{'find_one.return_value': None})
+    with caplog.at_level(logging.INFO, logger='vakt.storage.mongo'):
+        migration.up()
+    requests = storage.collection.bulk_write.call_args[0][0]
+    assert [1] == [r._filter['_id'] for r in requests]
+    assert 40 == len(requests[0]._doc['etag'])
+    assert "Mongo IDs of failed Policies are: ['bad']" in caplog.records[-1].getMessage()
+    assert migration.checkpoints.delete_one.called
+
+
+def test_online_migrations_add_queries_for_pending_docs():
+    storage = MongoStorage(MagicMock(), DB_NAME, collection=COLLECTION, cache_size=0)
+    storage.db_server_version = (4, 2, 0)
+    storage.collection.aggregate.side_effect = lambda pipeline: iter([{'0': []}] if '$facet' in pipeline[-1] else [])
+    storage.collection.find.side_effect = lambda *args, **kwargs: iter([])
+    inquiry = Inquiry(action='get', resource='printer', subject='Max')
+    storage.online_migrations = [Migration1x4x0To1x6x0(storage)]
+    assert [] == list(storage.find_for_inquiry(inquiry, RegexChecker()))
+    assert [] == list(storage.find_for_inquiries([inquiry], RegexChecker()))
+    assert not storage.collection.find.called
+    assert 2 == storage.collection.aggregate.call_count
+    storage.online_migrations.append(Migration1x2x0To1x4x0(storage))
+    assert [] == list(storage.find_for_inquiry(inquiry, RegexChecker()))
+    storage.collection.find.assert_called_once_with(
+        storage.online_migrations[1].pending_filter, projection=storage.read_projection)
+
+
+@pytest.mark.integration
+class TestMigration1x4x0To1x6x0:
+    @pytest.fixture()
+    def storage(self):
+        client = create_client()
+        storage = MongoStorage(client, DB_NAME, collection=COLLECTION)
+        yield storage
+        client[DB_NAME][COLLECTION].delete_many({})
+        client[DB_NAME][COLLECTION].drop_indexes()
+        client.close()
+
+    def test_order(self, storage):
+        migration = Migration1x4x0To1x6x0(storage)
+        assert 5 == migration.order
+
+    def test_up(self, storage):
+        migration = Migration1x4x0To1x6x0(storage, batch_size=2)
+        storage.add_many([
+            Policy(1, actions=['get', 'list'], resources=['fax', '<[pP]rinter>'], subjects=['Max<.*>']),
+            Policy(2, actions=['<.*>'], resources=['<.*>'], subjects=['<.*>']),
+            Policy(3, subjects=[{'name': Eq('Max')}]),
+        ])
+        storage.collection.update_many({}, {'$unset': {
+            'actions_literal_prefix': '', 'resources_literal_prefix': '', 'subjects_literal_prefix': '',
+            'actions_rule_constraints': '', 'resources_rule_constraints': '', 'subjects_rule_constraints': '',
+            'actions_rule_tokens': '', 'resources_rule_tokens': '', 'subjects_rule_tokens': '',
+            'etag': '',
+        }})
+        migration.up()
+        created_indices = [i['name'] for i in storage.collection.list_indexes()]
+        assert created_indices == [
+            '_id_',
+            'actions_literal_prefix_idx',
+            'subjects_literal_prefix_idx',
+            'resources_literal_prefix_idx',
+            'actions_rule_tokens_idx',
+            'subjects_rule_tokens_idx',
+            'resources_rule_tokens_idx'
+        ]
+        doc = storage.collection.find_one({'_id': 1})
+        assert ['get', 'list'] == doc['actions_literal_prefix']
+        assert ['fax', ''] == doc['resources_literal_prefix']
+        assert ['Max'] == doc['subjects_literal_prefix']
+        assert 'subjects_literal_prefix' not in storage.collection.find_one({'_id': 3})
+        assert [[['["eq", "name", "Max"]']]] == storage.collection.find_one({'_id': 3})['subjects_rule_constraints']
+        assert ['["eq", "name", "Max"]'] == storage.collection.find_one({'_id': 3})['subjects_rule_tokens']
+        assert ['*'] == storage.collection.find_one({'_id': 3})['actions_rule_tokens']
+        assert 40 == len(storage.collection.find_one({'_id': 3})['etag'])
+        inq = Inquiry(action='get', resource='printer', subject='Maxim')
+        assert [1, 2] == sorted(p.uid for p in storage.find_for_inquiry(inq, RegexChecker()))
+
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_up_in_parallel_batches_resumes_after_checkpoint(self, storage, workers):
+        checkpoints = storage.database[MIGRATION_COLLECTION]
+        migration = Migration1x4x0To1x6x0(storage, batch_size=2)
+        migration.workers = workers
+        migration.checkpoints = checkpoints
+        storage.add_many([Policy(i, subjects=['Max<.*>']) for i in range(7)] + [Policy('a', subjects=['Max<.*>'])])
+        storage.collection.update_many({}, {'$unset': {'subjects_literal_prefix': '', 'etag': ''}})
+        # previous run was interrupted after the policy with uid 2
+        checkpoints.insert_one({'_id': 'migration_checkpoint_5_up', 'last': 2})
+        reports = []
+        migration.report = lambda p: reports.append(p.processed)
+        try:
+            migration.up()
+        finally:
+            checkpoints.delete_many({})
+        migrated = [doc['_id'] for doc in storage.collection.find({'subjects_literal_prefix': ['Max']})]
+        assert [3, 4, 5, 6, 'a'] == sorted(migrated, key=str)
+        assert [2, 4, 5] == reports
+        assert None is checkpoints.find_one({'_id': 'migration_checkpoint_5_up'})
+
+    def test_up_online(self, storage):
+        migration_set = MongoMigrationSet(storage, MIGRATION_COLLECTION, batch_size=2)
+        policies = [
+            Policy(1, effect=ALLOW_ACCESS, actions=['get'], resources=['<[pP]rinter>'], subjects=['Max<.*>']),
+            Policy(2, actions=['<.*>'], resources=['fax'], subjects=['<.*>']),
+            Policy(3, effect=ALLOW_ACCESS, subjects=[{'name': Eq('Max')}]),
+            Policy(4, effect=ALLOW_ACCESS, actions=['print'], resources=['printer'], subjects=['Maxim']),
+        ]
+        storage.add_many(policies[:3])
+        storage.collection.update_many({}, {'$unset': {
+            'actions_literal_prefix': '', 'resources_literal_prefix': '', 'subjects_literal_prefix': '',
+            'subjects_rule_constraints': '', 'etag': '',
+        }})
+        migration_set.save_applied_number(4)
+        inquiries = [
+            Inquiry(action=a, resource=r, subject='Maxim') for a in ('get', 'print') for r in ('printer', 'fax')
+        ]
+        try:
+            # documents without literal prefixes are still found by regexes
+            assert [1] == [p.uid for p in storage.find_for_inquiry(inquiries[0], RegexChecker())]
+            storage.online_migrations = migration_set.pending()
+            # until they are converted, they are found by the usual queries
+            assert [1] == [p.uid for p in storage.find_for_inquiry(inquiries[0], RegexChecker())]
+            # new policies are written in the new shape
+            storage.add(policies[3])
+            assert 40 == len(storage.collection.find_one({'_id': 4})['etag'])
+            reference = MemoryStorage()
+            reference.add_many(policies)
+            expected = [Guard(reference, RegexChecker()).is_allowed(i) for i in inquiries]
+            assert expected == [Guard(storage, RegexChecker()).is_allowed(i) for i in inquiries]
+            thread = migration_set.up_online()
+            thread.join()
+            assert [] == storage.online_migrations
+            assert 5 == migration_set.last_applied()
+            assert 0 == storage.collection.count_documents({'etag': {'$exists': False}})
+            assert expected == [Guard(storage, RegexChecker()).is_allowed(i) for i in inquiries]
+        finally:
+            storage.database[MIGRATION_COLLECTION].delete_many({})
+
+    def test_down(self, storage):
+        migration = Migration1x4x0To1x6x0(storage)
+        migration.up()
+        storage.add(Policy(1, actions=['get'], resources=['<[pP]rinter>'], subjects=['Max<.*>']))
+        storage.add(Policy(2, subjects=[{'name': Eq('Max')}]))
+        migration.down()
+        assert ['_id_'] == [i['name'] for i in storage.collection.list_indexes()]
+        doc = storage.collection.find_one({'_id': 1})
+        assert not [x for x in doc if x.endswith('_literal_prefix')]
+        assert 1 == storage.get(1).uid
+        assert not [x for x in storage.collection.find_one({'_id': 2}) if x.endswith('_rule_constraints')]
+        assert not [x for x in storage.collection.find_one({'_id': 2}) if x.endswith('_rule_tokens')]
+        assert 'etag' not in storage.collection.find_one({'_id': 2})
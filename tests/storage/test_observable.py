@@ -31,6 +31,18 @@ class TestObservableMutationStorage:
         st.add(p3)
         assert 3 == observer.count
 
+    def test_batch_methods_notify_once(self, factory):
+        st, mem, observer = factory()
+        st.add_many([Policy(1), Policy(2), Policy(3)])
+        assert 1 == observer.count
+        assert 3 == len(list(mem.retrieve_all()))
+        st.update_many([Policy(1, description='foo'), Policy(2, description='bar')])
+        assert 2 == observer.count
+        assert 'foo' == mem.get(1).description
+        st.delete_many([1, 2])
+        assert 3 == observer.count
+        assert [3] == [p.uid for p in mem.retrieve_all()]
+
     def test_get(self, factory):
         st, mem, observer = factory()
         p1 = Policy('a')
@@ -68,6 +80,26 @@ class TestObservableMutationStorage:
         assert [] == list(st.retrieve_all())
         assert 3 == observer.count
 
+    def test_observers_receive_changes(self, factory):
+        st, mem, observer = factory()
+        p1, p2, p3 = Policy(1), Policy(2), Policy(3)
+        st.add(p1)
+        assert [(None, p1)] == observer.changes
+        st.add_many(p for p in [p2, p3])
+        assert [(None, p2), (None, p3)] == observer.changes
+        p1_new = Policy(1, description='foo')
+        st.update(p1_new)
+        assert [(p1, p1_new)] == observer.changes
+        p2_new, p3_new = Policy(2, description='bar'), Policy(3, description='baz')
+        st.update_many([p2_new, p3_new])
+        assert observer.changes is None
+        st.delete(1)
+        assert [(p1_new, None)] == observer.changes
+        st.delete(4)
+        assert [(None, None)] == observer.changes
+        st.delete_many([2, 3])
+        assert observer.changes is None
+
     def test_retrieve_all(self, factory):
         st, mem, observer = factory()
         p1 = Policy('a')
@@ -108,3 +140,17 @@ class TestObservableMutationStorage:
         st.find_for_inquiry(inq)
         st.find_for_inquiry(inq)
         assert 2 == observer.count
+
+    def test_find_for_inquiries(self, factory):
+        st, mem, observer = factory()
+        inq = Inquiry(action='get', subject='foo', resource='bar')
+        p1 = Policy('a')
+        st.add(p1)
+        assert [(0, p1), (1, p1)] == list(st.find_for_inquiries([inq, inq]))
+        assert 1 == observer.count
+
+    def test_find_fitting_for_inquiry(self, factory):
+        st, mem, observer = factory()
+        st.add(Policy('a'))
+        assert None is st.find_fitting_for_inquiry(Inquiry(subject='foo'))
+        assert 1 == observer.count
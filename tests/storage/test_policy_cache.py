@@ -0,0 +1,58 @@
+from vakt.policy import Policy
+from vakt.storage.policy_cache import PolicyCache, get_etag
+
+
+def test_get_etag():
+    assert get_etag('{"uid": 1}') == get_etag('{"uid": 1}')
+    assert get_etag('{"uid": 1}') != get_etag('{"uid": 2}')
+    assert 40 == len(get_etag('{"uid": "ї"}'))
+
+
+def test_cache_is_bounded_lru():
+    cache = PolicyCache(2)
+    p1, p2, p3 = Policy(1), Policy(2), Policy(3)
+    cache.put(1, 'a', p1)
+    cache.put(2, 'a', p2)
+    assert p1 is cache.get(1, 'a')
+    cache.put(3, 'a', p3)
+    assert cache.get(2, 'a') is None
+    assert p1 is cache.get(1, 'a')
+    assert p3 is cache.get(3, 'a')
+    assert cache.get(1, 'b') is None
+
+
+def test_cache_skips_policies_without_etag_and_zero_size():
+    cache = PolicyCache(2)
+    cache.put(1, None, Policy(1))
+    assert cache.get(1, None) is None
+    cache = PolicyCache(0)
+    cache.put(1, 'a', Policy(1))
+    assert cache.get(1, 'a') is None
+
+
+def test_hydrate_fetches_only_misses():
+    fetched = []
+    policies = {uid: Policy(uid) for uid in range(5)}
+
+    def fetch(uids):
+        fetched.append(uids)
+        # policy 4 was deleted after its row was read
+        return [(uid, 'a', policies[uid]) for uid in uids if uid != 4]
+
+    cache = PolicyCache(10)
+    cache.put(1, 'a', policies[1])
+    cache.put(2, 'old', Policy(2))
+    rows = [(uid, 'a') for uid in range(5)]
+    assert [(row, policies[row[0]]) for row in rows[:4]] == list(cache.hydrate(rows, fetch, batch_size=3))
+    assert [[0, 2], [3, 4]] == fetched
+    del fetched[:]
+    assert [(row, policies[row[0]]) for row in rows[:4]] == list(cache.hydrate(rows, fetch, batch_size=3))
+    assert [[4]] == fetched
+
+
+def test_hydrate_keeps_extra_values_of_rows():
+    policy = Policy(1)
+    cache = PolicyCache(10)
+    rows = [(1, 'a', 'x'), (1, 'a', 'y')]
+    assert [(rows[0], policy), (rows[1], policy)] == \
+        list(cache.hydrate(rows, lambda uids: [(uid, 'a', policy) for uid in uids]))
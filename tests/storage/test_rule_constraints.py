@@ -0,0 +1,91 @@
+import pytest
+
+from vakt.checker import RulesChecker
+from vakt.policy import Policy
+from vakt.rules.operator import Eq, Greater
+from vakt.rules.list import In
+from vakt.rules.string import StartsWith, Equal
+from vakt.rules.logic import Any, Or
+from vakt.storage.rule_constraints import get_policy_constraints, get_value_tokens
+
+
+def may_fit(policy, field, value):
+    """The same decision as storages make with constraints stored for a policy"""
+    tokens = set(get_value_tokens(value, 4))
+    elements = get_policy_constraints(policy, 4)[field]
+    return any(all(tokens.intersection(group) for group in groups) for groups in elements)
+
+
+def test_get_policy_constraints():
+    policy = Policy(1, subjects=[
+        {'name': Eq('Max'), 'stars': Greater(5)},
+        {'role': In('admin', 'owner'), 'team': StartsWith('developers'), 'id': Any()},
+        Eq('Jim'),
+        Or(Eq('Nina'), Eq('Sam')),
+    ], actions=[{'method': StartsWith('get', ci=True)}])
+    assert {
+        'subjects': [
+            [['["eq", "name", "Max"]']],
+            [['["eq", "role", "admin"]', '["eq", "role", "owner"]'], ['["prefix", "team", "deve"]'], ['["any", "id"]']],
+            [['["eq", null, "Jim"]']],
+            [],
+        ],
+        'resources': [[]],
+        'actions': [[]],
+    } == get_policy_constraints(policy, 4)
+
+
+def test_get_policy_constraints_skips_long_tokens():
+    policy = Policy(1, subjects=[{'name': Eq('Max'), 'team': In('developers', 'qa')}])
+    assert [[['["eq", "name", "Max"]']]] == get_policy_constraints(policy, 4, 22)['subjects']
+
+
+def test_get_policy_constraints_for_string_based_policy():
+    assert {} == get_policy_constraints(Policy(1, subjects=['Max']), 4)
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('Max', ['["eq", null, "Max"]', '["prefix", null, ""]', '["prefix", null, "M"]', '["prefix", null, "Ma"]',
+             '["prefix", null, "Max"]']),
+    ({'id': 1, 'ip': 'a'}, ['["any", "id"]', '["any", "ip"]', '["eq", "ip", "a"]', '["prefix", "ip", ""]',
+                            '["prefix", "ip", "a"]']),
+    ({1: 'a'}, []),
+    (['Max'], []),
+    (None, []),
+])
+def test_get_value_tokens(value, expected):
+    assert expected == get_value_tokens(value, 4)
+
+
+@pytest.mark.parametrize('elements, value', [
+    ([{'name': Eq('Max')}], {'name': 'Max', 'stars': 5}),
+    ([{'name': Eq('Max')}, {'name': Eq('Jim')}], {'name': 'Jim'}),
+    ([{'role': In('admin', 'owner')}], {'role': 'owner'}),
+    ([{'team': StartsWith('developers')}], {'team': 'developers-backend'}),
+    ([{'team': StartsWith('dev', ci=True)}], {'team': 'Developers'}),
+    ([{'id': Any()}], {'id': None}),
+    ([{'stars': Eq(5)}], {'stars': 5.0}),
+    ([{'name': Equal('max', ci=True)}], {'name': 'Max'}),
+    ([Eq('Max')], 'Max'),
+    ([Any()], {'name': 'Max'}),
+])
+def test_constraints_dont_exclude_fitting_policies(elements, value):
+    policy = Policy(1, subjects=elements)
+    assert may_fit(policy, 'subjects', value)
+    assert RulesChecker().fits(policy, 'subjects', value)
+
+
+@pytest.mark.parametrize('elements, value', [
+    ([{'name': Eq('Max')}], {'name': 'Jim'}),
+    ([{'name': Eq('Max')}], {'nickname': 'Max'}),
+    ([{'name': Eq('Max')}], 'Max'),
+    ([{'name': Eq('Max'), 'stars': Greater(5)}, {'name': Eq('Jim')}], {'name': 'Sam', 'stars': 10}),
+    ([{'role': In('admin', 'owner')}], {'role': ['admin']}),
+    ([{'team': StartsWith('developers')}], {'team': 'dev-ops'}),
+    ([{'id': Any()}], {'name': 'Max'}),
+    ([Eq('Max')], {'name': 'Max'}),
+])
+def test_constraints_exclude_not_fitting_policies(elements, value):
+    policy = Policy(1, subjects=elements)
+    assert not may_fit(policy, 'subjects', value)
+    assert not RulesChecker().fits(policy, 'subjects', value)
@@ -0,0 +1,303 @@
+import threading
+import types
+from operator import attrgetter
+
+import pytest
+
+from vakt.checker import StringExactChecker, StringFuzzyChecker, RegexChecker, RulesChecker
+from vakt.effects import ALLOW_ACCESS
+from vakt.exceptions import PolicyExistsError, UnknownCheckerType
+from vakt.guard import Inquiry, Guard
+from vakt.policy import Policy
+from vakt.rules.operator import Eq
+from vakt.rules.string import Equal
+from vakt.storage.memory import MemoryStorage
+from vakt.storage.migration import Migrator
+from vakt.storage.sqlite import SQLiteStorage, SQLiteMigrationSet
+
+
+class TestSQLiteStorage:
+
+    @pytest.fixture
+    def path(self, tmpdir):
+        return str(tmpdir.join('vakt.db'))
+
+    @pytest.fixture
+    def st(self, path):
+        storage = SQLiteStorage(path)
+        Migrator(SQLiteMigrationSet(storage)).up()
+        return storage
+
+    def test_add(self, st):
+        p = Policy(
+            uid='1',
+            description='foo bar баз',
+            subjects=('Edward Rooney', 'Florence Sparrow'),
+            actions=['<.*>'],
+            resources=['<.*>'],
+            context={
+                'secret': Equal('i-am-a-teacher'),
+            },
+        )
+        st.add(p)
+        back = st.get('1')
+        assert '1' == back.uid
+        assert 'foo bar баз' == back.description
+        assert ['Edward Rooney', 'Florence Sparrow'] == back.subjects
+        assert isinstance(back.context['secret'], Equal)
+        st.add(Policy('2', actions=[Eq('get'), Eq('put')], resources=[{'books': Eq('Harry')}]))
+        assert 2 == len(st.get('2').actions)
+        assert 'Harry' == st.get('2').resources[0]['books'].val
+
+    def test_policy_create_existing(self, st):
+        st.add(Policy('1', actions=['get'], description='foo'))
+        with pytest.raises(PolicyExistsError):
+            st.add(Policy('1', actions=['put'], description='bar'))
+        assert 'foo' == st.get('1').description
+        assert [] == list(st.find_for_inquiry(Inquiry(action='put'), StringExactChecker()))
+
+    def test_get(self, st):
+        st.add(Policy('1'))
+        st.add(Policy(2, description='some text'))
+        assert '1' == st.get('1').uid
+        assert 2 == st.get(2).uid
+        assert 'some text' == st.get('2').description
+        assert None is st.get('123456789')
+
+    @pytest.mark.parametrize('limit, offset, result', [
+        (50, 0, 20),
+        (11, 1, 11),
+        (50, 5, 15),
+        (20, 1, 19),
+        (0, 0, 0),
+        (0, 10, 0),
+        (5, 4, 5),
+    ])
+    def test_get_all(self, st, limit, offset, result):
+        for i in range(20):
+            st.add(Policy(str(i)))
+        assert result == len(list(st.get_all(limit=limit, offset=offset)))
+
+    def test_get_all_with_incorrect_args(self, st):
+        with pytest.raises(ValueError) as e:
+            list(st.get_all(-1, 9))
+        assert "Limit can't be negative" == str(e.value)
+        with pytest.raises(ValueError) as e:
+            list(st.get_all(0, -3))
+        assert "Offset can't be negative" == str(e.value)
+
+    def test_get_all_ascending_sorting_order(self, st):
+        for i in range(1, 20):
+            st.add(Policy(str(i)))
+        expected_uids = sorted(list(map(str, range(1, 20))))
+        assert expected_uids == list(map(attrgetter('uid'), st.get_all(30, 0)))
+
+    @pytest.mark.parametrize('batch', [1, 2, 3, 7, 100])
+    def test_retrieve_all(self, st, batch):
+        for i in range(7):
+            st.add(Policy(str(i)))
+        assert list(map(str, range(7))) == list(map(attrgetter('uid'), st.retrieve_all(batch)))
+        assert [] == list(st.retrieve_all(0))
+
+    @pytest.mark.parametrize('checker, expect_number', [
+        (None, 9),
+        (RulesChecker(), 2),
+        (StringExactChecker(), 1),
+        (StringFuzzyChecker(), 1),
+        (RegexChecker(), 5),
+    ])
+    def test_find_for_inquiry_returns_existing_policies(self, st, checker, expect_number):
+        st.add(Policy('1', subjects=['<[mM]ax>', '<.*>'], actions=['delete'], resources=['server']))
+        st.add(Policy('2', subjects=['Ji<[mM]+>'], actions=['delete'], resources=[r'server<\s*>']))
+        st.add(Policy('3', subjects=['sam<.*>', 'foo']))
+        st.add(Policy('5', subjects=['Jim'], actions=['delete'], resources=['server']))
+        st.add(Policy('6', subjects=['Ji<[mM]+>'], actions=[r'<[a-zA-Z]{6}>'], resources=['serve<(r|rs)>']))
+        st.add(Policy('7', subjects=['Ji<[mM]+>'], actions=[r'<[a-zA-Z]{6}>'], resources=['serve<(u|rs)>']))
+        st.add(Policy('8', subjects=['Ji<[mM]+>'], actions=[r'<[a-zA-Z]{6}>'], resources=['serve<(u|rs)>', 'server']))
+        st.add(Policy('40', subjects=[{'stars': Eq(90)}, Eq('Max')]))
+        st.add(Policy('60', subjects=[Eq('Jim'), Eq('Nina')]))
+        inquiry = Inquiry(subject='Jim', action='delete', resource='server')
+        found = st.find_for_inquiry(inquiry, checker)
+        assert isinstance(found, types.GeneratorType)
+        assert expect_number == len(list(found))
+
+    def test_find_for_inquiry_with_exact_string_checker(self, st):
+        st.add(Policy('1', subjects=['max', 'bob'], actions=['get'], resources=['books', 'comics', 'magazines']))
+        st.add(Policy('2', subjects=['maxim'], actions=['get'], resources=['books', 'comics', 'magazines']))
+        st.add(Policy('3', subjects=['<max>'], actions=['<get>'], resources=['<books>']))
+        st.add(Policy('4', subjects=[Eq('sam'), Eq('nina')]))
+        inquiry = Inquiry(subject='max', action='get', resource='books')
+        found = st.find_for_inquiry(inquiry, StringExactChecker())
+        assert ['1', '3'] == sorted(map(attrgetter('uid'), found))
+
+    def test_find_for_inquiry_with_fuzzy_string_checker(self, st):
+        st.add(Policy('1', subjects=['max', 'bob'], actions=['get'], resources=['books', 'comics', 'magazines']))
+        st.add(Policy('2', subjects=['maxim'], actions=['get'], resources=['books', 'foos']))
+        st.add(Policy('3', subjects=['Max'], actions=['get'], resources=['books', 'comics']))
+        st.add(Policy('4', subjects=['sam', 'nina']))
+        inquiry = Inquiry(subject='max', action='et', resource='oo')
+        found = st.find_for_inquiry(inquiry, StringFuzzyChecker())
+        assert ['1', '2'] == sorted(map(attrgetter('uid'), found))
+        inquiry = Inquiry(subject='%', action='_', resource='')
+        assert [] == list(st.find_for_inquiry(inquiry, StringFuzzyChecker()))
+
+    @pytest.mark.parametrize('policy, inquiry, expected_reference', [
+        (
+            Policy(uid=1, actions=['get', 'post'], effect=ALLOW_ACCESS, resources=['<.*>'],
+                   subjects=['<[Mm]ax>', '<Jim>']),
+            Inquiry(action='get', resource='printer', subject='Max'),
+            True,
+        ),
+        (
+            Policy(uid=1, actions=['<.*>'], effect=ALLOW_ACCESS, resources=['library:books:<.+>'],
+                   subjects=['<.*>']),
+            Inquiry(action='get', resource='library:books:dracula', subject='Max'),
+            True,
+        ),
+        (
+            Policy(uid=1, actions=['<.*>'], effect=ALLOW_ACCESS, resources=['library:books:<.+>'],
+                   subjects=['<.*>']),
+            Inquiry(action='get', resource='library:magazines:vogue', subject='Max'),
+            False,
+        ),
+        (
+            Policy(uid=1, actions=[r'<[0-9]+>'], effect=ALLOW_ACCESS, resources=[r'<[a-zA-Z]{1,3}>'],
+                   subjects=[r'<[a-zA-Z0-9]{2}-[0-9]+>']),
+            Inquiry(action='12', resource='Pie', subject='Jo-1'),
+            True,
+        ),
+        (
+            Policy(uid=1, actions=['get'], effect=ALLOW_ACCESS, resources=['a' * 40 + '<[0-9]+>'],
+                   subjects=['<.*>']),
+            Inquiry(action='get', resource='a' * 40 + '123', subject='Jo'),
+            True,
+        ),
+    ])
+    def test_find_for_inquiry_with_regex_checker(self, st, policy, inquiry, expected_reference):
+        mem_storage = MemoryStorage()  # it returns all stored policies so we consider Guard as a reference
+        st.add(policy)
+        mem_storage.add(policy)
+        reference_answer = Guard(mem_storage, RegexChecker()).is_allowed(inquiry)
+        assert expected_reference == reference_answer, 'Check reference answer'
+        assert reference_answer == Guard(st, RegexChecker()).is_allowed(inquiry), \
+            'SQLite storage should give the same answers as reference'
+
+    @pytest.mark.parametrize('checker', [StringExactChecker(), StringFuzzyChecker()])
+    def test_find_for_inquiry_with_string_checker_and_non_string_inquiry_fields(self, st, checker):
+        st.add(Policy('1', actions=['get'], resources=['book'], subjects=['Max']))
+        st.add(Policy('2', subjects=[{'name': Eq('Max')}]))
+        inquiry = Inquiry(action='get', resource='book', subject={'name': 'Max'})
+        assert [] == list(st.find_for_inquiry(inquiry, checker))
+        assert not Guard(st, checker).is_allowed(inquiry)
+        inquiry = Inquiry(action='get', resource=['book'], subject='Max')
+        assert [] == list(st.find_for_inquiry(inquiry, checker))
+
+    def test_find_for_inquiry_with_regex_checker_and_non_string_inquiry_fields(self, st):
+        st.add(Policy('1', actions=['get'], resources=['<.*>'], subjects=['<.*>']))
+        st.add(Policy('2', actions=['get'], resources=['<.*>'], subjects=['Max']))
+        inquiry = Inquiry(action='get', resource='book', subject={'name': 'Max'})
+        assert ['1'] == [p.uid for p in st.find_for_inquiry(inquiry, RegexChecker())]
+        inquiry = Inquiry(action='get', resource=42, subject='Max')
+        assert ['1', '2'] == sorted(p.uid for p in st.find_for_inquiry(inquiry, RegexChecker()))
+
+    def test_find_for_inquiry_with_unknown_checker(self, st):
+        st.add(Policy('1'))
+        with pytest.raises(UnknownCheckerType):
+            list(st.find_for_inquiry(Inquiry(), Inquiry()))
+
+    def test_update(self, st):
+        policy = Policy('1', actions=['get'], subjects=['max'], resources=['book'])
+        st.add(policy)
+        policy.description = 'foo'
+        policy.actions = ['a', 'b', 'c']
+        st.update(policy)
+        assert 'foo' == st.get('1').description
+        assert ['a', 'b', 'c'] == st.get('1').actions
+        assert [] == list(st.find_for_inquiry(Inquiry(action='get'), StringFuzzyChecker()))
+        assert ['1'] == [p.uid for p in st.find_for_inquiry(Inquiry(action='b'), StringFuzzyChecker())]
+        st.update(Policy('1', actions=[Eq('get')]))
+        assert 'get' == st.get('1').actions[0].val
+        assert [] == list(st.find_for_inquiry(Inquiry(action='b'), StringFuzzyChecker()))
+
+    def test_update_non_existing_does_not_create_anything(self, st):
+        st.update(Policy('1', actions=['get'], description='bar'))
+        assert st.get('1') is None
+        assert [] == list(st.find_for_inquiry(Inquiry(action='get'), StringFuzzyChecker()))
+
+    def test_delete(self, st):
+        st.add(Policy('1', actions=['get']))
+        st.delete('1')
+        assert None is st.get('1')
+        assert [] == list(st.find_for_inquiry(Inquiry(action='get'), StringFuzzyChecker()))
+        st.delete('non-existent-id')
+
+    def test_add_many(self, st):
+        st.add_many(Policy(str(i), subjects=['max'], actions=['get'], resources=['<.*>']) for i in range(3))
+        assert ['0', '1', '2'] == [p.uid for p in st.retrieve_all()]
+        inquiry = Inquiry(subject='max', action='get', resource='books')
+        assert 3 == len(list(st.find_for_inquiry(inquiry, RegexChecker())))
+        with pytest.raises(PolicyExistsError) as e:
+            st.add_many([Policy('4'), Policy('1')])
+        assert 'Conflicting UID = 1' == str(e.value)
+        with pytest.raises(PolicyExistsError) as e:
+            st.add_many([Policy('5'), Policy('5')])
+        assert 'Conflicting UID = 5' == str(e.value)
+        assert 3 == len(list(st.retrieve_all()))
+
+    def test_update_many_and_delete_many(self, st):
+        st.add_many(Policy(str(i), subjects=['max'], actions=['get'], resources=['books']) for i in range(3))
+        st.update_many([
+            Policy('0', subjects=['max'], actions=['put'], resources=['books']),
+            Policy('9', subjects=['max'], actions=['put'], resources=['books']),
+        ])
+        inquiry = Inquiry(subject='max', action='put', resource='books')
+        assert ['0'] == [p.uid for p in st.find_for_inquiry(inquiry, StringExactChecker())]
+        assert st.get('9') is None
+        st.delete_many(['0', '2', '9'])
+        assert ['1'] == [p.uid for p in st.retrieve_all()]
+        assert [] == list(st.find_for_inquiry(inquiry, StringExactChecker()))
+
+    def test_uses_wal_journal_mode(self, st):
+        assert 'wal' == st.connection.execute('PRAGMA journal_mode').fetchone()[0]
+
+    def test_many_storages_share_one_file(self, st, path):
+        other = SQLiteStorage(path)
+        st.add(Policy('1'))
+        assert '1' == other.get('1').uid
+        other.delete('1')
+        assert st.get('1') is None
+
+    def test_threads_use_own_connections(self, st):
+        errors = []
+
+        def work(prefix):
+            try:
+                for i in range(20):
+                    st.add(Policy('%s-%d' % (prefix, i), actions=['get']))
+                    list(st.find_for_inquiry(Inquiry(action='get'), StringExactChecker()))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(x,)) for x in 'abcd']
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert [] == errors
+        assert 80 == len(list(st.retrieve_all()))
+
+
+class TestSQLiteMigrations:
+
+    def test_up_and_down(self, tmpdir):
+        st = SQLiteStorage(str(tmpdir.join('vakt.db')))
+        migration_set = SQLiteMigrationSet(st)
+        assert 0 == migration_set.last_applied()
+        migrator = Migrator(migration_set)
+        migrator.up()
+        assert 1 == migration_set.last_applied()
+        st.add(Policy('1'))
+        migrator.down()
+        assert 0 == migration_set.last_applied()
+        tables = st.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        assert [('vakt_migrations',)] == tables
@@ -1,6 +1,6 @@
 import pytest
 
-from vakt.parser import compile_regex
+from vakt.parser import compile_regex, get_literal_prefix, get_prefixes, get_ngrams
 from vakt.exceptions import InvalidPatternError
 
 
@@ -53,3 +53,38 @@ def test_compile_regex_output_matches_correctly(phrase, start, end, match_agains
         assert result.match(match_against)
     else:
         assert not result.match(match_against)
+
+
+@pytest.mark.parametrize('phrase, start, max_length, output', [
+    ('foo-bar-<.*>', '<', None, 'foo-bar-'),
+    ('foo-bar-<.*>', '<', 3, 'foo'),
+    ('foo-bar-<.*>', '<', 100, 'foo-bar-'),
+    ('<.*>-foo', '<', None, ''),
+    ('foo', '<', None, 'foo'),
+    ('a-{b}-{c}', '{', None, 'a-'),
+    ('', '<', None, ''),
+])
+def test_get_literal_prefix(phrase, start, max_length, output):
+    assert output == get_literal_prefix(phrase, start, max_length)
+
+
+@pytest.mark.parametrize('value, max_length, output', [
+    ('abc', 10, ['', 'a', 'ab', 'abc']),
+    ('abc', 2, ['', 'a', 'ab']),
+    ('', 2, ['']),
+])
+def test_get_prefixes(value, max_length, output):
+    assert output == get_prefixes(value, max_length)
+
+
+@pytest.mark.parametrize('value, n, output', [
+    ('abcd', 3, ['abc', 'bcd']),
+    ('abc', 3, ['abc']),
+    ('ab', 3, []),
+    ('', 3, []),
+    ('aaaa', 2, ['aa']),
+    ('abab', 2, ['ab', 'ba']),
+    ('фу-бар', 3, ['фу-', 'у-б', '-ба', 'бар']),
+])
+def test_get_ngrams(value, n, output):
+    assert output == get_ngrams(value, n)
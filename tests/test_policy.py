@@ -1,3 +1,5 @@
+import json
+
 import pytest
 
 from vakt.policy import Policy, PolicyAllow, PolicyDeny
@@ -137,6 +139,23 @@ def test_json_roundtrip_of_a_rules_based_policy(policy):
     assert policy.to_json() == p2.to_json()
 
 
+@pytest.mark.parametrize('policy', [
+    Policy(1, subjects=[{'name': Eq('Max'), 'rate': Greater(90)}], actions=[Eq('get'), Eq('post')]),
+    Policy(2, subjects=[{'login': Eq('sally')}], actions=[Eq('get'), Eq('post')], context={'ip': Eq('127.0.0.1')}),
+    Policy(3, subjects=[{'rating': AnyIn(1, 2)}], actions=[And(Eq('get'), Eq('post'))], description='foo'),
+    Policy('4', subjects=['<[Mm]ax>', 'sally'], actions=('get',), context={'ip': CIDR('192.168.1.0/24')}),
+])
+def test_dict_roundtrip(policy):
+    d = policy.to_dict()
+    assert json.loads(policy.to_json()) == d
+    p2 = Policy.from_dict(d)
+    assert isinstance(p2, Policy)
+    assert policy.to_json(sort=True) == p2.to_json(sort=True)
+    assert policy.type == p2.type
+    with pytest.raises(PolicyCreationError):
+        Policy.from_dict({'subjects': []})
+
+
 @pytest.mark.parametrize('data, exception, msg', [
     ('{}', PolicyCreationError, "'uid'"),
     ('{"uid":}', ValueError, ''),
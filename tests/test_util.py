@@ -1,4 +1,6 @@
-from vakt.util import JsonSerializer, Subject
+import json
+
+from vakt.util import JsonSerializer, Subject, Observer
 from .helper import CountObserver
 
 
@@ -25,6 +27,16 @@ def test_json_serializer_from_json():
     assert cd == {'x': 1}
 
 
+def test_json_serializer_dict_roundtrip():
+    d = AB(5).to_dict()
+    assert json.loads(AB(5).to_json()) == d
+    ab = AB.from_dict(d)
+    assert isinstance(ab, AB)
+    assert 5 == ab.b
+    assert {'x': 1} == CD().to_dict()
+    assert {'x': 1} == CD.from_dict(CD().to_dict())
+
+
 def test_observables():
     subj = Subject()
     o1 = CountObserver()
@@ -39,3 +51,24 @@ def test_observables():
     subj.notify()
     assert 2 == o1.count
     assert 3 == o2.count
+    subj.notify(['foo'])
+    assert 4 == o2.count
+    assert ['foo'] == o2.changes
+
+
+def test_observables_without_arguments_in_update():
+    class Legacy(Observer):
+        def __init__(self):
+            self.count = 0
+
+        def update(self):
+            self.count += 1
+    subj = Subject()
+    legacy, o = Legacy(), CountObserver()
+    subj.add_listener(legacy)
+    subj.add_listener(o)
+    subj.notify(['foo'])
+    subj.notify()
+    assert 2 == legacy.count
+    assert 2 == o.count
+    assert o.changes is None
@@ -2,8 +2,17 @@
 Caching mechanisms for vakt
 """
 
+import os
+import time
+import mmap
+import zlib
+import struct
+import hashlib
 import logging
-from functools import lru_cache
+import threading
+from functools import wraps
+from itertools import chain
+from collections import OrderedDict, namedtuple
 from abc import ABCMeta, abstractmethod
 
 from .storage.observable import ObservableMutationStorage
@@ -15,11 +24,19 @@ __all__ = [
     'create_cached_guard',
     'EnfoldCache',
     'AllowanceCacheBackend',
+    'LRUCache',
+    'ShardedLRUCache',
+    'TTLCache',
+    'TinyLFUCache',
+    'MMapCache',
 ]
 
 
 log = logging.getLogger(__name__)
 
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize', 'evictions'])
+EnfoldCacheInfo = namedtuple('EnfoldCacheInfo', ['hits', 'misses', 'fallbacks', 'populated'])
+
 
 def create_cached_guard(storage, checker, cache=None, **kwargs):
     """
@@ -34,6 +51,8 @@ def create_cached_guard(storage, checker, cache=None, **kwargs):
             It also accepts optional keyword arguments that will be passed to a cache.
             Currently only `maxsize` is available.
     maxsize - argument allows you to specify a maximum size of a default in-memory LRU cache, (preferably a power of 2)
+    max_changed_policies - argument allows you to specify how many changed policies are checked against cached
+                           Inquiries, the whole cache is invalidated if more of them are changed at once
 
     :return (storage, guard, cache)
     guard - Guard whose `is_allowed` method will be cached
@@ -56,6 +75,13 @@ class EnfoldCache:
     Otherwise you need to set `populate` arg is False and manually call ec.populate()
     before you start working with the cache.
 
+    Until the cache is populated, reads that find nothing in it are tried from backend storage.
+    Once it is populated, the cache holds all the policies (provided they are modified only through EnfoldCache),
+    so empty results (e.g. for Inquiries that no policy fits) are served from the cache as well.
+    If modification of the cache fails after the backend storage was modified, it's no longer considered populated.
+    Use `info` to get counters of reads that found something in the cache (hits), found nothing (misses)
+    and were tried from backend storage (fallbacks).
+
     Typical (and recommended) usage is:
     storage = EnfoldCache(MongoStorage(...), cache=MemoryStorage())
 
@@ -69,12 +95,24 @@ class EnfoldCache:
         self.storage = storage
         self.cache = cache
         self.populate_step_size = 1000
+        self.populated = False
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
         if populate:
             self.populate()
 
     def populate(self):
-        for p in self.storage.retrieve_all(self.populate_step_size):
-            self.cache.add(p)
+        self.cache.add_many(self.storage.retrieve_all(self.populate_step_size))
+        self.populated = True
+
+    def info(self):
+        """
+        Get counters of cache reads and whether the cache is populated
+        """
+        with self.lock:
+            return EnfoldCacheInfo(self.hits, self.misses, self.fallbacks, self.populated)
 
     def add(self, policy):
         """
@@ -82,7 +120,16 @@ class EnfoldCache:
         """
         # we aren't catching any exceptions - just letting them pass
         res = self.storage.add(policy)
-        self.cache.add(policy)
+        self._modify_cache(self.cache.add, policy)
+        return res
+
+    def add_many(self, policies):
+        """
+        Cache storage `add_many`
+        """
+        policies = list(policies)
+        res = self.storage.add_many(policies)
+        self._modify_cache(self.cache.add_many, policies)
         return res
 
     def get(self, uid):
@@ -90,7 +137,7 @@ class EnfoldCache:
         Cache storage `get`
         """
         policy = self.cache.get(uid)
-        if policy:
+        if not self._needs_fallback(policy is not None):
             return policy
         log.warning(
             '%s cache miss for get Policy with UID=%s. Trying to get it from backend storage',
@@ -103,17 +150,21 @@ class EnfoldCache:
         Cache storage `get_all`
         """
         result = list(self.cache.get_all(limit, offset))
-        if len(result) > 0:
+        if not self._needs_fallback(len(result) > 0):
             return result
         return self.storage.get_all(limit, offset)
 
     def retrieve_all(self, *args, **kwargs):
         """
-        Cache storage `retrieve_all`
+        Cache storage `retrieve_all`.
+        Only the first policy is read in advance to tell if the cache has any, the rest are yielded lazily.
         """
-        result = list(self.cache.retrieve_all(*args, **kwargs))
-        if len(result) > 0:
-            return result
+        result = iter(self.cache.retrieve_all(*args, **kwargs))
+        for first in result:
+            self._needs_fallback(True)
+            return chain([first], result)
+        if not self._needs_fallback(False):
+            return []
         return self.storage.retrieve_all(*args, **kwargs)
 
     def find_for_inquiry(self, inquiry, checker=None):
@@ -121,17 +172,42 @@ class EnfoldCache:
         Cache storage `find_for_inquiry`
         """
         result = list(self.cache.find_for_inquiry(inquiry, checker))
-        if len(result) > 0:
+        if not self._needs_fallback(len(result) > 0):
             return result
         log.warning('%s cache miss for find_for_inquiry. Trying it from backend storage', type(self).__name__)
         return self.storage.find_for_inquiry(inquiry, checker)
 
+    def find_for_inquiries(self, inquiries, checker=None):
+        """
+        Cache storage `find_for_inquiries`.
+        Inquiries that have no candidates in the cache are tried from backend storage with one batch call.
+        """
+        inquiries = list(inquiries)
+        result = list(self.cache.find_for_inquiries(inquiries, checker))
+        found = set(i for i, _ in result)
+        missed = [i for i in range(len(inquiries)) if i not in found]
+        if self._needs_fallback(len(found), len(missed)):
+            log.warning('%s cache miss for find_for_inquiries. Trying %d inquiries from backend storage',
+                        type(self).__name__, len(missed))
+            backend_result = self.storage.find_for_inquiries([inquiries[i] for i in missed], checker)
+            result.extend((missed[i], policy) for i, policy in backend_result)
+        return result
+
     def update(self, policy):
         """
         Cache storage `update`
         """
         res = self.storage.update(policy)
-        self.cache.update(policy)
+        self._modify_cache(self.cache.update, policy)
+        return res
+
+    def update_many(self, policies):
+        """
+        Cache storage `update_many`
+        """
+        policies = list(policies)
+        res = self.storage.update_many(policies)
+        self._modify_cache(self.cache.update_many, policies)
         return res
 
     def delete(self, uid):
@@ -139,36 +215,89 @@ class EnfoldCache:
         Cache storage `delete`
         """
         res = self.storage.delete(uid)
-        self.cache.delete(uid)
+        self._modify_cache(self.cache.delete, uid)
+        return res
+
+    def delete_many(self, uids):
+        """
+        Cache storage `delete_many`
+        """
+        uids = list(uids)
+        res = self.storage.delete_many(uids)
+        self._modify_cache(self.cache.delete_many, uids)
         return res
 
+    def _needs_fallback(self, hits, misses=None):
+        """
+        Count reads that found something in the cache (`hits`) and that didn't (`misses`, by default it's
+        the opposite of `hits` for a single read). Tells if missed reads should be tried from backend storage.
+        """
+        if misses is None:
+            hits, misses = int(hits), int(not hits)
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            if self.populated or not misses:
+                return False
+            self.fallbacks += misses
+            return True
+
+    def _modify_cache(self, method, arg):
+        """
+        Apply modification to the cache, which is no longer trusted for empty results if it fails
+        """
+        try:
+            method(arg)
+        except Exception:
+            self.populated = False
+            log.exception('%s failed to modify cache storage. Cache is considered not populated anymore',
+                          type(self).__name__)
+            raise
+
 
 class AllowanceCache(Observer):
     """
     Caches hits of `is_allowed` (technically, its more tiny part: `is_allowed_check`) for a given Inquiry.
     In case of a cache hit returns the cached boolean result, in case of a cache miss goes to a Storage and
     memorizes its result for future calls with the same Inquiry.
-    If underlying Storage notifies it that policy-set was anyhow changed, invalidates all the cached results.
+    If underlying Storage notifies it that policy-set was anyhow changed, invalidates cached results
+    for the Inquiries that changed policies fit.
 
     You need to pass proper options in order to create cache of a desired type.
     Available options are:
     maxsize - maximum size of a cache
     backend - which backend will be used for caching
     type - type of a caching algorithm to be used
+    max_changed_policies - if more policies are changed at once, the whole cache is invalidated instead of
+                           checking every cached Inquiry against all of them (defaults to MAX_CHANGED_POLICIES)
     """
+    MAX_CHANGED_POLICIES = 16
+
     def __init__(self, guard, cache_backend=None, **kwargs):
         self.options = kwargs
+        self.max_changed_policies = self.options.get('max_changed_policies', self.MAX_CHANGED_POLICIES)
+        self.checker = guard.checker
         if cache_backend is None:
-            self.cache = LRUCache(maxsize=self.options['maxsize'])
+            cache_backend = LRUCache(maxsize=self.options['maxsize'])
+        self.cache = cache_backend
         guard.is_allowed_check = self.cache.wrap(guard.is_allowed_check)
 
-    def update(self):
+    def update(self, changes=None):
         """
         Is a callback for fire events on Storage modify actions.
-        We need to invalidate cache since policy set is changed with each add/delete/update storage action,
-        thus old Guard answers on inquiries are will be no longer valid.
+        `changes` are (old policy, new policy) pairs of the modified policies.
+        Guard answers may change only for Inquiries that old or new policies fit, so only they are invalidated.
+        If changes are unknown, old state of a policy can't be told (it was modified in-place)
+        or too many policies were changed, the whole cache is invalidated.
         """
-        self.cache.invalidate()
+        if changes is None or any(old is not None and old is new for old, new in changes):
+            self.cache.invalidate()
+            return
+        policies = [p for pair in changes for p in pair if p is not None]
+        if len(policies) > self.max_changed_policies:
+            self.cache.invalidate()
+        elif policies:
+            self.cache.invalidate_where(lambda inquiry: any(self._fits(p, inquiry) for p in policies))
 
     def info(self):
         """
@@ -176,6 +305,18 @@ class AllowanceCache(Observer):
         """
         return self.cache.info()
 
+    def _fits(self, policy, inquiry):
+        """
+        Does policy fit the inquiry in the same way Guard checks it (context restrictions aside)?
+        """
+        try:
+            return self.checker.fits(policy, 'actions', inquiry.action, inquiry) and \
+                self.checker.fits(policy, 'subjects', inquiry.subject, inquiry) and \
+                self.checker.fits(policy, 'resources', inquiry.resource, inquiry)
+        except Exception:
+            log.exception('Unexpected exception occurred while checking Inquiry %s for invalidation', inquiry)
+            return True
+
 
 class AllowanceCacheBackend(metaclass=ABCMeta):
     """
@@ -196,6 +337,13 @@ class AllowanceCacheBackend(metaclass=ABCMeta):
         """
         pass
 
+    def invalidate_where(self, predicate):
+        """
+        Invalidate cached results for arguments (Inquiries) the predicate returns True for.
+        By default the whole cache is invalidated: backends that can drop separate results should override it.
+        """
+        self.invalidate()
+
     @abstractmethod
     def info(self):
         """
@@ -205,25 +353,441 @@ class AllowanceCacheBackend(metaclass=ABCMeta):
         - misses - number of cache misses,
         - maxsize - maximum number of elements the cache can contain,
         - currsize - number of elements the cache contains at the moment
+        - evictions - number of elements evicted to free space for other ones
         - ... some other useful attributes
         """
         pass
 
 
-class LRUCache(AllowanceCacheBackend):
+class LockingCacheBackend(AllowanceCacheBackend):
+    """
+    Base for thread-safe in-memory caches of results of a one-argument function.
+    Subclasses define how results are kept and evicted by implementing `_lookup`, `_store`, `_remove`, `_clear`,
+    `_keys` and `_size`, which are always called under the cache lock.
+    Stores evicted entries count in `evictions` attribute.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # is incremented on each invalidation, so results computed before it aren't cached
+        self._generation = 0
+
+    def wrap(self, func):
+        @wraps(func)
+        def cached(key):
+            with self.lock:
+                found, result = self._lookup(key)
+                if found:
+                    self.hits += 1
+                    return result
+                self.misses += 1
+                generation = self._generation
+            result = func(key)
+            with self.lock:
+                if generation == self._generation and self.maxsize != 0:
+                    self._store(key, result)
+            return result
+        return cached
+
+    def invalidate(self):
+        with self.lock:
+            self._generation += 1
+            self._clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def invalidate_where(self, predicate):
+        with self.lock:
+            self._generation += 1
+            keys = list(self._keys())
+        # predicate may be slow, so it's called without holding the lock
+        stale = [key for key in keys if predicate(key)]
+        with self.lock:
+            for key in stale:
+                self._remove(key)
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, self._size(), self.evictions)
+
+    @abstractmethod
+    def _lookup(self, key):
+        """
+        Get (True, result) for a cached key or (False, None) otherwise
+        """
+        pass
+
+    @abstractmethod
+    def _store(self, key, result):
+        """
+        Cache result for a key evicting other results if needed
+        """
+        pass
+
+    @abstractmethod
+    def _remove(self, key):
+        """
+        Remove result for a key if it's cached
+        """
+        pass
+
+    @abstractmethod
+    def _clear(self):
+        """
+        Remove all the results
+        """
+        pass
+
+    @abstractmethod
+    def _keys(self):
+        """
+        Get all cached keys
+        """
+        pass
+
+    @abstractmethod
+    def _size(self):
+        """
+        Get number of cached results
+        """
+        pass
+
+
+class LRUCache(LockingCacheBackend):
+    """
+    Thread-safe in-memory LRU cache.
+    `maxsize` None means that the cache is unbounded.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(kwargs['maxsize'])
+        self._results = OrderedDict()
+
+    def _lookup(self, key):
+        if key not in self._results:
+            return False, None
+        self._results.move_to_end(key)
+        return True, self._results[key]
+
+    def _store(self, key, result):
+        self._results[key] = result
+        self._results.move_to_end(key)
+        if self.maxsize is not None and len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+            self.evictions += 1
+
+    def _remove(self, key):
+        self._results.pop(key, None)
+
+    def _clear(self):
+        self._results.clear()
+
+    def _keys(self):
+        return self._results.keys()
+
+    def _size(self):
+        return len(self._results)
+
+
+class TTLCache(LRUCache):
+    """
+    Thread-safe in-memory LRU cache whose results expire `ttl` seconds after they were cached.
+    Is handy when policies can be changed not only through the observed Storage (e.g. by other processes).
+    Expired results are dropped on lookup and are counted as evictions, until then they are counted in `currsize`.
     """
-    Std lib LRU in-memory cache.
+    def __init__(self, **kwargs):
+        super().__init__(maxsize=kwargs['maxsize'])
+        self.ttl = kwargs['ttl']
+        self.timer = kwargs.get('timer', time.monotonic)
+
+    def _lookup(self, key):
+        found, item = super()._lookup(key)
+        if not found:
+            return False, None
+        expires, result = item
+        if expires <= self.timer():
+            del self._results[key]
+            self.evictions += 1
+            return False, None
+        return True, result
+
+    def _store(self, key, result):
+        super()._store(key, (self.timer() + self.ttl, result))
+
+
+class ShardedLRUCache(AllowanceCacheBackend):
+    """
+    LRU cache split into `shards` LRU caches by hash of a key, each with its own lock.
+    Threads that look up different keys seldom wait for each other, so it scales better in multi-threaded apps.
+    Each shard holds at most `maxsize / shards` results.
     """
     def __init__(self, **kwargs):
         self.maxsize = kwargs['maxsize']
-        self._wrapped_func = None
+        count = kwargs.get('shards', 16)
+        shard_size = None if self.maxsize is None else -(-self.maxsize // count)
+        self.shards = [LRUCache(maxsize=shard_size) for _ in range(count)]
 
     def wrap(self, func):
-        self._wrapped_func = lru_cache(self.maxsize)(func)
-        return self._wrapped_func
+        shards = [shard.wrap(func) for shard in self.shards]
+
+        @wraps(func)
+        def cached(key):
+            return shards[hash(key) % len(shards)](key)
+        return cached
 
     def invalidate(self):
-        self._wrapped_func.cache_clear()
+        for shard in self.shards:
+            shard.invalidate()
+
+    def invalidate_where(self, predicate):
+        for shard in self.shards:
+            shard.invalidate_where(predicate)
 
     def info(self):
-        return self._wrapped_func.cache_info()
+        infos = [shard.info() for shard in self.shards]
+        return CacheInfo(
+            sum(i.hits for i in infos), sum(i.misses for i in infos), self.maxsize,
+            sum(i.currsize for i in infos), sum(i.evictions for i in infos),
+        )
+
+
+class FrequencySketch:
+    """
+    Count-Min sketch that estimates how often keys were seen with 4 rows of counters saturating at 15.
+    Each row has at least 4 * `size` counters to keep estimates of `size` keys precise.
+    After 10 * `size` increments all counters are halved, so the sketch forgets the old popularity.
+    """
+    depth = 4
+    max_count = 15
+
+    def __init__(self, size):
+        width = 16
+        while width < 4 * size:
+            width *= 2
+        self.mask = width - 1
+        self.rows = [bytearray(width) for _ in range(self.depth)]
+        self.sample_size = 10 * max(size, 1)
+        self.additions = 0
+
+    def _indexes(self, key):
+        h = hash(key)
+        return [hash((h, row)) & self.mask for row in range(self.depth)]
+
+    def increment(self, key):
+        for row, i in zip(self.rows, self._indexes(key)):
+            if row[i] < self.max_count:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.rows = [bytearray(c >> 1 for c in row) for row in self.rows]
+            self.additions //= 2
+
+    def frequency(self, key):
+        return min(row[i] for row, i in zip(self.rows, self._indexes(key)))
+
+
+class TinyLFUCache(LockingCacheBackend):
+    """
+    Thread-safe in-memory W-TinyLFU cache that is resistant to scans of one-off keys.
+    New results get into a small LRU window (`window` share of `maxsize`, 1% by default). Results evicted
+    from the window are admitted into the main segmented LRU only if their keys were looked up more often
+    (according to a FrequencySketch) than the key the main segment would evict for them.
+    Main segment keeps results looked up at least twice in its protected part (80% of it).
+    """
+    def __init__(self, **kwargs):
+        maxsize = kwargs['maxsize']
+        super().__init__(maxsize)
+        self.window_size = max(1, int(maxsize * kwargs.get('window', 0.01)))
+        self.main_size = max(0, maxsize - self.window_size)
+        self.protected_size = int(self.main_size * 0.8)
+        self.sketch = FrequencySketch(maxsize)
+        self._window = OrderedDict()
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+
+    def _lookup(self, key):
+        self.sketch.increment(key)
+        if key in self._window:
+            self._window.move_to_end(key)
+            return True, self._window[key]
+        if key in self._protected:
+            self._protected.move_to_end(key)
+            return True, self._protected[key]
+        if key in self._probation:
+            result = self._protected[key] = self._probation.pop(key)
+            if len(self._protected) > self.protected_size:
+                demoted, demoted_result = self._protected.popitem(last=False)
+                self._probation[demoted] = demoted_result
+            return True, result
+        return False, None
+
+    def _store(self, key, result):
+        self._remove(key)
+        self._window[key] = result
+        if len(self._window) <= self.window_size:
+            return
+        candidate, candidate_result = self._window.popitem(last=False)
+        if len(self._probation) + len(self._protected) < self.main_size:
+            self._probation[candidate] = candidate_result
+            return
+        self.evictions += 1
+        victims = self._probation or self._protected
+        if not victims:
+            return
+        victim = next(iter(victims))
+        if self.sketch.frequency(candidate) > self.sketch.frequency(victim):
+            del victims[victim]
+            self._probation[candidate] = candidate_result
+
+    def _remove(self, key):
+        for segment in (self._window, self._probation, self._protected):
+            segment.pop(key, None)
+
+    def _clear(self):
+        self._window.clear()
+        self._probation.clear()
+        self._protected.clear()
+
+    def _keys(self):
+        return list(self._window) + list(self._probation) + list(self._protected)
+
+    def _size(self):
+        return len(self._window) + len(self._probation) + len(self._protected)
+
+
+class MMapCache(AllowanceCacheBackend):
+    """
+    Cache of Guard answers in a memory-mapped file at `path` that is shared by all the processes opening it
+    (e.g. prefork server workers), so an answer computed by one process is a hit for all the others.
+
+    The file is an open-addressing hash table of `maxsize` slots (65536 by default) keyed by a stable digest
+    of an Inquiry. Each slot is looked for among `probes` slots next to the home one; when all of them are taken
+    one of them is overwritten. Slots are tagged with a generation number stored in the file header
+    and invalidation just increments it, which makes all the cached answers stale for all the processes at once.
+    Separate answers can't be invalidated, so `invalidate_where` invalidates everything as well.
+    Slots are written without locks: each one has a checksum and torn slots are treated as misses.
+
+    `maxsize` is used only by the process that creates the file, others use the size the file was created with.
+    Wrapped function must accept Inquiries and only boolean results are cached.
+    `hits`, `misses` and `evictions` are counted per process.
+    """
+    # magic, generation, number of slots
+    HEADER = struct.Struct('<8sQI4x')
+    MAGIC = b'VAKTAC01'
+    # inquiry digest, generation, answer (1 - deny, 2 - allow), checksum of the preceding fields
+    SLOT = struct.Struct('<16sQB3xI')
+    probes = 8
+
+    def __init__(self, **kwargs):
+        self.path = kwargs['path']
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._buf = self._map(kwargs.get('maxsize', 65536))
+        magic, _, self.maxsize = self.HEADER.unpack_from(self._buf)
+        if magic != self.MAGIC:
+            raise ValueError('%s is not a vakt cache file' % self.path)
+
+    def wrap(self, func):
+        @wraps(func)
+        def cached(inquiry):
+            digest = self._digest(inquiry)
+            generation = self._generation()
+            idx = self._find(digest, generation)
+            if idx is not None:
+                self._count('hits')
+                return self._read_slot(idx)[2] == 2
+            self._count('misses')
+            result = func(inquiry)
+            if isinstance(result, bool):
+                self._store(digest, generation, result)
+            return result
+        return cached
+
+    def invalidate(self):
+        with self.lock:
+            self.HEADER.pack_into(self._buf, 0, self.MAGIC, self._generation() + 1, self.maxsize)
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        generation = self._generation()
+        size = sum(1 for i in range(self.maxsize) if self._is_valid(self._read_slot(i), generation))
+        return CacheInfo(self.hits, self.misses, self.maxsize, size, self.evictions)
+
+    def close(self):
+        """
+        Unmap the cache file
+        """
+        self._buf.close()
+
+    def _map(self, maxsize):
+        """
+        Map the cache file creating it if it doesn't exist yet.
+        """
+        if not os.path.exists(self.path):
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, 1, maxsize))
+                f.truncate(self.HEADER.size + self.SLOT.size * maxsize)
+            try:
+                # unlike rename, link doesn't replace a file that other process has created meanwhile
+                os.link(tmp_path, self.path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+        with open(self.path, 'r+b') as f:
+            return mmap.mmap(f.fileno(), 0)
+
+    def _generation(self):
+        return self.HEADER.unpack_from(self._buf)[1]
+
+    def _slots(self, digest):
+        home = int.from_bytes(digest[:8], 'little')
+        return [(home + i) % self.maxsize for i in range(min(self.probes, self.maxsize))]
+
+    def _find(self, digest, generation):
+        for idx in self._slots(digest):
+            slot = self._read_slot(idx)
+            if slot[0] == digest and self._is_valid(slot, generation):
+                return idx
+        return None
+
+    def _store(self, digest, generation, result):
+        slots = self._slots(digest)
+        for idx in slots:
+            slot = self._read_slot(idx)
+            if slot[0] == digest or not self._is_valid(slot, self._generation()):
+                break
+        else:
+            idx = slots[digest[8] % len(slots)]
+            self._count('evictions')
+        fields = (digest, generation, 2 if result else 1)
+        self.SLOT.pack_into(self._buf, self._offset(idx), *(fields + (self._checksum(fields),)))
+
+    def _read_slot(self, idx):
+        return self.SLOT.unpack_from(self._buf, self._offset(idx))
+
+    def _offset(self, idx):
+        return self.HEADER.size + self.SLOT.size * idx
+
+    def _is_valid(self, slot, generation):
+        return slot[1] == generation and slot[2] in (1, 2) and slot[3] == self._checksum(slot[:3])
+
+    def _count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @classmethod
+    def _checksum(cls, fields):
+        return zlib.crc32(cls.SLOT.pack(*(tuple(fields) + (0,)))[:-4])
+
+    @staticmethod
+    def _digest(inquiry):
+        return hashlib.sha1(inquiry.to_json_sorted().encode('utf-8')).digest()[:16]
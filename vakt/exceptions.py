@@ -33,3 +33,8 @@ class UnknownCheckerType(Exception):
 class Irreversible(Exception):
     """Storage migration can't convert record back to a lower version."""
     pass
+
+
+class ReadOnlyStorageError(Exception):
+    """Mutation was attempted on a Storage that was opened only for reading."""
+    pass
@@ -86,6 +86,12 @@ class Guard:
         Is not meant to be called by an end-user. Use it only if you want the core functionality of allowance check.
         """
         try:
+            find_fitting = getattr(self.storage, 'find_fitting_for_inquiry', None)
+            found = find_fitting(inquiry, self.checker) if find_fitting else None
+            if found is not None:
+                # Storage has matched policies by the checker itself: only context of some of them is left to check
+                fitting, candidates = found
+                return self.check_policies_allow(inquiry, candidates, fitting)
             policies = self.storage.find_for_inquiry(inquiry, self.checker)
             # A safe guard against custom Storages that may return None instead of an empty list
             if policies is None:
@@ -99,16 +105,64 @@ class Guard:
             answer = False
         return answer
 
-    def check_policies_allow(self, inquiry, policies):
+    def is_allowed_many(self, inquiries):
         """
-        Check if any of a given policy allows a specified inquiry
+        Are given inquiries intents allowed or not?
+        Same as `is_allowed` for each inquiry, but candidate policies for all of them are fetched from the storage
+        at once with `find_for_inquiries` which storages can do in one query.
+        Returns list of answers in the order of inquiries.
+        """
+        inquiries = list(inquiries)
+        answers = self.is_allowed_many_check(inquiries)
+        for inquiry, answer in zip(inquiries, answers):
+            if answer:
+                log.info('Incoming Inquiry was allowed. Inquiry: %s', inquiry)
+            else:
+                log.info('Incoming Inquiry was rejected. Inquiry: %s', inquiry)
+        return answers
+
+    def is_allowed_many_check(self, inquiries):
+        """
+        Are given inquiries intents allowed or not?
+        Does not log answers to 'vakt.guard' log-stream.
+        Is not meant to be called by an end-user. Use it only if you want the core functionality of allowance check.
+        """
+        inquiries = list(inquiries)
+        candidates = [[] for _ in inquiries]
+        try:
+            found = self.storage.find_for_inquiries(inquiries, self.checker)
+            # A safe guard against custom Storages that may return None instead of an empty list
+            if found is None:
+                log.error('Storage returned None, but is supposed to return at least an empty list')
+                return [False] * len(inquiries)
+            for i, policy in found:
+                candidates[i].append(policy)
+        except Exception:
+            log.exception('Unexpected exception occurred while finding Policies for Inquiries %s', inquiries)
+            return [False] * len(inquiries)
+        answers = []
+        for inquiry, policies in zip(inquiries, candidates):
+            try:
+                answer = self.check_policies_allow(inquiry, policies)
+            except Exception:
+                log.exception('Unexpected exception occurred while checking Inquiry %s', inquiry)
+                answer = False
+            answers.append(answer)
+        return answers
+
+    def check_policies_allow(self, inquiry, policies, fitting=()):
+        """
+        Check if any of a given policy allows a specified inquiry.
+        `fitting` are policies that are already known to fit the inquiry, so they aren't checked again.
         """
         # Filter policies that fit Inquiry by its attributes.
-        filtered = [p for p in policies if
-                    self.checker.fits(p, 'actions', inquiry.action, inquiry) and
-                    self.checker.fits(p, 'subjects', inquiry.subject, inquiry) and
-                    self.checker.fits(p, 'resources', inquiry.resource, inquiry) and
-                    self.check_context_restriction(p, inquiry)]
+        filtered = list(fitting) + [
+            p for p in policies if
+            self.checker.fits(p, 'actions', inquiry.action, inquiry) and
+            self.checker.fits(p, 'subjects', inquiry.subject, inquiry) and
+            self.checker.fits(p, 'resources', inquiry.resource, inquiry) and
+            self.check_context_restriction(p, inquiry)
+        ]
 
         # no policies -> deny access!
         if len(filtered) == 0:
@@ -7,7 +7,7 @@ import re
 from .exceptions import InvalidPatternError
 
 
-__all__ = ['compile_regex']
+__all__ = ['compile_regex', 'get_literal_prefix', 'get_prefixes', 'get_ngrams']
 
 
 def compile_regex(phrase, start_tag, end_tag):
@@ -24,6 +24,38 @@ def compile_regex(phrase, start_tag, end_tag):
     return re.compile('^%s%s$' % (pattern, re.escape(raw)))
 
 
+def get_literal_prefix(phrase, start_tag, max_length=None):
+    """
+    Literal beginning of a string denoted by tags: everything before the first start tag.
+    Any value matched by a regex compiled from that string starts with it.
+    If max_length is given, prefix is cut to it, which still keeps it a prefix of matched values.
+    """
+    idx = phrase.find(start_tag)
+    prefix = phrase if idx == -1 else phrase[:idx]
+    return prefix[:max_length] if max_length is not None else prefix
+
+
+def get_prefixes(value, max_length):
+    """
+    All the prefixes of a value (including an empty one) that are not longer than max_length.
+    """
+    return [value[:i] for i in range(min(len(value), max_length) + 1)]
+
+
+def get_ngrams(value, n):
+    """
+    Distinct substrings of length n of a value in order of their first occurrence.
+    Any value that contains the given one as a substring contains all of its n-grams.
+    """
+    ngrams, seen = [], set()
+    for i in range(len(value) - n + 1):
+        ngram = value[i:i + n]
+        if ngram not in seen:
+            seen.add(ngram)
+            ngrams.append(ngram)
+    return ngrams
+
+
 def get_tag_indices(string, start, end):
     """
     Find and return list of tag indices in the given string.
@@ -53,7 +53,17 @@ class Policy(JsonSerializer, PrettyPrint):
 
     @classmethod
     def from_json(cls, data):
-        props = cls._parse(data)
+        return cls._from_props(cls._parse(data))
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls._from_props(cls._restore(data))
+
+    @classmethod
+    def _from_props(cls, props):
+        """
+        Create policy from its restored properties
+        """
         if 'uid' not in props:
             log.error("Error creating policy from json. 'uid' attribute is required")
             raise PolicyCreationError("Error creating policy from json. 'uid' attribute is required")
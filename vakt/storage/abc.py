@@ -41,14 +41,30 @@ class Storage(metaclass=ABCMeta):
 
         Returns generator
         """
-        limit, offset = batch, 0
+        token = None
         while True:
-            policies = list(self.get_all(limit, offset))
+            policies, token = self._get_batch(batch, token)
+            policies = list(policies)
             if len(policies) == 0:
                 return
             for policy in policies:
                 yield policy
-            offset = offset + limit
+            if token is None:
+                return
+
+    def _get_batch(self, limit, token):
+        """
+        Retrieve the next batch of policies for `retrieve_all` starting from a continuation token.
+        Token is None for the first batch, further it's the value returned by the previous call.
+
+        Default implementation uses offset as a token and pages through `get_all`.
+        Storages that can do better (e.g. keyset pagination on `uid`) should override it
+        in order to stream all the policies in linear time.
+
+        Returns tuple of (Iterable of policies, next token or None if there are no more policies)
+        """
+        offset = token or 0
+        return self.get_all(limit, offset), offset + limit
 
     @abstractmethod
     def find_for_inquiry(self, inquiry, checker=None):
@@ -66,6 +82,36 @@ class Storage(metaclass=ABCMeta):
         """
         pass
 
+    def find_for_inquiries(self, inquiries, checker=None):
+        """
+        Get potential policies for many inquiries at once.
+        The same as `find_for_inquiry`, but each returned policy is tagged with an index of the inquiry
+        it's a candidate for. A policy is returned once for each of the inquiries it's a candidate for.
+
+        Default implementation simply calls `find_for_inquiry` for each inquiry, but concrete storages
+        are encouraged to override it with the one that fetches candidates for all the inquiries in one query.
+
+        Returns Iterable of (inquiry index, policy) tuples
+        """
+        for i, inquiry in enumerate(inquiries):
+            for policy in self.find_for_inquiry(inquiry, checker):
+                yield i, policy
+
+    def find_fitting_for_inquiry(self, inquiry, checker=None):
+        """
+        Get policies that fit a given inquiry, if storage can match them by the checker exactly.
+        Unlike `find_for_inquiry` it's not a list of candidates: storage does the checker's work itself,
+        so that Guard doesn't need to check those policies again.
+
+        Returns tuple of (fitting policies without context, policies with context that fit the inquiry
+        by the checker, but whose context should be checked) or None if storage can't match policies exactly
+        for the given checker, in this case Guard checks policies returned by `find_for_inquiry`.
+        Since any fitting policy with deny effect decides on the inquiry, storage can return only one such policy.
+
+        Default implementation returns None.
+        """
+        return None
+
     @abstractmethod
     def update(self, policy):
         """Update a policy"""
@@ -76,6 +122,32 @@ class Storage(metaclass=ABCMeta):
         """Delete a policy"""
         pass
 
+    def add_many(self, policies):
+        """
+        Store many policies at once.
+        Default implementation simply calls `add` for each policy, but concrete storages are encouraged
+        to override it with a more efficient batched one.
+        Whether a batch is stored atomically if some of the policies already exist is up to the storage.
+        """
+        for policy in policies:
+            self.add(policy)
+
+    def update_many(self, policies):
+        """
+        Update many policies at once.
+        Default implementation simply calls `update` for each policy.
+        """
+        for policy in policies:
+            self.update(policy)
+
+    def delete_many(self, uids):
+        """
+        Delete many policies at once.
+        Default implementation simply calls `delete` for each uid.
+        """
+        for uid in uids:
+            self.delete(uid)
+
     @staticmethod
     def _check_limit_and_offset(limit, offset):
         if limit < 0:
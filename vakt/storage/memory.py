@@ -13,11 +13,19 @@ log = logging.getLogger(__name__)
 
 
 class MemoryStorage(Storage):
-    """Stores all policies in memory"""
+    """
+    Stores all policies in memory.
+
+    Writers mutate `policies` under a lock and invalidate the published snapshot.
+    Readers iterate an immutable snapshot (a tuple of policies) that is rebuilt lazily by the first read
+    after a mutation and then shared by all readers without any locking.
+    So iterating the result of `find_for_inquiry` or `get_all` is always safe even under concurrent mutations.
+    """
 
     def __init__(self):
         self.policies = {}
         self.lock = threading.Lock()
+        self._snapshot = ()
 
     def add(self, policy):
         uid = policy.uid
@@ -26,27 +34,87 @@ class MemoryStorage(Storage):
                 log.error('Error trying to create already existing policy with UID=%s', uid)
                 raise PolicyExistsError(uid)
             self.policies[uid] = policy
-            log.info('Added Policy: %s', policy)
+            self._snapshot = None
+        log.info('Added Policy: %s', policy)
 
     def get(self, uid):
         return self.policies.get(uid)
 
     def get_all(self, limit, offset):
         self._check_limit_and_offset(limit, offset)
-        result = [v for v in self.policies.values()]
+        result = self._get_snapshot()
         if offset > len(result) or limit == 0:
             return []
-        return result[offset:limit+offset]
+        return list(result[offset:limit+offset])
+
+    def retrieve_all(self, batch=50):
+        self._check_limit_and_offset(batch, 0)
+        if batch == 0:
+            return
+        # all policies are already in memory, so batching makes no sense: just stream the snapshot
+        for policy in self._get_snapshot():
+            yield policy
 
     def find_for_inquiry(self, inquiry, checker=None):
-        with self.lock:
-            return self.policies.values()
+        return self._get_snapshot()
 
     def update(self, policy):
-        self.policies[policy.uid] = policy
+        with self.lock:
+            self.policies[policy.uid] = policy
+            self._snapshot = None
         log.info('Updated Policy with UID=%s. New value is: %s', policy.uid, policy)
 
     def delete(self, uid):
-        if uid in self.policies:
+        with self.lock:
+            if uid not in self.policies:
+                return
             del self.policies[uid]
-            log.info('Policy with UID %s was deleted', uid)
+            self._snapshot = None
+        log.info('Policy with UID %s was deleted', uid)
+
+    def add_many(self, policies):
+        policies = list(policies)
+        with self.lock:
+            # check all the policies first so that either all or none of them are added
+            seen = set()
+            for policy in policies:
+                if policy.uid in self.policies or policy.uid in seen:
+                    log.error('Error trying to create already existing policy with UID=%s', policy.uid)
+                    raise PolicyExistsError(policy.uid)
+                seen.add(policy.uid)
+            for policy in policies:
+                self.policies[policy.uid] = policy
+            self._snapshot = None
+        log.info('Added %d Policies', len(policies))
+
+    def update_many(self, policies):
+        policies = list(policies)
+        with self.lock:
+            for policy in policies:
+                self.policies[policy.uid] = policy
+            self._snapshot = None
+        log.info('Updated %d Policies', len(policies))
+
+    def delete_many(self, uids):
+        with self.lock:
+            deleted = 0
+            for uid in uids:
+                if uid in self.policies:
+                    del self.policies[uid]
+                    deleted += 1
+            if deleted:
+                self._snapshot = None
+        log.info('%d Policies were deleted', deleted)
+
+    def _get_snapshot(self):
+        """
+        Get the current immutable snapshot of all the stored policies.
+        Builds a new one only if policies were mutated since the last snapshot was published.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self.lock:
+                if self._snapshot is None:
+                    self._snapshot = tuple(self.policies.values())
+                snapshot = self._snapshot
+        return snapshot
@@ -4,6 +4,7 @@ Migration utilities for Storage Migrations
 
 from abc import ABCMeta, abstractmethod
 import logging
+import time
 
 
 log = logging.getLogger(__name__)
@@ -31,6 +32,39 @@ class Migration(metaclass=ABCMeta):
         pass
 
 
+class MigrationProgress:
+    """
+    Reports throughput of a migration that processes policies in batches.
+    Each report is logged, `report` callback is also called with the progress itself if given.
+    """
+
+    def __init__(self, name, report=None):
+        self.name = name
+        self.report = report
+        self.processed = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    @property
+    def rate(self):
+        """
+        Number of processed policies per second
+        """
+        elapsed = time.monotonic() - self.started
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def advance(self, processed, failed=0):
+        """
+        Add a processed batch and report the progress
+        """
+        self.processed += processed
+        self.failed += failed
+        log.info('%s: %d policies processed (%d failed), %.1f per second',
+                 self.name, self.processed, self.failed, self.rate)
+        if self.report:
+            self.report(self)
+
+
 class MigrationSet(metaclass=ABCMeta):
     """
     Collection of migrations.
@@ -0,0 +1,395 @@
+"""
+Memory-mapped file Storage for Policies that is shared between processes.
+"""
+
+import os
+import json
+import mmap
+import struct
+import logging
+import threading
+import contextlib
+from collections import OrderedDict
+
+import jsonpickle
+
+from ..storage.abc import Storage
+from ..exceptions import PolicyExistsError, UnknownCheckerType, ReadOnlyStorageError
+from ..checker import StringExactChecker, StringFuzzyChecker, RegexChecker, RulesChecker
+from ..policy import Policy, TYPE_STRING_BASED, TYPE_RULE_BASED
+
+
+log = logging.getLogger(__name__)
+
+
+# magic, generation of the currently published data file
+CONTROL_HEADER = struct.Struct('<8sQ')
+CONTROL_MAGIC = b'VAKTCTL1'
+# magic, number of records
+DATA_HEADER = struct.Struct('<8sI')
+DATA_MAGIC = b'VAKTDAT1'
+# offset of a record, length of uid key, length of policy JSON, policy type
+DATA_ENTRY = struct.Struct('<QIIB')
+
+
+class MMapStorage(Storage):
+    """
+    Stores all policies in memory-mapped files that are shared by many processes (e.g. prefork server workers).
+
+    Only one process should open the storage with `writer=True` and apply add/update/delete to it.
+    Every mutation (or a batch of them for `add_many`, `update_many`, `delete_many`) is published as a new
+    immutable data file, after which a generation counter in a small control file located at `path` is incremented.
+    Readers compare that counter with the one they've seen last on each read and if it changed
+    they map the new data file. Thus the encoded policy-set lives once in the OS page cache for all the processes
+    and readers never need to be reloaded.
+
+    Since each publication rewrites the whole policy-set, loading policies one by one takes quadratic time.
+    Use batch methods for bulk loads, or make single mutations inside `with storage.bulk():` that publishes
+    all of them at once on exit.
+
+    Policies are decoded lazily - only those returned by a read - and are kept in a per-process cache
+    of at most `cache_size` policies (None means unbounded). For string-based checkers most of the policies
+    are filtered out without decoding at all.
+    """
+
+    def __init__(self, path, writer=False, cache_size=None):
+        self.path = path
+        self.writer = writer
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self._control = None
+        self._data = None
+        self._decoded = OrderedDict()
+        # Used only by writer: uid key -> (policy type, encoded policy)
+        self._records = {}
+        # Used only by writer: depth of nested `bulk` blocks and whether they have changes to publish
+        self._bulk_depth = 0
+        self._unpublished = False
+        if writer:
+            self._init_writer()
+        else:
+            self._control = self._map_control(mmap.ACCESS_READ)
+
+    def add(self, policy):
+        self._check_writer()
+        key = self._key(policy.uid)
+        with self.lock:
+            if key in self._records:
+                log.error('Error trying to create already existing policy with UID=%s.', policy.uid)
+                raise PolicyExistsError(policy.uid)
+            self._records[key] = self._encode(policy)
+            self._publish_changes()
+        log.info('Added Policy: %s', policy)
+
+    def get(self, uid):
+        data = self._current_data()
+        idx = data.find(self._key(uid))
+        if idx is None:
+            return None
+        return self._decode(data.record(idx))
+
+    def get_all(self, limit, offset):
+        self._check_limit_and_offset(limit, offset)
+        data = self._current_data()
+        return [self._decode(data.record(i)) for i in range(offset, min(offset + limit, data.count))]
+
+    def find_for_inquiry(self, inquiry, checker=None):
+        policy_type, needles = self._create_filter(inquiry, checker)
+        data = self._current_data()
+        for i in range(data.count):
+            if data.matches(i, policy_type, needles):
+                yield self._decode(data.record(i))
+
+    def update(self, policy):
+        self._check_writer()
+        key = self._key(policy.uid)
+        with self.lock:
+            if key not in self._records:
+                return
+            self._records[key] = self._encode(policy)
+            self._publish_changes()
+        log.info('Updated Policy with UID=%s. New value is: %s', policy.uid, policy)
+
+    def delete(self, uid):
+        self._check_writer()
+        key = self._key(uid)
+        with self.lock:
+            if key not in self._records:
+                return
+            del self._records[key]
+            self._publish_changes()
+        log.info('Deleted Policy with UID=%s.', uid)
+
+    def add_many(self, policies):
+        self._check_writer()
+        records = [(self._key(p.uid), p) for p in policies]
+        with self.lock:
+            seen = set()
+            for key, policy in records:
+                if key in self._records or key in seen:
+                    log.error('Error trying to create already existing policy with UID=%s.', policy.uid)
+                    raise PolicyExistsError(policy.uid)
+                seen.add(key)
+            for key, policy in records:
+                self._records[key] = self._encode(policy)
+            self._publish_changes()
+        log.info('Added %d Policies', len(records))
+
+    def update_many(self, policies):
+        self._check_writer()
+        records = [(self._key(p.uid), p) for p in policies]
+        with self.lock:
+            records = [(key, policy) for key, policy in records if key in self._records]
+            if not records:
+                return
+            for key, policy in records:
+                self._records[key] = self._encode(policy)
+            self._publish_changes()
+        log.info('Updated %d Policies', len(records))
+
+    def delete_many(self, uids):
+        self._check_writer()
+        keys = [self._key(uid) for uid in uids]
+        with self.lock:
+            keys = [key for key in keys if key in self._records]
+            if not keys:
+                return
+            for key in keys:
+                del self._records[key]
+            self._publish_changes()
+        log.info('Deleted %d Policies', len(keys))
+
+    @contextlib.contextmanager
+    def bulk(self):
+        """
+        Context manager that publishes all the mutations made inside it at once on exit.
+        Until then neither readers nor the writer itself see them.
+        """
+        self._check_writer()
+        with self.lock:
+            self._bulk_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self._bulk_depth -= 1
+                if self._bulk_depth == 0 and self._unpublished:
+                    self._publish()
+
+    def _create_filter(self, inquiry, checker):
+        """
+        Returns policy type that candidates should have and byte-strings that candidates should contain,
+        based on the checker type.
+        """
+        if isinstance(checker, (StringFuzzyChecker, StringExactChecker)):
+            # Both checkers need an inquiry value to be a substring of a policy element.
+            # JSON escaping is done per character, so the escaped value must be a substring of the encoded policy.
+            needles = []
+            for value in (inquiry.action, inquiry.subject, inquiry.resource):
+                if isinstance(value, str) and value:
+                    needles.append(json.dumps(value)[1:-1].encode('ascii'))
+            return TYPE_STRING_BASED, needles
+        elif isinstance(checker, RegexChecker):
+            return TYPE_STRING_BASED, []
+        elif isinstance(checker, RulesChecker):
+            return TYPE_RULE_BASED, []
+        elif not checker:
+            return None, []
+        else:
+            log.error('Provided Checker type is not supported.')
+            raise UnknownCheckerType(checker)
+
+    def _check_writer(self):
+        if not self.writer:
+            raise ReadOnlyStorageError('%s at %s is opened only for reading' % (type(self).__name__, self.path))
+
+    def _init_writer(self):
+        """
+        Restore policies from already published data if any, otherwise publish an empty policy-set.
+        """
+        if not os.path.exists(self.path):
+            self._publish()
+            return
+        self._control = self._map_control(mmap.ACCESS_WRITE)
+        data = self._current_data()
+        for i in range(data.count):
+            self._records[data.key(i)] = (data.type(i), data.record(i))
+
+    def _publish_changes(self):
+        """
+        Publish changed records unless they are made inside `bulk` block.
+        Must be called by writer under the lock.
+        """
+        if self._bulk_depth:
+            self._unpublished = True
+        else:
+            self._publish()
+
+    def _publish(self):
+        """
+        Write all the policies into a new data file and point readers to it.
+        Must be called by writer only.
+        """
+        self._unpublished = False
+        generation = self._read_generation() + 1 if self._control is not None else 1
+        data_path = self._data_path(generation)
+        self._write_file(data_path, self._encode_records())
+        if self._control is None:
+            self._write_file(self.path, CONTROL_HEADER.pack(CONTROL_MAGIC, generation))
+            self._control = self._map_control(mmap.ACCESS_WRITE)
+        else:
+            CONTROL_HEADER.pack_into(self._control, 0, CONTROL_MAGIC, generation)
+            self._control.flush()
+        # Keep the previous data file for readers that have just read the previous generation number.
+        self._remove_file(self._data_path(generation - 2))
+
+    def _encode_records(self):
+        """
+        Encode all the writer's records into data file contents. Records are sorted by uid key.
+        """
+        keys = sorted(self._records)
+        offset = DATA_HEADER.size + DATA_ENTRY.size * len(keys)
+        index, blobs = [DATA_HEADER.pack(DATA_MAGIC, len(keys))], []
+        for key in keys:
+            policy_type, record = self._records[key]
+            index.append(DATA_ENTRY.pack(offset, len(key), len(record), policy_type))
+            blobs.append(key)
+            blobs.append(record)
+            offset += len(key) + len(record)
+        return b''.join(index + blobs)
+
+    def _current_data(self):
+        """
+        Get data file of the current generation. Maps a new one if writer has published it.
+        """
+        generation = self._read_generation()
+        data = self._data
+        if data is not None and data.generation == generation:
+            return data
+        with self.lock:
+            if self._data is None or self._data.generation != generation:
+                self._data = self._map_data(generation)
+            return self._data
+
+    def _map_data(self, generation):
+        while True:
+            try:
+                with open(self._data_path(generation), 'rb') as f:
+                    return _DataFile(generation, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            except FileNotFoundError:
+                # writer has moved further and removed the data file, so try the newest one
+                newest = self._read_generation()
+                if newest == generation:
+                    raise
+                generation = newest
+
+    def _map_control(self, access):
+        with open(self.path, 'r+b' if access == mmap.ACCESS_WRITE else 'rb') as f:
+            control = mmap.mmap(f.fileno(), CONTROL_HEADER.size, access=access)
+        if CONTROL_HEADER.unpack_from(control)[0] != CONTROL_MAGIC:
+            raise ValueError('%s is not a vakt policies control file' % self.path)
+        return control
+
+    def _read_generation(self):
+        return CONTROL_HEADER.unpack_from(self._control)[1]
+
+    def _data_path(self, generation):
+        return '%s.%d' % (self.path, generation)
+
+    def _decode(self, record):
+        """
+        Decode a policy using per-process cache of already decoded policies.
+        """
+        with self.lock:
+            policy = self._decoded.get(record)
+            if policy is not None:
+                self._decoded.move_to_end(record)
+                return policy
+        policy = Policy.from_json(record.decode('ascii'))
+        with self.lock:
+            self._decoded[record] = policy
+            if self.cache_size is not None and len(self._decoded) > self.cache_size:
+                self._decoded.popitem(last=False)
+        return policy
+
+    @staticmethod
+    def _encode(policy):
+        # re-dump with default options to be sure that record is ASCII-only and is escaped the canonical way
+        return policy.type, json.dumps(json.loads(policy.to_json())).encode('ascii')
+
+    @staticmethod
+    def _key(uid):
+        return jsonpickle.encode(uid).encode('utf-8')
+
+    @staticmethod
+    def _write_file(path, contents):
+        """
+        Atomically write a file, so that readers never see it partially written.
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            log.warning('Unable to remove stale policies data file %s', path)
+
+
+class _DataFile:
+    """
+    Read-only view of a memory-mapped data file of a specific generation.
+    """
+
+    def __init__(self, generation, buf):
+        magic, self.count = DATA_HEADER.unpack_from(buf)
+        if magic != DATA_MAGIC:
+            raise ValueError('Data file of generation %d is not a vakt policies data file' % generation)
+        self.generation = generation
+        self.buf = buf
+
+    def _entry(self, idx):
+        return DATA_ENTRY.unpack_from(self.buf, DATA_HEADER.size + DATA_ENTRY.size * idx)
+
+    def key(self, idx):
+        offset, key_len, _, _ = self._entry(idx)
+        return self.buf[offset:offset + key_len]
+
+    def type(self, idx):
+        return self._entry(idx)[3]
+
+    def record(self, idx):
+        offset, key_len, record_len, _ = self._entry(idx)
+        start = offset + key_len
+        return self.buf[start:start + record_len]
+
+    def matches(self, idx, policy_type, needles):
+        """
+        Does record possibly match the given policy type and contain all the needles?
+        """
+        offset, key_len, record_len, record_type = self._entry(idx)
+        if policy_type is not None and policy_type != record_type:
+            return False
+        start = offset + key_len
+        end = start + record_len
+        return all(self.buf.find(needle, start, end) != -1 for needle in needles)
+
+    def find(self, key):
+        """
+        Binary search of a record index by its uid key. Returns None if nothing was found.
+        """
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.key(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.count and self.key(low) == key:
+            return low
+        return None
@@ -2,27 +2,49 @@
 MongoDB Storage and Migrations for Policies.
 """
 
+import re
+import json
 import logging
 import copy
+import threading
 from abc import ABCMeta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
 
 import bson.json_util as b_json
 import pymongo
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 import jsonpickle.tags
 
 from ..storage.abc import Storage
-from ..storage.migration import Migration, MigrationSet
+from ..storage.migration import Migration, MigrationSet, MigrationProgress
 from ..exceptions import PolicyExistsError, UnknownCheckerType, Irreversible
 from ..policy import Policy
 from ..rules.base import Rule
 from ..checker import StringExactChecker, StringFuzzyChecker, RegexChecker, RulesChecker
 from ..policy import TYPE_STRING_BASED, TYPE_RULE_BASED
-from ..parser import compile_regex
+from ..effects import ALLOW_ACCESS
+from ..parser import compile_regex, get_literal_prefix, get_prefixes
+from .rule_constraints import get_policy_constraints, get_value_tokens
+from .policy_cache import PolicyCache, get_etag
 
 
 DEFAULT_COLLECTION = 'vakt_policies'
 DEFAULT_MIGRATION_COLLECTION = 'vakt_policies_migration_version'
+DUPLICATE_KEY_ERROR_CODE = 11000
+# Max length of a literal prefix of policy elements that is stored in the index
+PREFIX_LENGTH = 32
+# Tags of regexes in elements of string-based policies
+START_TAG, END_TAG = '<', '>'
+# Max length of a rule constraints token that is stored in the index
+TOKEN_LENGTH = 255
+# Token stored for policy elements without constraints: they fit any inquiry value
+NO_CONSTRAINTS_TOKEN = '*'
+# Max number of inquiries whose pipelines are combined with $facet into one aggregation.
+# Result of $facet is a single document, so it must fit into 16MB BSON document limit.
+MAX_INQUIRIES_IN_FACET = 50
 
 log = logging.getLogger(__name__)
 
@@ -30,53 +52,204 @@ log = logging.getLogger(__name__)
 class MongoStorage(Storage):
     """Stores all policies in MongoDB"""
 
-    def __init__(self, client, db_name, collection=DEFAULT_COLLECTION):
+    def __init__(self, client, db_name, collection=DEFAULT_COLLECTION, cache_size=1024, server_side_decisions=False):
+        """
+        Initialize Mongo Storage
+
+        :param cache_size: max number of decoded policies kept for `find_for_inquiry`. 0 turns the cache off
+        :param server_side_decisions: match policies by string-based checkers exactly inside the aggregation,
+                                      so that Guard checks only context of the found policies
+                                      (see `find_fitting_for_inquiry`)
+        """
         self.client = client
         self.database = self.client[db_name]
         self.collection = self.database[collection]
-        self.db_server_version = tuple(map(int, client.server_info()['version'].split('.')))
+        # version is fetched on the first query, so that creating a storage doesn't make a round-trip
+        self._db_server_version = None
         self.condition_fields = [
             'actions',
             'subjects',
             'resources',
         ]
         self.condition_field_compiled_name = lambda x: '%s_compiled_regex' % x
+        self.condition_field_prefix_name = lambda x: '%s_literal_prefix' % x
+        self.condition_field_constraints_name = lambda x: '%s_rule_constraints' % x
+        self.condition_field_tokens_name = lambda x: '%s_rule_tokens' % x
+        self.etag_field = 'etag'
+        self.cache = PolicyCache(cache_size)
+        self.server_side_decisions = server_side_decisions
+        # migrations that run online: documents are read in both the old and the new shape until they complete
+        self.online_migrations = []
+        # fields that are needed only to query policies aren't fetched for decoding
+        self.read_projection = {
+            name(field): False
+            for field in self.condition_fields
+            for name in (self.condition_field_compiled_name,
+                         self.condition_field_prefix_name,
+                         self.condition_field_constraints_name,
+                         self.condition_field_tokens_name)
+        }
+        # fields of string-based policies that are needed to match regexes on the client side
+        self.client_match_fields = self.condition_fields + [
+            self.condition_field_compiled_name(field) for field in self.condition_fields
+        ]
+
+    @property
+    def db_server_version(self):
+        """
+        Version of MongoDB server as a tuple of numbers
+        """
+        if self._db_server_version is None:
+            self._db_server_version = tuple(map(int, self.client.server_info()['version'].split('.')))
+        return self._db_server_version
+
+    @db_server_version.setter
+    def db_server_version(self, version):
+        self._db_server_version = version
 
     def add(self, policy):
         try:
-            self.collection.insert_one(self.__prepare_doc(policy))
+            self.collection.insert_one(self._prepare_doc(policy))
         except DuplicateKeyError:
             log.error('Error trying to create already existing policy with UID=%s.', policy.uid)
             raise PolicyExistsError(policy.uid)
         log.info('Added Policy: %s', policy)
 
     def get(self, uid):
-        ret = self.collection.find_one(uid)
+        ret = self.collection.find_one(uid, projection=self.read_projection)
         if not ret:
             return None
-        return self.__prepare_from_doc(ret)
+        return self._prepare_from_doc(ret)
 
     def get_all(self, limit, offset):
         self._check_limit_and_offset(limit, offset)
         # Special check for: https://docs.mongodb.com/manual/reference/method/cursor.limit/#zero-value
         if limit == 0:
             return []
-        cur = self.collection.find(limit=limit, skip=offset, sort=[('_id', pymongo.ASCENDING)])
+        cur = self.collection.find(limit=limit, skip=offset, sort=[('_id', pymongo.ASCENDING)],
+                                   projection=self.read_projection)
         return self.__feed_policies(cur)
 
+    def retrieve_all(self, batch=50):
+        self._check_limit_and_offset(batch, 0)
+        if batch == 0:
+            return
+        # One server-side cursor that fetches `batch` documents per round-trip in order of `_id` index.
+        # Unlike paging with `skip` it doesn't rescan skipped documents, so a full scan is linear.
+        cur = self.collection.find(sort=[('_id', pymongo.ASCENDING)], batch_size=batch,
+                                   projection=self.read_projection)
+        for policy in self.__feed_policies(cur):
+            yield policy
+
     def find_for_inquiry(self, inquiry, checker=None):
+        policies = self.__find_for_inquiry(inquiry, checker)
+        pending = self.__pending_filter(inquiry, checker)
+        if pending is None:
+            return policies
+        # Documents that online migrations haven't converted yet may lack fields the queries rely on,
+        # so they are found by the queries migrations define for their old shape.
+        cur = self.collection.find(pending, projection=self.read_projection)
+        return _unique_policies(chain(policies, self.__feed_policies(cur)))
+
+    def __find_for_inquiry(self, inquiry, checker):
         q_filter, use_aggregation = self._create_filter(inquiry, checker)
+        on_client = self._matches_regex_on_client(checker)
+        if self.cache.maxsize <= 0:
+            if use_aggregation:
+                cur = self.collection.aggregate(q_filter + [{'$project': self.read_projection}])
+            elif on_client:
+                projection = {k: v for k, v in self.read_projection.items() if k not in self.client_match_fields}
+                cur = (doc for doc in self.collection.find(q_filter, projection=projection)
+                       if self.__regex_fits_on_client(doc, inquiry))
+            else:
+                cur = self.collection.find(q_filter, projection=self.read_projection)
+            return self.__feed_policies(cur)
+        # fetch only etags of matched policies, documents are fetched and decoded only for the cache misses
         if use_aggregation:
-            cur = self.collection.aggregate(q_filter)
+            cur = self.collection.aggregate(q_filter + [{'$project': {self.etag_field: True}}])
+        elif on_client:
+            projection = [self.etag_field] + self.client_match_fields
+            cur = (doc for doc in self.collection.find(q_filter, projection=projection)
+                   if self.__regex_fits_on_client(doc, inquiry))
         else:
-            cur = self.collection.find(q_filter)
-        return self.__feed_policies(cur)
+            cur = self.collection.find(q_filter, projection=[self.etag_field])
+        rows = ((doc['_id'], doc.get(self.etag_field)) for doc in cur)
+        return (policy for _, policy in self.cache.hydrate(rows, self.__fetch_policies))
+
+    def find_for_inquiries(self, inquiries, checker=None):
+        inquiries = list(inquiries)
+        if not self._finds_inquiries_at_once(inquiries, checker):
+            return super().find_for_inquiries(inquiries, checker)
+        rows = (
+            (uid, etag, start + i)
+            for start in range(0, len(inquiries), MAX_INQUIRIES_IN_FACET)
+            for uid, etag, i in self.__tag_by_inquiries(inquiries[start:start + MAX_INQUIRIES_IN_FACET], checker)
+        )
+        return ((i, policy) for (_, _, i), policy in self.cache.hydrate(rows, self.__fetch_policies))
+
+    def _finds_inquiries_at_once(self, inquiries, checker):
+        """
+        Whether policies for the inquiries are found with $facet aggregations instead of a query per inquiry.
+        """
+        # $facet is available starting with 3.4 version
+        return bool(inquiries) and self.db_server_version >= (3, 4, 0) and \
+            all(self.__pending_filter(inquiry, checker) is None for inquiry in inquiries)
+
+    def __tag_by_inquiries(self, inquiries, checker):
+        """
+        Yields (uid, etag, inquiry index) for policies found for the inquiries with one $facet aggregation.
+        """
+        on_client = self._matches_regex_on_client(checker)
+        projection = dict.fromkeys([self.etag_field] + (self.client_match_fields if on_client else []), True)
+        pipelines = []
+        for inquiry in inquiries:
+            q_filter, use_aggregation = self._create_filter(inquiry, checker)
+            pipelines.append(q_filter if use_aggregation else [{'$match': q_filter}])
+        # All the pipelines start with $match: their union is matched first using indices,
+        # then each pipeline is run on the matched documents to tag them by inquiry index.
+        # Only ids and etags are returned, so that the result fits into one document.
+        cur = self.collection.aggregate([
+            {'$match': {'$or': [p[0]['$match'] for p in pipelines]}},
+            {'$facet': {
+                str(i): p + [{'$project': projection}] for i, p in enumerate(pipelines)
+            }},
+        ])
+        tagged = next(cur)
+        for i in range(len(pipelines)):
+            for doc in tagged[str(i)]:
+                if not on_client or self.__regex_fits_on_client(doc, inquiries[i]):
+                    yield doc['_id'], doc.get(self.etag_field), i
+
+    def find_fitting_for_inquiry(self, inquiry, checker=None):
+        """
+        With `server_side_decisions` on, policies are matched by StringExactChecker, StringFuzzyChecker
+        (MongoDB >= 3.6) and RegexChecker (MongoDB >= 4.2) exactly as these checkers do it, and the aggregation
+        groups them by effect and by presence of context. Only uids and etags are returned, and only the deciding
+        policies are fetched (decoded ones are taken from the cache): if a policy with deny effect and without
+        context fits the inquiry, it's the only one that is returned.
+        Note that regexes are run by MongoDB regex engine, so policies should use syntax it shares with python.
+        """
+        # documents that aren't converted by online migrations yet can't be matched on the server side
+        pipeline = self.__fitting_pipeline(inquiry, checker) \
+            if self.server_side_decisions and not self.online_migrations else None
+        if pipeline is None:
+            return None
+        groups = {}
+        for group in self.collection.aggregate(pipeline):
+            groups[(group['_id']['allow'], group['_id']['has_context'])] = [
+                (doc['uid'], doc.get('etag')) for doc in group['policies']
+            ]
+        deny = groups.get((False, False))
+        if deny:
+            return self.__hydrate(deny[:1]), []
+        return self.__hydrate(groups.get((True, False), [])), \
+            self.__hydrate(groups.get((False, True), []) + groups.get((True, True), []))
 
     def update(self, policy):
         uid = policy.uid
         self.collection.update_one(
             {'_id': uid},
-            {"$set": self.__prepare_doc(policy)},
+            {"$set": self._prepare_doc(policy)},
             upsert=False)
         log.info('Updated Policy with UID=%s. New value is: %s', uid, policy)
 
@@ -84,6 +257,65 @@ class MongoStorage(Storage):
         self.collection.delete_one({'_id': uid})
         log.info('Deleted Policy with UID=%s.', uid)
 
+    def add_many(self, policies):
+        docs = [self._prepare_doc(p) for p in policies]
+        if not docs:
+            return
+        try:
+            self.collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            duplicates = [err['op']['_id'] for err in e.details.get('writeErrors', [])
+                          if err.get('code') == DUPLICATE_KEY_ERROR_CODE]
+            if not duplicates:
+                raise
+            log.error('Error trying to create already existing policies with UIDs=%s.', duplicates)
+            raise PolicyExistsError(duplicates[0])
+        log.info('Added %d Policies', len(docs))
+
+    def update_many(self, policies):
+        requests = [
+            pymongo.UpdateOne({'_id': p.uid}, {'$set': self._prepare_doc(p)}, upsert=False)
+            for p in policies
+        ]
+        if not requests:
+            return
+        self.collection.bulk_write(requests, ordered=False)
+        log.info('Updated %d Policies', len(requests))
+
+    def delete_many(self, uids):
+        uids = list(uids)
+        self.collection.delete_many({'_id': {'$in': uids}})
+        log.info('Deleted Policies with UIDs=%s.', uids)
+
+    def __pending_filter(self, inquiry, checker):
+        """
+        Query for documents that aren't converted by online migrations yet and may fit the inquiry,
+        or None if no migration runs online or storage queries find such documents as they are.
+        """
+        filters = []
+        for m in self.online_migrations:
+            q_filter = m.pending_candidates(inquiry, checker)
+            if q_filter is not None and q_filter not in filters:
+                filters.append(q_filter)
+        if not filters:
+            return None
+        return filters[0] if len(filters) == 1 else {'$or': filters}
+
+    def __hydrate(self, rows):
+        """
+        Get policies for (uid, etag) rows. Only the ones that aren't in the cache are fetched.
+        """
+        return [policy for _, policy in self.cache.hydrate(rows, self.__fetch_policies)]
+
+    def __fetch_policies(self, uids):
+        """
+        Get (uid, etag, policy) for policies with the given uids.
+        """
+        return [
+            (doc['_id'], doc.get(self.etag_field), self._prepare_from_doc(doc))
+            for doc in self.collection.find({'_id': {'$in': uids}}, projection=self.read_projection)
+        ]
+
     def _create_filter(self, inquiry, checker):
         """
         Returns proper query-filter based on the checker type and a flag that marks whether aggregation should be used
@@ -93,11 +325,16 @@ class MongoStorage(Storage):
         elif isinstance(checker, StringExactChecker):
             return self.__string_query_on_conditions('$eq', inquiry), False
         elif isinstance(checker, RegexChecker):
+            # $regexMatch is available starting with 4.2 version
             if self.db_server_version < (4, 2, 0):
-                return {'type': TYPE_STRING_BASED}, False
+                # candidates are narrowed by indexed literal prefixes, regexes are matched on the client side
+                return self.__prefix_query_on_conditions(inquiry), False
             return self.__regex_query_on_conditions(inquiry), True
         elif isinstance(checker, RulesChecker):
-            return {'type': TYPE_RULE_BASED}, False
+            # $expr is available in find queries starting with 3.6 version
+            if self.db_server_version < (3, 6, 0):
+                return {'type': TYPE_RULE_BASED}, False
+            return self.__rules_query_on_conditions(inquiry), False
         elif not checker:
             return {}, False
         else:
@@ -137,7 +374,8 @@ class MongoStorage(Storage):
                 '$anyElementTrue': [
                     {
                         '$map': {
-                            'input': "$%s" % self.condition_field_compiled_name(field),
+                            # documents not converted by online migration have no compiled regexes
+                            'input': {'$ifNull': ["$%s" % self.condition_field_compiled_name(field), []]},
                             'as': field_singular,
                             'in': {
                                 '$or': [
@@ -156,14 +394,180 @@ class MongoStorage(Storage):
                     }
                 ]
             })
-        return [{'$match': {'$expr': {'$and': conditions}}}]
+        # Restrict candidates with indexed literal prefixes of elements first,
+        # so that regexes are run only against documents that can be matched at all.
+        return [
+            {'$match': self.__prefix_query_on_conditions(inquiry)},
+            {'$match': {'$expr': {'$and': conditions}}},
+        ]
+
+    def __prefix_query_on_conditions(self, inquiry):
+        """
+        Construct MongoDB query that finds string-based policies whose elements' literal prefixes
+        are prefixes of the inquiry values. It's an exact match on the indexed fields,
+        and any policy that RegexChecker can find fitting has such prefixes.
+        Policies stored without literal prefixes (before Migration1x4x0To1x6x0) are matched by `null`.
+        """
+        prefix_conditions = {'type': TYPE_STRING_BASED}
+        for field in self.condition_fields:
+            inquiry_value = getattr(inquiry, field.rstrip('s'))
+            if isinstance(inquiry_value, str):
+                prefix_conditions[self.condition_field_prefix_name(field)] = {
+                    '$in': get_prefixes(inquiry_value, PREFIX_LENGTH) + [None]
+                }
+        return prefix_conditions
+
+    def _matches_regex_on_client(self, checker):
+        """
+        Should regexes of found policies be matched on the client side before the policies are decoded.
+        """
+        return isinstance(checker, RegexChecker) and self.db_server_version < (4, 2, 0)
 
-    def __prepare_doc(self, policy):
+    def __regex_fits_on_client(self, doc, inquiry):
+        """
+        Does the document fit the inquiry by compiled regexes of its elements.
+        Only documents that RegexChecker definitely doesn't find fitting are filtered out.
+        """
+        for field in self.condition_fields:
+            inquiry_value = getattr(inquiry, field.rstrip('s'))
+            compiled = doc.get(self.condition_field_compiled_name(field))
+            if not isinstance(inquiry_value, str) or compiled is None:
+                continue
+            if not any(_element_may_fit(el, pattern, inquiry_value) for el, pattern in zip(doc[field], compiled)):
+                return False
+        return True
+
+    def __fitting_pipeline(self, inquiry, checker):
+        """
+        Construct aggregation that finds policies that fit the inquiry by the checker exactly
+        and groups them by effect and by presence of context.
+        Returns None if policies can't be matched exactly for the given checker or inquiry.
+        """
+        values = [getattr(inquiry, field.rstrip('s')) for field in self.condition_fields]
+        if not all(isinstance(v, str) for v in values):
+            return None
+        # subclasses of checkers may redefine what fits
+        checker_type = type(checker)
+        if checker_type == StringExactChecker and self.db_server_version >= (3, 6, 0):
+            # elements in tags are compared without them
+            stages = [{'$match': dict(
+                [('type', TYPE_STRING_BASED)] +
+                [(field, {'$in': _exact_elements(v)}) for field, v in zip(self.condition_fields, values)]
+            )}]
+        elif checker_type == StringFuzzyChecker and self.db_server_version >= (3, 6, 0):
+            stages = [
+                {'$match': dict(
+                    [('type', TYPE_STRING_BASED)] +
+                    [(field, {'$regex': re.escape(v)}) for field, v in zip(self.condition_fields, values)]
+                )},
+                {'$match': {'$expr': {'$and': [
+                    _any_element(field, 'el', {'$gte': [{'$indexOfCP': [_without_tags('$$el'), v]}, 0]})
+                    for field, v in zip(self.condition_fields, values)
+                ]}}},
+            ]
+        elif checker_type == RegexChecker and self.db_server_version >= (4, 2, 0):
+            stages = [
+                self.__regex_query_on_conditions(inquiry)[0],
+                {'$match': {'$expr': {'$and': [
+                    self.__regex_fits(field, v) for field, v in zip(self.condition_fields, values)
+                ]}}},
+            ]
+        else:
+            return None
+        return stages + [{
+            '$group': {
+                '_id': {
+                    'allow': {'$eq': ['$effect', ALLOW_ACCESS]},
+                    'has_context': {'$gt': [{'$size': {'$objectToArray': {'$ifNull': ['$context', {}]}}}, 0]},
+                },
+                'policies': {'$push': {'uid': '$_id', 'etag': '$%s' % self.etag_field}},
+            }
+        }]
+
+    def __regex_fits(self, field, value):
+        """
+        Expression that is true if the field fits the value as RegexChecker sees it. Elements are checked in order:
+        elements without tags are compared as strings, elements with both tags are matched by their compiled regexes,
+        and an element with only one of the tags (it isn't compiled when stored) fails the whole field,
+        unless one of the previous elements already fits.
+        """
+        has_start = {'$gte': [{'$indexOfCP': ['$$el', START_TAG]}, 0]}
+        has_end = {'$gte': [{'$indexOfCP': ['$$el', END_TAG]}, 0]}
+        # element decides with true or false, null lets the next element decide
+        decision = {
+            '$cond': [
+                {'$and': [has_start, has_end]},
+                {'$cond': [{'$regexMatch': {'input': value, 'regex': '$$regex'}}, True, None]},
+                {'$cond': [{'$or': [has_start, has_end]}, False, {'$cond': [{'$eq': ['$$el', value]}, True, None]}]},
+            ]
+        }
+        return {
+            '$eq': [{
+                '$reduce': {
+                    'input': {'$zip': {'inputs': ['$%s' % field, '$%s' % self.condition_field_compiled_name(field)]}},
+                    'initialValue': None,
+                    'in': {
+                        '$cond': [
+                            {'$ne': ['$$value', None]},
+                            '$$value',
+                            {'$let': {
+                                'vars': {
+                                    'el': {'$arrayElemAt': ['$$this', 0]},
+                                    'regex': {'$arrayElemAt': ['$$this', 1]},
+                                },
+                                'in': decision,
+                            }},
+                        ]
+                    },
+                }
+            }, True]
+        }
+
+    def __rules_query_on_conditions(self, inquiry):
+        """
+        Construct MongoDB query for RulesChecker.
+        It excludes policies whose constraints extracted from simple rules definitely fail:
+        policy is a candidate if for every field at least one element has all its constraints groups
+        satisfied by the inquiry value's tokens. Policies stored without constraints are always candidates.
+        Nested constraints can be evaluated only in $expr that can't use indices, so policies are first
+        matched by indexed flat tokens: a candidate has an element without constraints or a token of the value.
+        """
+        q_filter, conditions = {'type': TYPE_RULE_BASED}, []
+        for field in self.condition_fields:
+            tokens = get_value_tokens(getattr(inquiry, field.rstrip('s')), PREFIX_LENGTH)
+            # null matches policies saved without tokens
+            q_filter[self.condition_field_tokens_name(field)] = {'$in': [None, NO_CONSTRAINTS_TOKEN] + tokens}
+            conditions.append({
+                '$anyElementTrue': [
+                    {
+                        '$map': {
+                            'input': {'$ifNull': ["$%s" % self.condition_field_constraints_name(field), [[]]]},
+                            'as': 'element',
+                            'in': {
+                                '$allElementsTrue': [
+                                    {
+                                        '$map': {
+                                            'input': '$$element',
+                                            'as': 'group',
+                                            'in': {'$gt': [{'$size': {'$setIntersection': ['$$group', tokens]}}, 0]}
+                                        }
+                                    }
+                                ]
+                            }
+                        }
+                    }
+                ]
+            })
+        q_filter['$expr'] = {'$and': conditions}
+        return q_filter
+
+    def _prepare_doc(self, policy):
         """
         Prepare Policy object as a document for insertion.
         """
-        # todo - add dict inheritance
-        doc = b_json.loads(policy.to_json())
+        # policy is converted to a dict directly, without encoding it to JSON string and parsing it back
+        doc = policy.to_dict()
+        etag = get_etag(json.dumps(doc, sort_keys=True))
         if policy.type == TYPE_STRING_BASED:
             for field in self.condition_fields:
                 compiled_regexes = []
@@ -174,27 +578,110 @@ class MongoStorage(Storage):
                         compiled = el
                     compiled_regexes.append(compiled)
                 doc[self.condition_field_compiled_name(field)] = compiled_regexes
+                doc[self.condition_field_prefix_name(field)] = [
+                    get_literal_prefix(el, policy.start_tag, PREFIX_LENGTH) for el in doc[field]
+                ]
+        for field, constraints in get_policy_constraints(policy, PREFIX_LENGTH, TOKEN_LENGTH).items():
+            doc[self.condition_field_constraints_name(field)] = constraints
+            tokens = set(token for groups in constraints for group in groups for token in group)
+            if not all(constraints):
+                tokens.add(NO_CONSTRAINTS_TOKEN)
+            doc[self.condition_field_tokens_name(field)] = sorted(tokens)
+        doc[self.etag_field] = etag
         doc['_id'] = policy.uid
         return doc
 
-    def __prepare_from_doc(self, doc):
+    def _prepare_from_doc(self, doc):
         """
         Prepare Policy object as a return from MongoDB.
         """
-        # todo - add dict inheritance
+        for migration in self.online_migrations:
+            doc = migration.read_doc(doc)
         del doc['_id']
+        if self.etag_field in doc:
+            del doc[self.etag_field]
         for field in self.condition_fields:
-            compiled_field_name = self.condition_field_compiled_name(field)
-            if compiled_field_name in doc:
-                del doc[compiled_field_name]
-        return Policy.from_json(b_json.dumps(doc))
+            for service_field_name in (self.condition_field_compiled_name(field),
+                                       self.condition_field_prefix_name(field),
+                                       self.condition_field_constraints_name(field),
+                                       self.condition_field_tokens_name(field)):
+                if service_field_name in doc:
+                    del doc[service_field_name]
+        return Policy.from_dict(doc)
 
     def __feed_policies(self, cursor):
         """
         Yields Policies from the given cursor.
         """
         for doc in cursor:
-            yield self.__prepare_from_doc(doc)
+            yield self._prepare_from_doc(doc)
+
+
+@lru_cache(maxsize=1024)
+def _compile(pattern):
+    return re.compile(pattern)
+
+
+def _element_may_fit(element, pattern, value):
+    """
+    Can RegexChecker find the element with its compiled pattern fitting the value.
+    """
+    if START_TAG not in element and END_TAG not in element:
+        return element == value
+    if START_TAG not in element or END_TAG not in element:
+        # such elements aren't compiled when stored, let RegexChecker decide on them
+        return True
+    try:
+        return _compile(pattern).match(value) is not None
+    except re.error:
+        return True
+
+
+def _unique_policies(policies):
+    """
+    Yields policies skipping the ones whose uid was already yielded.
+    """
+    seen = set()
+    for policy in policies:
+        if policy.uid not in seen:
+            seen.add(policy.uid)
+            yield policy
+
+
+def _exact_elements(value):
+    """
+    Elements that fit the value by StringExactChecker: the value itself or the value in tags.
+    String in tags is never compared as is, since checker strips its tags.
+    """
+    elements = ['%s%s%s' % (START_TAG, value, END_TAG)]
+    if not (value.startswith(START_TAG) and value.endswith(END_TAG)):
+        elements.append(value)
+    return elements
+
+
+def _without_tags(el):
+    """
+    Expression for the element without tags around it, the same way as string checkers strip them.
+    """
+    length = {'$strLenCP': el}
+    return {
+        '$cond': [
+            # $and stops at the first false expression, so an empty element doesn't get to negative index
+            {'$and': [
+                {'$eq': [{'$substrCP': [el, 0, 1]}, START_TAG]},
+                {'$eq': [{'$substrCP': [el, {'$subtract': [length, 1]}, 1]}, END_TAG]},
+            ]},
+            {'$substrCP': [el, 1, {'$subtract': [length, 2]}]},
+            el,
+        ]
+    }
+
+
+def _any_element(field, name, condition):
+    """
+    Expression that is true if the condition on the element named `name` is true for any element of the field.
+    """
+    return {'$anyElementTrue': [{'$map': {'input': '$%s' % field, 'as': name, 'in': condition}}]}
 
 
 ##############
@@ -203,21 +690,67 @@ class MongoStorage(Storage):
 
 class MongoMigrationSet(MigrationSet):
     """
-    Migrations Collection for MongoStorage
+    Migrations Collection for MongoStorage.
+    Migrations that convert policies do it in bulk writes of `batch_size` documents with `workers` threads
+    and save progress checkpoints into the same collection as the version, so an interrupted migration
+    resumes from the last converted batch. `report` is called with `MigrationProgress` after each batch.
     """
-    def __init__(self, storage, collection=DEFAULT_MIGRATION_COLLECTION):
+    def __init__(self, storage, collection=DEFAULT_MIGRATION_COLLECTION, batch_size=1000, workers=1, report=None):
         self.storage = storage
         self.collection = self.storage.database[collection]
         self.key = 'version'
         self.filter = {'_id': 'migration_version'}
+        self.batch_size = batch_size
+        self.workers = workers
+        self.report = report
+        self.online = False
 
     def migrations(self):
-        return [
+        migrations = [
             Migration0To1x1x0(self.storage),
             Migration1x1x0To1x1x1(self.storage),
             Migration1x1x1To1x2x0(self.storage),
             Migration1x2x0To1x4x0(self.storage),
+            Migration1x4x0To1x6x0(self.storage),
         ]
+        for m in migrations:
+            m.batch_size = self.batch_size
+            m.workers = self.workers
+            m.report = self.report
+            m.checkpoints = self.collection
+            m.online = self.online
+        return migrations
+
+    def pending(self, number=None):
+        """
+        Migrations that are not applied yet (or a particular one if number is given)
+        """
+        return [m for m in self._get_migrations(number) if m.order > self.last_applied()]
+
+    def up_online(self, number=None):
+        """
+        Runs migrations up in a background thread while the storage keeps serving requests.
+        Until migrations complete, the storage reads documents of both the old and the new shape
+        and treats the ones that aren't converted yet as candidates for any inquiry.
+        Storage writes policies in the new shape, version is saved only when each migration completes.
+        If migration fails, the storage stays in this mode, and migration can be resumed.
+        Returns the started thread.
+        """
+        self.storage.online_migrations = self.pending(number)
+
+        def run():
+            self.online = True
+            try:
+                self.up(number)
+            except Exception:
+                log.exception('Online migration failed. Storage keeps reading documents of both shapes')
+                return
+            finally:
+                self.online = False
+            self.storage.online_migrations = []
+        thread = threading.Thread(target=run, name='vakt-online-migration', daemon=True)
+        thread.start()
+        return thread
 
     def save_applied_number(self, number):
         self.collection.update_one(self.filter, {'$set': {self.key: number}}, upsert=True)
@@ -233,34 +766,144 @@ class MongoMigration(Migration, metaclass=ABCMeta):
     """
     Mongo DB migration abstract base class
     """
-    def _each_doc(self, processor):
+    # number of documents converted and written with one bulk write
+    batch_size = 1000
+    # number of threads that convert and write batches
+    workers = 1
+    # callback that is called with MigrationProgress after each batch
+    report = None
+    # collection for progress checkpoints, the default migrations collection if not set
+    checkpoints = None
+    # query for documents that aren't converted yet if they lack fields that storage queries rely on
+    pending_filter = None
+    # is migration run while storage serves requests
+    online = False
+
+    def read_doc(self, doc):
         """
-        Iterate each doc in the DB and run processor function with it
+        Convert document to the shape that storage reads, if it isn't converted by the migration yet.
+        It's used while migration runs online. By default documents are read as is.
+        """
+        return doc
+
+    def pending_candidates(self, inquiry, checker):
+        """
+        Query for documents that aren't converted by the migration yet and may fit the inquiry.
+        It's used while migration runs online in addition to storage queries.
+        None means that storage queries find such documents as they are.
+        By default all the documents that match `pending_filter` are candidates.
+        """
+        return self.pending_filter
+
+    def _each_doc(self, processor, direction='up'):
+        """
+        Iterate each doc in the DB and run processor function with it.
+        Docs are iterated in order of `_id` and replaced in batches. After each batch a checkpoint with
+        the last `_id` is saved, so that if migration is interrupted, the next run skips converted docs
+        (docs of batches that were written, but not checkpointed yet, are processed again).
+        Online migration up converts only the docs that match `pending_filter` when they are read and written,
+        so policies written by storage in the new shape aren't overwritten.
         """
-        failed_policies = []
         storage = getattr(self, 'storage')
-        cur = storage.collection.find()
-        for doc in cur:
-            try:
-                log.info('Trying to migrate Policy with UID: %s', doc['uid'])
-                new_doc = processor(doc)
-                storage.collection.replace_one({'_id': new_doc['uid']}, new_doc)
-                log.info('Policy with UID: %s was migrated', doc['uid'])
-            except Irreversible as e:
-                log.warning('Irreversible Policy. %s. Mongo doc: %s', e, doc)
-                failed_policies.append(doc)
-            except Exception as e:
-                log.exception('Unexpected exception occurred while migrating Policy: %s', doc)
-                failed_policies.append(doc)
+        checkpoints = self.checkpoints
+        if checkpoints is None:
+            checkpoints = storage.database[DEFAULT_MIGRATION_COLLECTION]
+        checkpoint_filter = {'_id': 'migration_checkpoint_%d_%s' % (self.order, direction)}
+        checkpoint = checkpoints.find_one(checkpoint_filter)
+        if checkpoint:
+            log.info('Resuming migration #%d %s after Policy with UID: %s', self.order, direction, checkpoint['last'])
+        q_filter = _after_id(checkpoint['last']) if checkpoint else {}
+        pending = self.pending_filter if self.online and direction == 'up' else None
+        if pending is not None:
+            q_filter = {'$and': [q_filter, pending]} if q_filter else pending
+        cur = storage.collection.find(q_filter, sort=[('_id', pymongo.ASCENDING)], batch_size=self.batch_size)
+        progress = MigrationProgress('Migration #%d %s' % (self.order, direction), self.report)
+        failed_policies = []
+
+        def complete(future, last, processed):
+            failed = future.result()
+            failed_policies.extend(failed)
+            checkpoints.update_one(checkpoint_filter, {'$set': {'last': last}}, upsert=True)
+            progress.advance(processed, len(failed))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # batches are written in parallel, but checkpoints are saved in order of batches
+            submitted = deque()
+            for batch in _batches(cur, self.batch_size):
+                # processor may modify docs, so the last _id is taken before the batch is submitted
+                last = batch[-1]['_id']
+                submitted.append((executor.submit(self.__migrate_batch, processor, batch, pending), last, len(batch)))
+                while submitted and (len(submitted) > self.workers or submitted[0][0].done()):
+                    complete(*submitted.popleft())
+            while submitted:
+                complete(*submitted.popleft())
+        checkpoints.delete_one(checkpoint_filter)
         if failed_policies:
             msg = "\n".join([
                 'Migration was unable to convert some Policies, but they were left in the database as-is. ' +
                 'They might be not automatically convertible, custom ones, malformed JSON docs.',
                 'You must convert them manually or delete entirely. See above log output for details of migration.',
-                'Mongo IDs of failed Policies are: %s' % [p['_id'] for p in failed_policies]
+                'Mongo IDs of failed Policies are: %s' % failed_policies
             ])
             log.error(msg)
 
+    def _resave_policies(self, direction='up'):
+        """
+        Save each policy in the DB again, so that all the fields needed by MongoStorage are updated.
+        """
+        def process(doc):
+            """Processor that re-saves policy"""
+            return self.storage._prepare_doc(self.storage._prepare_from_doc(copy.deepcopy(doc)))
+        self._each_doc(processor=process, direction=direction)
+
+    def __migrate_batch(self, processor, docs, pending=None):
+        """
+        Convert docs with processor and replace them in one bulk write. Returns `_id` of docs that failed to convert.
+        If pending query is given, docs are replaced only if they still match it.
+        """
+        storage = getattr(self, 'storage')
+        requests, failed = [], []
+        for doc in docs:
+            uid = doc['_id']
+            try:
+                log.info('Trying to migrate Policy with UID: %s', uid)
+                doc_filter = dict(pending, _id=uid) if pending else {'_id': uid}
+                requests.append(pymongo.ReplaceOne(doc_filter, processor(doc)))
+                log.info('Policy with UID: %s was migrated', uid)
+            except Irreversible as e:
+                log.warning('Irreversible Policy. %s. Mongo doc: %s', e, doc)
+                failed.append(uid)
+            except Exception as e:
+                log.exception('Unexpected exception occurred while migrating Policy: %s', doc)
+                failed.append(uid)
+        if requests:
+            storage.collection.bulk_write(requests, ordered=False)
+        return failed
+
+
+def _batches(iterable, size):
+    """
+    Split iterable into lists of the given size.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _after_id(last):
+    """
+    Query for documents that go after the given `_id` in the ascending order.
+    """
+    # $gt compares values of the same BSON type only, and numeric uids are sorted before string ones
+    if isinstance(last, (int, float)):
+        return {'$or': [{'_id': {'$gt': last}}, {'_id': {'$type': 'string'}}]}
+    return {'_id': {'$gt': last}}
+
 
 class Migration0To1x1x0(MongoMigration):
     """
@@ -296,6 +939,9 @@ class Migration1x1x0To1x1x1(MongoMigration):
     Migration between versions 1.1.0 and 1.1.1
     """
 
+    # documents before 1.2.0 have no type
+    pending_filter = {'type': {'$exists': False}}
+
     def __init__(self, storage):
         self.storage = storage
         self._type_marker = jsonpickle.tags.OBJECT
@@ -305,18 +951,24 @@ class Migration1x1x0To1x1x1(MongoMigration):
         return 2
 
     def up(self):
-        def process(doc):
-            """Processor for up"""
-            doc_to_save = copy.deepcopy(doc)
-            rules_to_save = {}
-            for name, rule_str in doc['rules'].items():
-                rule = b_json.loads(rule_str)
-                rule_to_save = {self._type_marker: rule['type']}
-                rule_to_save.update(rule['contents'])
-                rules_to_save[name] = rule_to_save
-            doc_to_save['rules'] = rules_to_save
-            return doc_to_save
-        self._each_doc(processor=process)
+        self._each_doc(processor=self.__up_doc, direction='up')
+
+    def read_doc(self, doc):
+        if any(isinstance(rule, str) for rule in doc.get('rules', {}).values()):
+            return self.__up_doc(doc)
+        return doc
+
+    def __up_doc(self, doc):
+        """Processor for up"""
+        doc_to_save = copy.deepcopy(doc)
+        rules_to_save = {}
+        for name, rule_str in doc['rules'].items():
+            rule = b_json.loads(rule_str)
+            rule_to_save = {self._type_marker: rule['type']}
+            rule_to_save.update(rule['contents'])
+            rules_to_save[name] = rule_to_save
+        doc_to_save['rules'] = rules_to_save
+        return doc_to_save
 
     def down(self):
         def process(doc):
@@ -343,7 +995,7 @@ class Migration1x1x0To1x1x1(MongoMigration):
             # report or save document
             doc_to_save['rules'] = rules_to_save
             return doc_to_save
-        self._each_doc(processor=process)
+        self._each_doc(processor=process, direction='down')
 
 
 class Migration1x1x1To1x2x0(MongoMigration):
@@ -356,6 +1008,9 @@ class Migration1x1x1To1x2x0(MongoMigration):
         - have 'context' attribute instead of 'rules' attribute
     """
 
+    # documents before 1.2.0 have no type
+    pending_filter = {'type': {'$exists': False}}
+
     def __init__(self, storage):
         self.storage = storage
         self.type_field = 'type'
@@ -375,20 +1030,26 @@ class Migration1x1x1To1x2x0(MongoMigration):
         return 3
 
     def up(self):
-        def process(doc):
-            """Processor for up"""
-            doc['type'] = TYPE_STRING_BASED
-            for rule in doc['rules'].values():
-                rule_type = rule[jsonpickle.tags.OBJECT]
-                for old, new in self.rules_rename.items():
-                    if rule_type == old:
-                        rule[jsonpickle.tags.OBJECT] = new
-                        break
-            doc['context'] = doc['rules']
-            del doc['rules']
-            return doc
         self.storage.collection.create_index(self.type_field, name=self.type_index)
-        self._each_doc(processor=process)
+        self._each_doc(processor=self.__up_doc, direction='up')
+
+    def read_doc(self, doc):
+        if 'rules' in doc and 'context' not in doc:
+            return self.__up_doc(doc)
+        return doc
+
+    def __up_doc(self, doc):
+        """Processor for up"""
+        doc['type'] = TYPE_STRING_BASED
+        for rule in doc['rules'].values():
+            rule_type = rule[jsonpickle.tags.OBJECT]
+            for old, new in self.rules_rename.items():
+                if rule_type == old:
+                    rule[jsonpickle.tags.OBJECT] = new
+                    break
+        doc['context'] = doc['rules']
+        del doc['rules']
+        return doc
 
     def down(self):
         def process(doc):
@@ -413,7 +1074,7 @@ class Migration1x1x1To1x2x0(MongoMigration):
             del doc['type']
             return doc
         self.storage.collection.drop_index(self.type_index)
-        self._each_doc(processor=process)
+        self._each_doc(processor=process, direction='down')
 
 
 class Migration1x2x0To1x4x0(MongoMigration):
@@ -427,6 +1088,11 @@ class Migration1x2x0To1x4x0(MongoMigration):
     def __init__(self, storage):
         self.storage = storage
         self.index_name = lambda i: i + '_idx'
+        # string-based documents before 1.4.0 have no compiled regexes
+        self.pending_filter = {
+            'type': TYPE_STRING_BASED,
+            self.storage.condition_field_compiled_name('actions'): {'$exists': False},
+        }
         self.multi_key_indices = map(
             self.storage.condition_field_compiled_name,
             [
@@ -445,8 +1111,7 @@ class Migration1x2x0To1x4x0(MongoMigration):
         for field in self.multi_key_indices:
             self.storage.collection.create_index(field, name=self.index_name(field))
         # re-save policies to add compiled_regex fields
-        for p in self.storage.retrieve_all():
-            self.storage.update(p)
+        self._resave_policies()
 
     def down(self):
         def process(doc):
@@ -459,4 +1124,59 @@ class Migration1x2x0To1x4x0(MongoMigration):
         for field_name in self.multi_key_indices:
             self.storage.collection.drop_index(self.index_name(field_name))
         # return policies to their previous state
-        self._each_doc(processor=process)
+        self._each_doc(processor=process, direction='down')
+
+
+class Migration1x4x0To1x6x0(MongoMigration):
+    """
+    Migration between versions 1.4.0 and 1.6.0.
+    What it does:
+    - Adds special fields with literal prefixes of elements for each string-based policy
+      that are needed to restrict candidates before DB-side regex checks.
+    - Adds indices for *_literal_prefix fields in string-based polices
+    - Adds special fields with constraints extracted from simple rules of each rule-based policy
+      that are needed to exclude policies that can't fit an inquiry.
+    - Adds indices for *_rule_tokens fields with flat tokens of these constraints in rule-based policies
+    - Adds etag field with a hash of each policy that is needed to cache decoded policies.
+    """
+
+    def __init__(self, storage, batch_size=1000):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.index_name = lambda i: i + '_idx'
+        # documents before 1.6.0 have no etag
+        self.pending_filter = {self.storage.etag_field: {'$exists': False}}
+        self.fields = [self.storage.condition_field_prefix_name(x) for x in self.storage.condition_fields]
+        self.tokens_fields = [self.storage.condition_field_tokens_name(x) for x in self.storage.condition_fields]
+        self.constraints_fields = [
+            self.storage.condition_field_constraints_name(x) for x in self.storage.condition_fields
+        ]
+
+    @property
+    def order(self):
+        return 5
+
+    def pending_candidates(self, inquiry, checker):
+        # Storage queries don't exclude policies without literal prefixes and rule constraints:
+        # they are matched by compiled regexes and by rules as before the migration.
+        return None
+
+    def up(self):
+        # create indices
+        for field in self.fields + self.tokens_fields:
+            self.storage.collection.create_index(field, name=self.index_name(field))
+        # re-save policies to add literal_prefix, rule_constraints, rule_tokens and etag fields
+        self._resave_policies()
+
+    def down(self):
+        def process(doc):
+            """Processor for down"""
+            for field in self.fields + self.constraints_fields + self.tokens_fields + [self.storage.etag_field]:
+                if field in doc:
+                    del doc[field]
+            return doc
+        # delete indices
+        for field in self.fields + self.tokens_fields:
+            self.storage.collection.drop_index(self.index_name(field))
+        # return policies to their previous state
+        self._each_doc(processor=process, direction='down')
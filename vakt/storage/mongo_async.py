@@ -0,0 +1,123 @@
+"""
+Asyncio MongoDB Storage for Policies.
+Requires python 3.5 or newer.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .mongo import MongoStorage, DEFAULT_COLLECTION, MAX_INQUIRIES_IN_FACET
+
+
+__all__ = ['AsyncMongoStorage']
+
+
+class AsyncMongoStorage:
+    """
+    Stores all policies in MongoDB and exposes MongoStorage methods as coroutines.
+
+    Queries are run by pymongo in a pool of at most `max_concurrency` threads that share the connection pool
+    of the given client, so the event loop is never blocked and several queries are in flight at once.
+    Server version isn't fetched on creation, but on the first query that needs it.
+
+    Guard is synchronous, so it can't use this storage directly. Create it with the wrapped MongoStorage
+    (`storage` attribute) and run its checks with `run`, so that they are done in the same thread pool:
+    `await async_storage.run(Guard(async_storage.storage, checker).is_allowed, inquiry)`.
+    """
+
+    def __init__(self, client, db_name, collection=DEFAULT_COLLECTION, cache_size=1024, max_concurrency=10,
+                 loop=None, server_side_decisions=False):
+        """
+        Initialize Async Mongo Storage
+
+        :param client: pymongo client. Its `maxPoolSize` should be not less than `max_concurrency`
+        :param cache_size: max number of decoded policies kept for `find_for_inquiry`. 0 turns the cache off
+        :param max_concurrency: max number of queries run at once
+        :param loop: event loop, the current one by default
+        :param server_side_decisions: see MongoStorage
+        """
+        self.storage = MongoStorage(client, db_name, collection=collection, cache_size=cache_size,
+                                    server_side_decisions=server_side_decisions)
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.loop = loop
+
+    async def add(self, policy):
+        """Store a policy"""
+        await self.run(self.storage.add, policy)
+
+    async def add_many(self, policies):
+        """Store several policies at once"""
+        await self.run(self.storage.add_many, list(policies))
+
+    async def get(self, uid):
+        """Get a policy by its uid or None"""
+        return await self.run(self.storage.get, uid)
+
+    async def get_all(self, limit, offset):
+        """Get a list of policies with the given limit and offset"""
+        return await self.run(lambda: list(self.storage.get_all(limit, offset)))
+
+    async def retrieve_all(self, batch=50):
+        """Get a list of all the policies, that are read from the storage in batches of a specified size"""
+        return await self.run(lambda: list(self.storage.retrieve_all(batch=batch)))
+
+    async def find_for_inquiry(self, inquiry, checker=None):
+        """Get a list of policies that might fit the given inquiry"""
+        return await self.run(lambda: list(self.storage.find_for_inquiry(inquiry, checker)))
+
+    async def find_for_inquiries(self, inquiries, checker=None):
+        """
+        Get a list of (index of inquiry, policy) pairs for policies that might fit the given inquiries.
+        Inquiries are split into chunks found with one aggregation each (see MongoStorage) and the chunks
+        are queried concurrently. If the storage can't find them at once (e.g. old MongoDB version or
+        online migrations in progress) query of each inquiry is issued concurrently with the others.
+        """
+        inquiries = list(inquiries)
+        if not await self.run(self.storage._finds_inquiries_at_once, inquiries, checker):
+            found = await asyncio.gather(*[self.find_for_inquiry(i, checker) for i in inquiries])
+            return [(i, policy) for i, policies in enumerate(found) for policy in policies]
+        starts = range(0, len(inquiries), MAX_INQUIRIES_IN_FACET)
+        found = await asyncio.gather(*[
+            self.run(lambda chunk: list(self.storage.find_for_inquiries(chunk, checker)),
+                     inquiries[start:start + MAX_INQUIRIES_IN_FACET])
+            for start in starts
+        ])
+        return [(start + i, policy) for start, pairs in zip(starts, found) for i, policy in pairs]
+
+    async def find_fitting_for_inquiry(self, inquiry, checker=None):
+        """
+        Get (fitting policies, policies whose context is left to check) for the given inquiry
+        or None if policies can't be matched exactly (see MongoStorage).
+        """
+        return await self.run(self.storage.find_fitting_for_inquiry, inquiry, checker)
+
+    async def update(self, policy):
+        """Update a policy"""
+        await self.run(self.storage.update, policy)
+
+    async def update_many(self, policies):
+        """Update several policies at once"""
+        await self.run(self.storage.update_many, list(policies))
+
+    async def delete(self, uid):
+        """Delete a policy by its uid"""
+        await self.run(self.storage.delete, uid)
+
+    async def delete_many(self, uids):
+        """Delete several policies at once"""
+        await self.run(self.storage.delete_many, list(uids))
+
+    def close(self):
+        """
+        Shut down threads that run queries. The client isn't closed, since it can be shared.
+        """
+        self.executor.shutdown(wait=True)
+
+    async def run(self, func, *args):
+        """
+        Run a blocking call (e.g. of the wrapped storage or of a Guard that uses it) in the thread pool.
+        """
+        loop = self.loop or asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
@@ -6,6 +6,11 @@ class ObservableMutationStorage(Subject):
     Wraps Storage.
     Implements mutation part of Storage interface as a notifier of subscribers.
     Notifies observers when mutation method is called on Storage.
+    Observers receive a list of changes: (old policy, new policy) pairs, where old policy is None for added policies
+    and new policy is None for deleted ones. Old policies are read from Storage just before the mutation.
+    Batch mutation methods (add_many, update_many, delete_many) notify observers only once per batch.
+    Old versions of policies aren't read for update_many and delete_many not to make a Storage query per policy,
+    so their changes are unknown (None) to observers.
     Read part of Storage interface is a simple proxy.
     """
     def __init__(self, storage):
@@ -14,17 +19,35 @@ class ObservableMutationStorage(Subject):
 
     def add(self, policy):
         res = self.storage.add(policy)
-        self.notify()
+        self.notify([(None, policy)])
         return res
 
     def update(self, policy):
+        old = self.storage.get(policy.uid)
         res = self.storage.update(policy)
-        self.notify()
+        self.notify([(old, policy)])
         return res
 
     def delete(self, uid):
+        old = self.storage.get(uid)
         res = self.storage.delete(uid)
-        self.notify()
+        self.notify([(old, None)])
+        return res
+
+    def add_many(self, policies):
+        policies = list(policies)
+        res = self.storage.add_many(policies)
+        self.notify([(None, p) for p in policies])
+        return res
+
+    def update_many(self, policies):
+        res = self.storage.update_many(policies)
+        self.notify(None)
+        return res
+
+    def delete_many(self, uids):
+        res = self.storage.delete_many(uids)
+        self.notify(None)
         return res
 
     def get(self, uid):
@@ -38,3 +61,9 @@ class ObservableMutationStorage(Subject):
 
     def find_for_inquiry(self, inquiry, checker=None):
         return self.storage.find_for_inquiry(inquiry, checker)
+
+    def find_for_inquiries(self, inquiries, checker=None):
+        return self.storage.find_for_inquiries(inquiries, checker)
+
+    def find_fitting_for_inquiry(self, inquiry, checker=None):
+        return self.storage.find_fitting_for_inquiry(inquiry, checker)
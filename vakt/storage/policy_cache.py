@@ -0,0 +1,79 @@
+"""
+Cache of decoded policies for storages that keep policies as JSON documents.
+"""
+
+import hashlib
+import threading
+from itertools import islice
+from collections import OrderedDict
+
+
+__all__ = ['PolicyCache', 'get_etag']
+
+
+def get_etag(doc):
+    """
+    Etag of a policy JSON document: it changes whenever the document changes.
+    """
+    return hashlib.sha1(doc.encode('utf-8')).hexdigest()
+
+
+class PolicyCache:
+    """
+    Thread-safe LRU cache of at most `maxsize` decoded policies keyed by uid and etag of their document.
+    Entries are never invalidated: updated policy has a new etag, so its old entry is just evicted eventually.
+    Note that cached policies are shared by all the callers, so they must not be modified.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self._policies = OrderedDict()
+
+    def get(self, uid, etag):
+        """
+        Get cached policy or None if there is no such policy of the given etag.
+        """
+        key = (uid, etag)
+        with self.lock:
+            policy = self._policies.get(key)
+            if policy is not None:
+                self._policies.move_to_end(key)
+            return policy
+
+    def put(self, uid, etag, policy):
+        """
+        Cache a policy. Policies without etag (e.g. stored before etags were introduced) aren't cached.
+        """
+        if etag is None or self.maxsize <= 0:
+            return
+        with self.lock:
+            self._policies[(uid, etag)] = policy
+            self._policies.move_to_end((uid, etag))
+            if len(self._policies) > self.maxsize:
+                self._policies.popitem(last=False)
+
+    def hydrate(self, rows, fetch, batch_size=500):
+        """
+        Yield (row, policy) for rows that start with uid and etag of a policy, in the order of rows.
+        Policies that aren't in the cache are fetched in batches with `fetch(uids)` that should return
+        (uid, etag, policy) for the existing ones. Policies deleted between reading rows and fetching are skipped.
+        """
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, batch_size))
+            if not chunk:
+                return
+            policies = {}
+            for row in chunk:
+                policy = self.get(row[0], row[1])
+                if policy is not None:
+                    policies[row[0]] = policy
+            missed = list(OrderedDict.fromkeys(row[0] for row in chunk if row[0] not in policies))
+            if missed:
+                for uid, etag, policy in fetch(missed):
+                    self.put(uid, etag, policy)
+                    policies[uid] = policy
+            for row in chunk:
+                if row[0] in policies:
+                    yield row, policies[row[0]]
@@ -0,0 +1,100 @@
+"""
+Extraction of simple constraints from rule-based policies so that storages can index them.
+
+Storages can't evaluate arbitrary Rules, but some of them are simple enough to be translated into
+equality lookups: `Eq` and `In` of strings, case-sensitive `StartsWith` and `Any` on a key of inquiry data.
+Each such rule becomes a group of tokens, and it's satisfied by an inquiry value only if
+at least one of these tokens is among the tokens produced by that value.
+Policy element (a dict of rules or a single rule) can fit the value only if all of its groups are satisfied.
+Rules that can't be translated produce no groups, so they never exclude a policy:
+constraints are a prefilter and the final decision is always made by `RulesChecker`.
+"""
+
+import json
+
+from ..policy import TYPE_RULE_BASED
+from ..rules.operator import Eq
+from ..rules.list import In
+from ..rules.string import StartsWith
+from ..rules.logic import Any
+from ..parser import get_prefixes
+
+
+__all__ = ['get_policy_constraints', 'get_value_tokens']
+
+# Key of constraints for rules that are applied to the whole inquiry value and not to its dict item
+WHOLE_VALUE = None
+
+
+def get_policy_constraints(policy, prefix_length, max_token_length=None):
+    """
+    Constraints of a rule-based policy by its fields: subjects, resources and actions.
+    Each field has a list of constraints per each element: a list of groups, each group is a list of tokens.
+    Groups with tokens longer than max_token_length are skipped, since they can't be stored.
+    Field without elements gets one element without constraints: it's up to a checker to decide on it.
+    Empty dict is returned for other types of policies.
+    """
+    if policy.type != TYPE_RULE_BASED:
+        return {}
+    constraints = {}
+    for field in ('subjects', 'resources', 'actions'):
+        elements = []
+        for el in getattr(policy, field):
+            if type(el) == dict:
+                groups = [_rule_tokens(rule, key, prefix_length) for key, rule in el.items()]
+            else:
+                groups = [_rule_tokens(el, WHOLE_VALUE, prefix_length)]
+            elements.append([
+                g for g in groups
+                if g and (max_token_length is None or all(len(t) <= max_token_length for t in g))
+            ])
+        constraints[field] = elements or [[]]
+    return constraints
+
+
+def get_value_tokens(value, prefix_length):
+    """
+    All tokens produced by an inquiry value: subject, resource or action.
+    """
+    tokens = []
+    if isinstance(value, str):
+        tokens.extend(_value_tokens(value, WHOLE_VALUE, prefix_length))
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(key, str):
+                tokens.append(_token('any', key))
+                tokens.extend(_value_tokens(item, key, prefix_length))
+    return tokens
+
+
+def _value_tokens(value, key, prefix_length):
+    if not isinstance(value, str):
+        return []
+    return [_token('eq', key, value)] + [_token('prefix', key, p) for p in get_prefixes(value, prefix_length)]
+
+
+def _rule_tokens(rule, key, prefix_length):
+    """
+    Tokens of one rule applied to a dict key or to the whole value.
+    Empty list means that rule can't be translated.
+    Only exact types are translated: subclasses may redefine what satisfies them.
+    """
+    if key is not WHOLE_VALUE and not isinstance(key, str):
+        return []
+    rule_type = type(rule)
+    if rule_type == Eq and isinstance(rule.val, str):
+        return [_token('eq', key, rule.val)]
+    # inquiry value can be in a set of strings only if it's a string itself
+    if rule_type == In and rule.data and all(isinstance(x, str) for x in rule.data):
+        return sorted(_token('eq', key, x) for x in rule.data)
+    # stored prefix is cut, but it's still a prefix of any value that starts with the whole rule's value
+    if rule_type == StartsWith and not getattr(rule, 'ci', False):
+        return [_token('prefix', key, rule.val[:prefix_length])]
+    # Any() on a whole value is always satisfied, but on a dict key it requires the key to be present
+    if rule_type == Any and key is not WHOLE_VALUE:
+        return [_token('any', key)]
+    return []
+
+
+def _token(*parts):
+    return json.dumps(parts)
@@ -2,144 +2,501 @@
 SQL Storage for Policies.
 """
 
+import time
 import logging
+import contextlib
+from functools import partial
 
-from sqlalchemy import and_, or_, literal, func
+from sqlalchemy import and_, or_, literal, false, func, event, distinct, text, create_engine
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.orm.exc import FlushError
 
-from .model import PolicyModel, PolicyActionModel, PolicyResourceModel, PolicySubjectModel
+from .replicas import RoundRobinSelector
+from .model import PolicyModel, PolicyActionModel, PolicyResourceModel, PolicySubjectModel, PolicyNgramModel, \
+    PolicyRuleTokenModel, PREFIX_LENGTH, NGRAM_LENGTH, NO_CONSTRAINTS_TOKEN
 from ..abc import Storage
+from ..rule_constraints import get_value_tokens
+from ..policy_cache import PolicyCache
+from ..sqlite import regexp
 from ...checker import StringExactChecker, StringFuzzyChecker, RegexChecker, RulesChecker
 from ...exceptions import PolicyExistsError, UnknownCheckerType
-from ...policy import TYPE_STRING_BASED, TYPE_RULE_BASED
+from ...policy import Policy, TYPE_STRING_BASED, TYPE_RULE_BASED
+from ...parser import get_prefixes, get_ngrams
 
 
 log = logging.getLogger(__name__)
 
+# Max number of n-grams of an inquiry value that are looked up in the index.
+# Even a few of them are selective enough, while each one costs an index lookup.
+MAX_NGRAMS_IN_QUERY = 8
+# Max number of inquiries whose queries are combined with UNION ALL into one statement.
+# SQLite allows at most 500 SELECTs in a compound statement by default.
+MAX_INQUIRIES_IN_QUERY = 100
+# Databases that can start a transaction as read-only with `SET TRANSACTION READ ONLY`.
+READ_ONLY_TRANSACTION_DIALECTS = ('postgresql', 'mysql', 'oracle')
+
+
+def create_session(dsn, pool_size=None, max_overflow=None, pool_timeout=None, **engine_options):
+    """
+        Create SQL Alchemy scoped session for SQLStorage with a connection pool of the given size.
+
+        :param dsn: database connection string
+        :param pool_size: number of connections kept open in the pool.
+                          Should be not less than the number of threads that make decisions concurrently
+        :param max_overflow: number of connections that can be opened above pool_size under a peak load
+        :param pool_timeout: seconds to wait for a free connection before giving up
+        :param engine_options: any other options for `sqlalchemy.create_engine`
+        Pool options that are None are left to SQL Alchemy defaults
+        (note that some pools, e.g. the one for SQLite in-memory database, don't accept them).
+    """
+    pool_options = {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_timeout': pool_timeout}
+    engine_options.update({k: v for k, v in pool_options.items() if v is not None})
+    return scoped_session(sessionmaker(bind=create_engine(dsn, **engine_options)))
+
 
 class SQLStorage(Storage):
     """Stores all policies in SQL Database"""
 
-    def __init__(self, scoped_session):
+    def __init__(self, scoped_session, cache_size=1024, session_per_operation=False,
+                 read_sessions=None, read_selector=None, read_your_writes_window=1.0):
         """
             Initialize SQL Storage
 
             :param scoped_session: SQL Alchemy scoped session
+            :param cache_size: max number of decoded policies kept for `find_for_inquiry`. 0 turns the cache off
+            :param session_per_operation: use a short-lived session for each operation.
+                                          Session of the current thread is removed when operation is done,
+                                          so that its connection is returned to the pool.
+                                          Reads are done in read-only transactions that end before results
+                                          are returned, so found policies are fetched at once.
+            :param read_sessions: list of SQL Alchemy scoped sessions bound to read replicas.
+                                  `get`, `get_all`, `retrieve_all` and `find_for_inquiry` are routed to them,
+                                  all the modifications go to the primary `scoped_session`
+            :param read_selector: ReplicaSelector that chooses a replica for each read (round-robin by default)
+            :param read_your_writes_window: seconds after a modification made by this storage
+                                            during which reads go to the primary database,
+                                            so that they see the change before replicas catch up
         """
         self.session = scoped_session
+        self.cache = PolicyCache(cache_size)
+        self.session_per_operation = session_per_operation
+        self.read_sessions = list(read_sessions or [])
+        self.read_selector = read_selector or RoundRobinSelector()
+        self.read_your_writes_window = read_your_writes_window
+        self._last_write_time = None
         self.dialect = self.session.bind.engine.dialect.name
+        self._read_engines = [s.bind.engine for s in self.read_sessions]
+        if self.dialect == 'sqlite':
+            for engine in [self.session.bind.engine] + self._read_engines:
+                self._register_sqlite_regexp(engine)
 
     def add(self, policy):
-        try:
-            policy_model = PolicyModel.from_policy(policy)
-            self.session.add(policy_model)
-            self.session.commit()
-        except IntegrityError:
-            self.session.rollback()
-            log.error('Error trying to create already existing policy with UID=%s.', policy.uid)
-            raise PolicyExistsError(policy.uid)
-        # todo - figure out why FlushError is raised instead of IntegrityError on PyPy tests
-        except FlushError as e:
-            if 'conflicts with persistent instance' in str(e):
+        with self._operation():
+            try:
+                policy_model = PolicyModel.from_policy(policy)
+                self.session.add(policy_model)
+                self.session.commit()
+            except IntegrityError:
                 self.session.rollback()
                 log.error('Error trying to create already existing policy with UID=%s.', policy.uid)
                 raise PolicyExistsError(policy.uid)
+            # todo - figure out why FlushError is raised instead of IntegrityError on PyPy tests
+            except FlushError as e:
+                if 'conflicts with persistent instance' in str(e):
+                    self.session.rollback()
+                    log.error('Error trying to create already existing policy with UID=%s.', policy.uid)
+                    raise PolicyExistsError(policy.uid)
         log.info('Added Policy: %s', policy)
 
     def get(self, uid):
-        policy_model = self.session.query(PolicyModel).get(uid)
-        if not policy_model:
-            return None
-        return policy_model.to_policy()
+        session = self._read_session()
+        with self._operation(session, read_only=True):
+            row = session.query(PolicyModel.uid, PolicyModel.doc).filter(PolicyModel.uid == uid).first()
+            if not row:
+                return None
+            return self._to_policy(*row)
 
     def get_all(self, limit, offset):
         self._check_limit_and_offset(limit, offset)
-        cur = self.session.query(PolicyModel).order_by(PolicyModel.uid.asc()).slice(offset, offset + limit)
-        for policy_model in cur:
-            yield policy_model.to_policy()
+        session = self._read_session()
+        for policy in self._read(session, self._get_all(session, limit, offset)):
+            yield policy
+
+    def _get_all(self, session, limit, offset):
+        cur = session.query(PolicyModel.uid, PolicyModel.doc) \
+            .order_by(PolicyModel.uid.asc()).slice(offset, offset + limit)
+        for uid, doc in cur:
+            yield self._to_policy(uid, doc)
+
+    def _get_batch(self, limit, token):
+        # keyset pagination: each batch is an index range scan that starts right after the last seen uid
+        self._check_limit_and_offset(limit, 0)
+        session = self._read_session()
+        with self._operation(session, read_only=True):
+            cur = session.query(PolicyModel.uid, PolicyModel.doc)
+            if token is not None:
+                cur = cur.filter(PolicyModel.uid > token)
+            rows = cur.order_by(PolicyModel.uid.asc()).limit(limit).all()
+            policies = [self._to_policy(uid, doc) for uid, doc in rows]
+        return policies, rows[-1][0] if rows and len(rows) == limit else None
 
     def find_for_inquiry(self, inquiry, checker=None):
-        cur = self._get_filtered_cursor(inquiry, checker)
-        for policy_model in cur:
-            yield policy_model.to_policy()
+        session = self._read_session()
+        for policy in self._read(session, self._find_for_inquiry(session, inquiry, checker)):
+            yield policy
+
+    def _find_for_inquiry(self, session, inquiry, checker):
+        if self.cache.maxsize <= 0:
+            for uid, doc in self._get_filtered_cursor(session, inquiry, checker, PolicyModel.doc):
+                yield self._to_policy(uid, doc)
+            return
+        # fetch only etags of matched policies, documents are fetched and decoded only for the cache misses
+        cur = self._get_filtered_cursor(session, inquiry, checker, PolicyModel.etag)
+        for _, policy in self.cache.hydrate(cur, partial(self._fetch_policies, session)):
+            yield policy
+
+    def find_for_inquiries(self, inquiries, checker=None):
+        session = self._read_session()
+        for item in self._read(session, self._find_for_inquiries(session, list(inquiries), checker)):
+            yield item
+
+    def _find_for_inquiries(self, session, inquiries, checker):
+        column = PolicyModel.etag if self.cache.maxsize > 0 else PolicyModel.doc
+        for start in range(0, len(inquiries), MAX_INQUIRIES_IN_QUERY):
+            queries = [
+                session.query(PolicyModel.uid, column, literal(start + i).label('inquiry_idx'))
+                    .filter(*self._get_filter_conditions(inquiry, checker))
+                for i, inquiry in enumerate(inquiries[start:start + MAX_INQUIRIES_IN_QUERY])
+            ]
+            cur = queries[0].union_all(*queries[1:])
+            if self.cache.maxsize <= 0:
+                for uid, doc, idx in cur:
+                    yield idx, self._to_policy(uid, doc)
+                continue
+            for (_, _, idx), policy in self.cache.hydrate(cur, partial(self._fetch_policies, session)):
+                yield idx, policy
 
     def update(self, policy):
-        try:
-            policy_model = self.session.query(PolicyModel).get(policy.uid)
-            if not policy_model:
-                return
-            policy_model.update(policy)
-            self.session.commit()
-        except IntegrityError:
-            self.session.rollback()
-            raise
+        with self._operation():
+            try:
+                policy_model = self.session.query(PolicyModel).get(policy.uid)
+                if not policy_model:
+                    return
+                policy_model.update(policy)
+                self.session.commit()
+            except IntegrityError:
+                self.session.rollback()
+                raise
         log.info('Updated Policy with UID=%s. New value is: %s', policy.uid, policy)
 
     def delete(self, uid):
-        self.session.query(PolicyModel).filter(PolicyModel.uid == uid).delete()
+        with self._operation():
+            # elements are deleted explicitly: cascades aren't enforced by every database (e.g. SQLite by default)
+            self.__delete_rows([str(uid)])
+            self.session.commit()
         log.info('Deleted Policy with UID=%s.', uid)
 
-    def _get_filtered_cursor(self, inquiry, checker):
+    def add_many(self, policies):
+        policies = list(policies)
+        if not policies:
+            return
+        with self._operation():
+            try:
+                self.__insert_models([PolicyModel.from_policy(p) for p in policies])
+                self.session.commit()
+            except IntegrityError:
+                self.session.rollback()
+                uid = self.__find_existing_uid(policies)
+                if uid is None:
+                    raise
+                log.error('Error trying to create already existing policy with UID=%s.', uid)
+                raise PolicyExistsError(uid)
+        log.info('Added %d Policies', len(policies))
+
+    def update_many(self, policies):
+        policies = list(policies)
+        with self._operation():
+            existing = set()
+            for uids in self.__chunks([str(p.uid) for p in policies]):
+                existing.update(
+                    uid for (uid,) in self.session.query(PolicyModel.uid).filter(PolicyModel.uid.in_(uids))
+                )
+            models = [PolicyModel.from_policy(p) for p in policies if str(p.uid) in existing]
+            if not models:
+                return
+            try:
+                # replace the existing policies as a whole: it's the cheapest way to update all of their elements
+                self.__delete_rows(list(existing))
+                self.__insert_models(models)
+                self.session.commit()
+            except IntegrityError:
+                self.session.rollback()
+                raise
+        log.info('Updated %d Policies', len(models))
+
+    def delete_many(self, uids):
+        uids = [str(uid) for uid in uids]
+        with self._operation():
+            self.__delete_rows(uids)
+            self.session.commit()
+        log.info('Deleted Policies with UIDs=%s.', uids)
+
+    @contextlib.contextmanager
+    def _operation(self, session=None, read_only=False):
+        """
+        Scope of one storage operation with the given session (the primary one by default).
+        In session-per-operation mode the session of the current thread is removed at the end of the scope:
+        its transaction (if any is left) is rolled back and its connection is returned to the pool.
+        Reads start read-only transaction on databases that support it.
+        Otherwise session is left as is, as well as its transaction.
+        """
+        session = session or self.session
+        try:
+            if self.session_per_operation and read_only and self.dialect in READ_ONLY_TRANSACTION_DIALECTS:
+                session.execute(text('SET TRANSACTION READ ONLY'))
+            yield
+        finally:
+            if not read_only:
+                self._last_write_time = time.monotonic()
+            if self.session_per_operation:
+                session.remove()
+                # policies without `doc` are read from their models with the primary session
+                if session is not self.session:
+                    self.session.remove()
+
+    def _read(self, session, items):
+        """
+        Read items lazily or, in session-per-operation mode, all of them at once inside a read-only operation,
+        so that no transaction is left open while caller iterates over them.
+        """
+        if not self.session_per_operation:
+            return items
+        with self._operation(session, read_only=True):
+            return list(items)
+
+    def _read_session(self):
+        """
+        Session to read from: a replica chosen by the selector, or the primary session if there are no replicas
+        or this storage has modified policies within the read-your-writes window.
+        """
+        if not self.read_sessions:
+            return self.session
+        if self._last_write_time is not None and \
+                time.monotonic() - self._last_write_time < self.read_your_writes_window:
+            return self.session
+        return self.read_sessions[self.read_selector.select(self._read_engines)]
+
+    def __insert_models(self, models):
+        """
+        Insert rows of policy models with one multi-row insert statement per table.
+        """
+        self.session.execute(PolicyModel.__table__.insert(), [self.__to_row(m, uid=str(m.uid)) for m in models])
+        for relation, child_model in self.__child_models():
+            rows = [self.__to_row(el, uid=str(m.uid)) for m in models for el in getattr(m, relation)]
+            if rows:
+                self.session.execute(child_model.__table__.insert(), rows)
+
+    def __delete_rows(self, uids):
+        """
+        Delete rows of policies and their elements.
+        """
+        for chunk in self.__chunks(uids):
+            for _, child_model in self.__child_models():
+                self.session.query(child_model).filter(child_model.uid.in_(chunk)) \
+                    .delete(synchronize_session=False)
+            self.session.query(PolicyModel).filter(PolicyModel.uid.in_(chunk)).delete(synchronize_session=False)
+
+    def __find_existing_uid(self, policies):
+        """
+        Get first uid of the given policies that is duplicated among them or already exists in the database.
+        """
+        uids, seen = [str(p.uid) for p in policies], set()
+        for uid in uids:
+            if uid in seen:
+                return uid
+            seen.add(uid)
+        for chunk in self.__chunks(uids):
+            existing = self.session.query(PolicyModel.uid).filter(PolicyModel.uid.in_(chunk)).first()
+            if existing:
+                return existing[0]
+        return None
+
+    @staticmethod
+    def __child_models():
+        return [
+            ('subjects', PolicySubjectModel),
+            ('resources', PolicyResourceModel),
+            ('actions', PolicyActionModel),
+            ('ngrams', PolicyNgramModel),
+            ('rule_tokens', PolicyRuleTokenModel),
+        ]
+
+    @staticmethod
+    def __to_row(model, **values):
+        """
+        Get model's column values. Autoincrement ids are left for a database.
         """
-            Returns cursor with proper query-filter based on the checker type.
+        row = {c.key: getattr(model, c.key) for c in model.__table__.columns if c.key != 'id'}
+        row.update(values)
+        return row
+
+    @staticmethod
+    def __chunks(items, size=500):
+        """
+        Split items into chunks small enough to be used as a list of bound parameters.
+        """
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
+
+    def _to_policy(self, uid, doc):
+        """
+        Create policy from its JSON document.
+        Policies stored before `doc` column was filled by migration are created from their model.
+        """
+        if doc is None:
+            return self.session.query(PolicyModel).get(uid).to_policy()
+        policy = Policy.from_json(doc)
+        # uid is always returned as it's stored in the database: as a string
+        policy.uid = uid
+        return policy
+
+    def _fetch_policies(self, session, uids):
+        """
+        Get (uid, etag, policy) for policies with the given uids.
+        """
+        rows = session.query(PolicyModel.uid, PolicyModel.etag, PolicyModel.doc) \
+            .filter(PolicyModel.uid.in_(uids)).all()
+        return [(uid, etag, self._to_policy(uid, doc)) for uid, etag, doc in rows]
+
+    def _get_filtered_cursor(self, session, inquiry, checker, column):
+        """
+            Returns cursor of (uid, column) rows with proper query-filter based on the checker type.
+        """
+        return session.query(PolicyModel.uid, column).filter(*self._get_filter_conditions(inquiry, checker))
+
+    def _get_filter_conditions(self, inquiry, checker):
+        """
+            Returns list of query-filter conditions based on the checker type.
         """
-        cur = self.session.query(PolicyModel)
         if isinstance(checker, StringFuzzyChecker):
-            return cur.filter(
-                PolicyModel.type == TYPE_STRING_BASED,
-                PolicyModel.actions.any(PolicyActionModel.action_string.like('%{}%'.format(inquiry.action))),
-                PolicyModel.resources.any(PolicyResourceModel.resource_string.like('%{}%'.format(inquiry.resource))),
-                PolicyModel.subjects.any(PolicySubjectModel.subject_string.like('%{}%'.format(inquiry.subject))))
+            return [PolicyModel.type == TYPE_STRING_BASED] + \
+                self._fuzzy_conditions(inquiry.action, 'actions', PolicyActionModel.action_string) + \
+                self._fuzzy_conditions(inquiry.resource, 'resources', PolicyResourceModel.resource_string) + \
+                self._fuzzy_conditions(inquiry.subject, 'subjects', PolicySubjectModel.subject_string)
         elif isinstance(checker, StringExactChecker):
-            return cur.filter(
+            return [
                 PolicyModel.type == TYPE_STRING_BASED,
-                PolicyModel.actions.any(PolicyActionModel.action_string == inquiry.action),
-                PolicyModel.resources.any(PolicyResourceModel.resource_string == inquiry.resource),
-                PolicyModel.subjects.any(PolicySubjectModel.subject_string == inquiry.subject))
+                PolicyModel.actions.any(self._exact_condition(inquiry.action, PolicyActionModel.action_string)),
+                PolicyModel.resources.any(self._exact_condition(inquiry.resource,
+                                                                PolicyResourceModel.resource_string)),
+                PolicyModel.subjects.any(self._exact_condition(inquiry.subject, PolicySubjectModel.subject_string)),
+            ]
         elif isinstance(checker, RegexChecker):
-            if not self._supports_regex_operator():
-                return cur.filter(PolicyModel.type == TYPE_STRING_BASED)
-            return cur.filter(
+            return [
                 PolicyModel.type == TYPE_STRING_BASED,
-                PolicyModel.actions.any(
-                    or_(
-                        and_(PolicyActionModel.action_regex.is_(None),
-                             PolicyActionModel.action_string == inquiry.action),
-                        and_(PolicyActionModel.action_regex.isnot(None),
-                             self._regex_operation(inquiry.action, PolicyActionModel.action_regex))
-                    ),
-                ),
-                PolicyModel.resources.any(
-                    or_(
-                        and_(PolicyResourceModel.resource_regex.is_(None),
-                             PolicyResourceModel.resource_string == inquiry.resource),
-                        and_(PolicyResourceModel.resource_regex.isnot(None),
-                             self._regex_operation(inquiry.resource, PolicyResourceModel.resource_regex))
-                    ),
-                ),
-                PolicyModel.subjects.any(
-                    or_(
-                        and_(PolicySubjectModel.subject_regex.is_(None),
-                             PolicySubjectModel.subject_string == inquiry.subject),
-                        and_(PolicySubjectModel.subject_regex.isnot(None),
-                             self._regex_operation(inquiry.subject, PolicySubjectModel.subject_regex))
-                    ),
-                )
-            )
+                PolicyModel.actions.any(self._regex_condition(inquiry.action, PolicyActionModel, 'action')),
+                PolicyModel.resources.any(self._regex_condition(inquiry.resource, PolicyResourceModel, 'resource')),
+                PolicyModel.subjects.any(self._regex_condition(inquiry.subject, PolicySubjectModel, 'subject')),
+            ]
         elif isinstance(checker, RulesChecker):
-            return cur.filter(PolicyModel.type == TYPE_RULE_BASED)
+            return [
+                PolicyModel.type == TYPE_RULE_BASED,
+                self._rules_condition(inquiry.action, 'actions'),
+                self._rules_condition(inquiry.resource, 'resources'),
+                self._rules_condition(inquiry.subject, 'subjects'),
+            ]
         elif not checker:
-            return cur
+            return []
         else:
             log.error('Provided Checker type is not supported.')
             raise UnknownCheckerType(checker)
 
+    @staticmethod
+    def _exact_condition(value, string):
+        """
+        Condition for a policy element to be equal to the inquiry value with StringExactChecker.
+        Non-string values can't be bound to string columns by some drivers and no string element is equal to them.
+        """
+        if not isinstance(value, str):
+            return false()
+        return string == value
+
+    def _fuzzy_conditions(self, value, field, string):
+        """
+        Conditions for policy elements of a given field to contain the inquiry value with StringFuzzyChecker.
+        Candidates are found by the index of n-grams: a policy element can contain the value
+        only if it has all of the value's n-grams. `LIKE` is applied only to those candidates.
+        """
+        value = '{}'.format(value)
+        conditions = []
+        for ngram in get_ngrams(value, NGRAM_LENGTH)[:MAX_NGRAMS_IN_QUERY]:
+            conditions.append(PolicyModel.uid.in_(
+                self.session.query(PolicyNgramModel.uid).filter(
+                    PolicyNgramModel.field == field,
+                    PolicyNgramModel.ngram == ngram,
+                )
+            ))
+        # `%` and `_` in the value are escaped, so they are matched literally
+        conditions.append(getattr(PolicyModel, field).any(string.contains(value, autoescape=True)))
+        return conditions
+
+    def _rules_condition(self, value, field):
+        """
+        Condition for policy elements of a given field to possibly fit the inquiry value with RulesChecker.
+        Element is a candidate if each of its constraints groups has a token produced by the value:
+        tokens found in the index are counted per element and compared with its number of groups.
+        Elements without constraints are always found by their special token.
+        """
+        tokens = [NO_CONSTRAINTS_TOKEN] + get_value_tokens(value, PREFIX_LENGTH)
+        return PolicyModel.uid.in_(
+            self.session.query(PolicyRuleTokenModel.uid).filter(
+                PolicyRuleTokenModel.field == field,
+                PolicyRuleTokenModel.token.in_(tokens),
+            ).group_by(
+                PolicyRuleTokenModel.uid,
+                PolicyRuleTokenModel.element_idx,
+            ).having(
+                func.count(distinct(PolicyRuleTokenModel.group_idx)) == func.min(PolicyRuleTokenModel.groups_count)
+            )
+        )
+
+    def _regex_condition(self, value, model, name):
+        """
+        Condition for a policy element to match the inquiry value with RegexChecker.
+        Element either is a plain string equal to the value or is a regex that matches the value.
+        Regex is applied only to elements whose indexed literal prefix is a prefix of the value,
+        so that the database doesn't need to run it against every row.
+        If database doesn't support regex operator, prefix check alone still filters out most of the elements.
+        Elements stored without prefix (before the prefix columns were filled by the migration) aren't excluded.
+        Non-string values can't be bound by some drivers, so for them all the regexes are left to the checker.
+        """
+        string, regex, prefix = [getattr(model, '%s_%s' % (name, x)) for x in ('string', 'regex', 'prefix')]
+        if not isinstance(value, str):
+            return regex.isnot(None)
+        regex_conditions = [regex.isnot(None), or_(prefix.in_(get_prefixes(value, PREFIX_LENGTH)), prefix.is_(None))]
+        if self._supports_regex_operator():
+            regex_conditions.append(self._regex_operation(value, regex))
+        return or_(
+            and_(regex.is_(None), string == value),
+            and_(*regex_conditions),
+        )
+
     def _supports_regex_operator(self):
         """
         Does database support regex operator?
         """
-        return self.dialect in ['mysql', 'postgresql', 'oracle']
+        return self.dialect in ['mysql', 'postgresql', 'oracle', 'sqlite']
+
+    @staticmethod
+    def _register_sqlite_regexp(engine):
+        """
+        SQLite has REGEXP operator, but doesn't implement it: it calls a user function that should be registered
+        on every connection. Do it when connection is checked out from the pool, so that connections
+        that were opened before the storage was created get it as well.
+        """
+        if not event.contains(engine, 'checkout', _create_sqlite_regexp_function):
+            event.listen(engine, 'checkout', _create_sqlite_regexp_function)
 
     def _regex_operation(self, left, right):
         """
@@ -152,4 +509,17 @@ class SQLStorage(Storage):
             return literal(left).op('~', is_comparison=True)(right)
         elif self.dialect == 'oracle':
             return func.REGEXP_LIKE(left, right)
+        elif self.dialect == 'sqlite':
+            return literal(left).op('REGEXP', is_comparison=True)(right)
         return None
+
+
+def _create_sqlite_regexp_function(dbapi_connection, connection_record, connection_proxy):
+    """
+    Register python implementation of REGEXP on SQLite connection once per connection.
+    Compiled regexes are cached, so each pattern is compiled only once for all the rows.
+    """
+    if connection_record.info.get('vakt_regexp'):
+        return
+    dbapi_connection.create_function('REGEXP', 2, regexp)
+    connection_record.info['vakt_regexp'] = True
@@ -1,9 +1,13 @@
-from sqlalchemy import Column, Integer
+from sqlalchemy import Column, Integer, String, inspect, text, or_
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
 
-from .model import Base
-from ..migration import Migration, MigrationSet
+from .model import Base, PolicyModel, PolicySubjectModel, PolicyResourceModel, PolicyActionModel, PolicyNgramModel, \
+    PolicyRuleTokenModel, PREFIX_LENGTH
+from ..migration import Migration, MigrationSet, MigrationProgress
+from ..policy_cache import get_etag
+from ...parser import get_literal_prefix
+from ...policy import Policy, TYPE_STRING_BASED, TYPE_RULE_BASED
 
 MigrationBase = declarative_base()
 
@@ -19,20 +23,38 @@ class MigrationModel(MigrationBase):
     version = Column(Integer, nullable=False)
 
 
+class MigrationCheckpointModel(MigrationBase):
+    """
+        Last policy processed by a migration that fills a table, so that an interrupted migration resumes after it
+    """
+
+    __tablename__ = 'vakt_migration_checkpoints'
+
+    name = Column(String(64), primary_key=True)
+    last_uid = Column(String(255), nullable=True)
+
+
 class SQLMigrationSet(MigrationSet):
     """
-        Set of migrations for SQL Storage
+        Set of migrations for SQL Storage.
+        Migrations that fill data do it in transactions of `batch_size` policies,
+        `report` is called with `MigrationProgress` after each of them.
     """
 
-    def __init__(self, storage):
+    def __init__(self, storage, batch_size=1000, report=None):
         self.storage = storage
         self.session = storage.session
         self._index = 1
+        self.batch_size = batch_size
+        self.report = report
 
         MigrationModel.metadata.create_all(self.storage.session.bind)
 
     def migrations(self):
-        return [Migration0To1x3x0(self.storage)]
+        return [
+            Migration0To1x3x0(self.storage),
+            Migration1x3x0To1x6x0(self.storage, batch_size=self.batch_size, report=self.report),
+        ]
 
     def save_applied_number(self, number):
         try:
@@ -73,3 +95,160 @@ class Migration0To1x3x0(Migration):
 
     def down(self):
         Base.metadata.drop_all(self.storage.session.bind)
+
+
+class Migration1x3x0To1x6x0(Migration):
+    """
+        Migration between versions 1.3.0 and 1.6.0.
+        What it does:
+        - Adds `doc` column with JSON of the whole policy and `etag` column with its hash to policies table
+          and fills them for existing policies
+        - Adds `*_prefix` columns with literal prefixes of regexes to subjects, resources, actions tables
+          and fills them for existing policies
+        - Adds indexes for `uid` and `*_prefix` columns of subjects, resources, actions tables
+        - Adds table with n-grams of elements of string-based policies and fills it for existing policies
+        - Adds table with tokens of constraints extracted from rule-based policies and fills it for existing policies
+        If it's interrupted, the next run continues filling data from the last committed batch.
+    """
+
+    def __init__(self, storage, batch_size=1000, report=None):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.report = report
+        self.elements = [
+            (PolicySubjectModel, 'subject'),
+            (PolicyResourceModel, 'resource'),
+            (PolicyActionModel, 'action'),
+        ]
+
+    @property
+    def order(self):
+        return 2
+
+    def up(self):
+        bind = self.storage.session.bind
+        for column in self._columns():
+            if not self._has_column(column):
+                bind.execute(text('ALTER TABLE %s ADD %s %s' % (
+                    column.table.name, column.name, column.type.compile(dialect=bind.dialect))))
+        for index in self._indexes():
+            if not self._has_index(index):
+                index.create(bind)
+        MigrationCheckpointModel.__table__.create(bind, checkfirst=True)
+        self._fill_docs()
+        self._fill_prefixes()
+        self._create_and_fill(PolicyNgramModel, TYPE_STRING_BASED, 'ngrams', PolicyModel._policy_ngrams_to_db)
+        self._create_and_fill(PolicyRuleTokenModel, TYPE_RULE_BASED, 'rule_tokens',
+                              PolicyModel._policy_rule_tokens_to_db)
+
+    def down(self):
+        bind = self.storage.session.bind
+        PolicyRuleTokenModel.__table__.drop(bind, checkfirst=True)
+        PolicyNgramModel.__table__.drop(bind, checkfirst=True)
+        for index in self._indexes():
+            if self._has_index(index):
+                index.drop(bind)
+        for column in self._columns():
+            if self._has_column(column):
+                bind.execute(text('ALTER TABLE %s DROP COLUMN %s' % (column.table.name, column.name)))
+
+    def _fill_docs(self):
+        session = self.storage.session
+        progress = MigrationProgress('Migration #%d up: filling docs' % self.order, self.report)
+        while True:
+            models = session.query(PolicyModel) \
+                .filter(or_(PolicyModel.doc.is_(None), PolicyModel.etag.is_(None))).limit(self.batch_size).all()
+            if not models:
+                return
+            for model in models:
+                if model.doc is None:
+                    model.doc = model.to_policy().to_json()
+                model.etag = get_etag(model.doc)
+            session.commit()
+            progress.advance(len(models))
+
+    def _fill_prefixes(self):
+        session = self.storage.session
+        # policies' tags aren't stored, all of them are created with the default ones
+        start_tag = Policy(None).start_tag
+        for model, name in self.elements:
+            string, regex, prefix = [getattr(model, '%s_%s' % (name, x)) for x in ('string', 'regex', 'prefix')]
+            progress = MigrationProgress('Migration #%d up: filling %s prefixes' % (self.order, name), self.report)
+            # paged by primary key: some databases (e.g. Oracle) store empty prefixes as NULL,
+            # so filled elements can't be told apart from unfilled ones by the prefix alone
+            last_id = None
+            while True:
+                query = session.query(model).filter(regex.isnot(None), prefix.is_(None))
+                if last_id is not None:
+                    query = query.filter(model.id > last_id)
+                elements = query.order_by(model.id).limit(self.batch_size).all()
+                if not elements:
+                    break
+                for el in elements:
+                    value = get_literal_prefix(getattr(el, string.key), start_tag, PREFIX_LENGTH)
+                    setattr(el, prefix.key, value)
+                last_id = elements[-1].id
+                session.commit()
+                progress.advance(len(elements))
+
+    def _create_and_fill(self, model, policy_type, relation, to_db):
+        """
+        Create table of a relation and fill it for all the policies of a given type.
+        Checkpoint is saved before the table is created, so that the table is filled even if
+        the previous run was interrupted after its creation.
+        """
+        session, bind = self.storage.session, self.storage.session.bind
+        name = model.__tablename__
+        checkpoint = session.query(MigrationCheckpointModel).get(name)
+        if checkpoint is None:
+            if model.__table__.exists(bind):
+                return
+            checkpoint = MigrationCheckpointModel(name=name)
+            session.add(checkpoint)
+            session.commit()
+        model.__table__.create(bind, checkfirst=True)
+        self._fill_policies(policy_type, relation, to_db, checkpoint)
+        session.delete(checkpoint)
+        session.commit()
+
+    def _fill_policies(self, policy_type, relation, to_db, checkpoint):
+        """
+        Fill relation of all the policies of a given type with models created by `to_db` from a policy.
+        Policies are processed in order of uid starting after the last uid of the checkpoint,
+        which is committed together with each batch.
+        """
+        session, last_uid = self.storage.session, checkpoint.last_uid
+        progress = MigrationProgress('Migration #%d up: filling %s' % (self.order, relation), self.report)
+        while True:
+            query = session.query(PolicyModel).filter(PolicyModel.type == policy_type)
+            if last_uid is not None:
+                query = query.filter(PolicyModel.uid > last_uid)
+            models = query.order_by(PolicyModel.uid.asc()).limit(self.batch_size).all()
+            if not models:
+                return
+            for model in models:
+                setattr(model, relation, to_db(model.to_policy()))
+            last_uid = checkpoint.last_uid = models[-1].uid
+            session.commit()
+            progress.advance(len(models))
+
+    def _has_column(self, column):
+        columns = inspect(self.storage.session.bind).get_columns(column.table.name)
+        return column.name in [c['name'] for c in columns]
+
+    def _has_index(self, index):
+        indexes = inspect(self.storage.session.bind).get_indexes(index.table.name)
+        return index.name in [i['name'] for i in indexes]
+
+    def _columns(self):
+        return [PolicyModel.__table__.c.doc, PolicyModel.__table__.c.etag] + [
+            model.__table__.c['%s_prefix' % name] for model, name in self.elements
+        ]
+
+    def _indexes(self):
+        return [
+            index
+            for model, name in self.elements
+            for index in model.__table__.indexes
+            if list(index.columns.keys()) in (['uid'], ['%s_prefix' % name])
+        ]
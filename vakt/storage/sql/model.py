@@ -1,15 +1,26 @@
 import json
 
-from sqlalchemy import Column, Integer, SmallInteger, String, ForeignKey, Text, JSON, Boolean
+from sqlalchemy import Column, Integer, SmallInteger, String, ForeignKey, Text, JSON, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
 from ...policy import Policy, ALLOW_ACCESS, DENY_ACCESS, TYPE_STRING_BASED
 from ...rules.base import Rule
-from ...parser import compile_regex
+from ...parser import compile_regex, get_literal_prefix, get_ngrams
+from ..rule_constraints import get_policy_constraints
+from ..policy_cache import get_etag
 
 Base = declarative_base()
 
+# Max length of a literal prefix of regex-defined policy elements that is stored in the index
+PREFIX_LENGTH = 32
+# Length of n-grams of string-based policy elements that are stored in the index for fuzzy matching
+NGRAM_LENGTH = 3
+# Max length of a token of rule-based policies constraints that is stored in the index
+TOKEN_LENGTH = 255
+# Token of policy elements that have no constraints: every inquiry value produces it
+NO_CONSTRAINTS_TOKEN = '*'
+
 
 class PolicySubjectModel(Base):
     """Storage model for policy subjects"""
@@ -17,12 +28,15 @@ class PolicySubjectModel(Base):
     __tablename__ = 'vakt_policy_subjects'
 
     id = Column(Integer, primary_key=True)
-    uid = Column(String(255), ForeignKey('vakt_policies.uid', ondelete='CASCADE'))
+    uid = Column(String(255), ForeignKey('vakt_policies.uid', ondelete='CASCADE'), index=True)
     subject = Column(JSON(), comment='JSON value for rule-based policies')
     subject_string = Column(String(255), index=True, comment='Initial string value for string-based policies')
     subject_regex = Column(String(520),
                            index=True,
                            comment='Regexp from initial string value for string-based policies')
+    subject_prefix = Column(String(PREFIX_LENGTH),
+                            index=True,
+                            comment='Literal prefix of regexp for string-based policies')
 
 
 class PolicyResourceModel(Base):
@@ -31,12 +45,15 @@ class PolicyResourceModel(Base):
     __tablename__ = 'vakt_policy_resources'
 
     id = Column(Integer, primary_key=True)
-    uid = Column(String(255), ForeignKey('vakt_policies.uid', ondelete='CASCADE'))
+    uid = Column(String(255), ForeignKey('vakt_policies.uid', ondelete='CASCADE'), index=True)
     resource = Column(JSON(), comment='JSON value for rule-based policies')
     resource_string = Column(String(255), index=True, comment='Initial string value for string-based policies')
     resource_regex = Column(String(520),
                             index=True,
                             comment='Regexp from initial string value for string-based policies')
+    resource_prefix = Column(String(PREFIX_LENGTH),
+                             index=True,
+                             comment='Literal prefix of regexp for string-based policies')
 
 
 class PolicyActionModel(Base):
@@ -45,12 +62,46 @@ class PolicyActionModel(Base):
     __tablename__ = 'vakt_policy_actions'
 
     id = Column(Integer, primary_key=True)
-    uid = Column(String(255), ForeignKey('vakt_policies.uid', ondelete='CASCADE'))
+    uid = Column(String(255), ForeignKey('vakt_policies.uid', ondelete='CASCADE'), index=True)
     action = Column(JSON(), comment='JSON value for rule-based policies')
     action_string = Column(String(255), index=True, comment='Initial string value for string-based policies')
     action_regex = Column(String(520),
                           index=True,
                           comment='Regexp from initial string value for string-based policies')
+    action_prefix = Column(String(PREFIX_LENGTH),
+                           index=True,
+                           comment='Literal prefix of regexp for string-based policies')
+
+
+class PolicyNgramModel(Base):
+    """Storage model for n-grams of policy elements values"""
+
+    __tablename__ = 'vakt_policy_ngrams'
+    __table_args__ = (
+        Index('ix_vakt_policy_ngrams_field_ngram', 'field', 'ngram'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    uid = Column(String(255), ForeignKey('vakt_policies.uid', ondelete='CASCADE'), index=True)
+    field = Column(String(16), comment='Name of policy elements: subjects, resources or actions')
+    ngram = Column(String(NGRAM_LENGTH), comment='N-gram of any element value for string-based policies')
+
+
+class PolicyRuleTokenModel(Base):
+    """Storage model for tokens of constraints extracted from rules of rule-based policies"""
+
+    __tablename__ = 'vakt_policy_rule_tokens'
+    __table_args__ = (
+        Index('ix_vakt_policy_rule_tokens_field_token', 'field', 'token'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    uid = Column(String(255), ForeignKey('vakt_policies.uid', ondelete='CASCADE'), index=True)
+    field = Column(String(16), comment='Name of policy elements: subjects, resources or actions')
+    element_idx = Column(Integer, comment='Number of element in the list of policy elements')
+    groups_count = Column(Integer, comment='Number of constraints groups of element')
+    group_idx = Column(Integer, comment='Number of constraints group of element the token belongs to')
+    token = Column(String(TOKEN_LENGTH), comment='Token that satisfies constraints group')
 
 
 class PolicyModel(Base):
@@ -63,9 +114,13 @@ class PolicyModel(Base):
     description = Column(Text())
     effect = Column(Boolean())
     context = Column(JSON())
-    subjects = relationship(PolicySubjectModel, passive_deletes=True, lazy='joined')
-    resources = relationship(PolicyResourceModel, passive_deletes=True, lazy='joined')
-    actions = relationship(PolicyActionModel, passive_deletes=True, lazy='joined')
+    doc = Column(Text(), comment='JSON of the whole policy for fast reads')
+    etag = Column(String(40), comment='Hash of doc that changes on each update of the policy')
+    subjects = relationship(PolicySubjectModel, passive_deletes=True, lazy='selectin')
+    resources = relationship(PolicyResourceModel, passive_deletes=True, lazy='selectin')
+    actions = relationship(PolicyActionModel, passive_deletes=True, lazy='selectin')
+    ngrams = relationship(PolicyNgramModel, passive_deletes=True, cascade='all, delete-orphan')
+    rule_tokens = relationship(PolicyRuleTokenModel, passive_deletes=True, cascade='all, delete-orphan')
 
     @classmethod
     def from_policy(cls, policy):
@@ -123,33 +178,78 @@ class PolicyModel(Base):
         model.effect = policy_dict['effect'] == ALLOW_ACCESS
         model.description = policy_dict['description']
         model.context = json.dumps(policy_dict['context'])
+        model.doc = policy_json
+        model.etag = get_etag(policy_json)
         model.subjects = [
-            PolicySubjectModel(subject=x, subject_string=string, subject_regex=compiled)
+            PolicySubjectModel(subject=x, subject_string=string, subject_regex=compiled, subject_prefix=prefix)
             for y in policy_dict['subjects']
-            for (x, string, compiled) in cls._policy_element_to_db(policy, y)
+            for (x, string, compiled, prefix) in cls._policy_element_to_db(policy, y)
         ]
         model.resources = [
-            PolicyResourceModel(resource=x, resource_string=string, resource_regex=compiled)
+            PolicyResourceModel(resource=x, resource_string=string, resource_regex=compiled, resource_prefix=prefix)
             for y in policy_dict['resources']
-            for (x, string, compiled) in cls._policy_element_to_db(policy, y)
+            for (x, string, compiled, prefix) in cls._policy_element_to_db(policy, y)
         ]
         model.actions = [
-            PolicyActionModel(action=x, action_string=string, action_regex=compiled)
+            PolicyActionModel(action=x, action_string=string, action_regex=compiled, action_prefix=prefix)
             for y in policy_dict['actions']
-            for (x, string, compiled) in cls._policy_element_to_db(policy, y)
+            for (x, string, compiled, prefix) in cls._policy_element_to_db(policy, y)
         ]
+        model.ngrams = cls._policy_ngrams_to_db(policy)
+        model.rule_tokens = cls._policy_rule_tokens_to_db(policy)
         return model
 
     @classmethod
     def _policy_element_to_db(cls, policy, el):
-        json_value, string_value, compiled = None, None, None
+        json_value, string_value, compiled, prefix = None, None, None, None
         if policy.type == TYPE_STRING_BASED:
             string_value = el
             if policy.start_tag in el and policy.end_tag in el:
                 compiled = compile_regex(el, policy.start_tag, policy.end_tag).pattern
+                prefix = get_literal_prefix(el, policy.start_tag, PREFIX_LENGTH)
         else:  # it's a rule-based policy and it's value is a json
             json_value = json.dumps(el)
-        yield (json_value, string_value, compiled)
+        yield (json_value, string_value, compiled, prefix)
+
+    @classmethod
+    def _policy_ngrams_to_db(cls, policy):
+        """
+            Create n-gram models for all the elements values of a string-based policy.
+
+            :param policy: object of type Policy
+        """
+        models = []
+        if policy.type != TYPE_STRING_BASED:
+            return models
+        for field in ('subjects', 'resources', 'actions'):
+            ngrams = set()
+            for el in getattr(policy, field):
+                ngrams.update(get_ngrams(el, NGRAM_LENGTH))
+            models.extend(PolicyNgramModel(field=field, ngram=ngram) for ngram in sorted(ngrams))
+        return models
+
+    @classmethod
+    def _policy_rule_tokens_to_db(cls, policy):
+        """
+            Create token models for constraints of all the elements of a rule-based policy.
+            Element without constraints gets a single `NO_CONSTRAINTS_TOKEN`.
+
+            :param policy: object of type Policy
+        """
+        models = []
+        constraints = get_policy_constraints(policy, PREFIX_LENGTH, TOKEN_LENGTH)
+        for field, elements in sorted(constraints.items()):
+            for element_idx, groups in enumerate(elements):
+                if not groups:
+                    models.append(PolicyRuleTokenModel(field=field, element_idx=element_idx, groups_count=0,
+                                                       token=NO_CONSTRAINTS_TOKEN))
+                for group_idx, tokens in enumerate(groups):
+                    models.extend(
+                        PolicyRuleTokenModel(field=field, element_idx=element_idx, groups_count=len(groups),
+                                             group_idx=group_idx, token=token)
+                        for token in tokens
+                    )
+        return models
 
     @classmethod
     def _policy_element_from_db(cls, policy_type, element_json, element_string):
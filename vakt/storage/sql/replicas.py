@@ -0,0 +1,84 @@
+"""
+Selection of a read replica for SQLStorage.
+"""
+
+import time
+import threading
+from abc import ABCMeta, abstractmethod
+from itertools import count
+
+from sqlalchemy import event
+
+
+__all__ = ['ReplicaSelector', 'RoundRobinSelector', 'LeastLatencySelector']
+
+
+class ReplicaSelector(metaclass=ABCMeta):
+    """
+    Selects a replica engine to read from.
+    """
+
+    @abstractmethod
+    def select(self, engines):
+        """
+        Get index of an engine to read from
+        """
+        pass
+
+
+class RoundRobinSelector(ReplicaSelector):
+    """
+    Selects replicas one by one in turn.
+    """
+
+    def __init__(self):
+        self._counter = count()
+
+    def select(self, engines):
+        return next(self._counter) % len(engines)
+
+
+class LeastLatencySelector(ReplicaSelector):
+    """
+    Selects replica with the least latency of SQL statements executed on it.
+    Latency is an exponentially weighted moving average with the given weight of the latest statement.
+    Replicas without statements yet are selected first, so each replica is measured.
+    """
+
+    def __init__(self, weight=0.2):
+        self.weight = weight
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def select(self, engines):
+        self._watch(engines)
+        return min(range(len(engines)), key=lambda i: self.latencies.get(engines[i], 0.0))
+
+    def _watch(self, engines):
+        """
+        Listen to statements execution on engines that aren't watched yet.
+        """
+        if all(e in self.latencies for e in engines):
+            return
+        with self.lock:
+            for engine in engines:
+                if engine not in self.latencies:
+                    self._listen(engine)
+                    self.latencies[engine] = 0.0
+
+    def _listen(self, engine):
+        key = 'vakt_statement_start_%d' % id(self)
+
+        def start(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault(key, []).append(time.monotonic())
+
+        def finish(conn, cursor, statement, parameters, context, executemany):
+            starts = conn.info.get(key)
+            if not starts:
+                return
+            elapsed = time.monotonic() - starts.pop()
+            latency = self.latencies.get(engine)
+            self.latencies[engine] = elapsed if not latency else latency + self.weight * (elapsed - latency)
+
+        event.listen(engine, 'before_cursor_execute', start)
+        event.listen(engine, 'after_cursor_execute', finish)
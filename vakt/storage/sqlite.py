@@ -0,0 +1,362 @@
+"""
+SQLite Storage and Migrations for Policies.
+Uses only python's standard library `sqlite3` module.
+"""
+
+import re
+import sqlite3
+import logging
+import threading
+import contextlib
+from functools import lru_cache
+
+from ..storage.abc import Storage
+from ..storage.migration import Migration, MigrationSet
+from ..exceptions import PolicyExistsError, UnknownCheckerType
+from ..checker import StringExactChecker, StringFuzzyChecker, RegexChecker, RulesChecker
+from ..policy import Policy, TYPE_STRING_BASED, TYPE_RULE_BASED
+from ..parser import compile_regex, get_literal_prefix, get_prefixes
+
+
+POLICIES_TABLE = 'vakt_policies'
+ELEMENTS_TABLE = 'vakt_policy_elements'
+MIGRATIONS_TABLE = 'vakt_migrations'
+# Max length of a literal prefix of regex-defined policy elements that is stored in the index
+PREFIX_LENGTH = 32
+
+log = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=512)
+def _compile(pattern):
+    return re.compile(pattern)
+
+
+def regexp(pattern, value):
+    """
+    Implementation of `value REGEXP pattern` operator for SQLite.
+    """
+    if pattern is None or value is None:
+        return False
+    return _compile(pattern).search(value) is not None
+
+
+class SQLiteStorage(Storage):
+    """
+    Stores all policies in a local SQLite database file without any ORM.
+
+    Each policy is stored as one row with its JSON. Elements (actions, subjects, resources) of string-based policies
+    are additionally stored in an indexed table in the form suitable for every checker: exact string, literal prefix
+    and compiled regex. `REGEXP` operator is implemented with a python function, so that all checkers
+    filter policies inside the database. Database works in WAL mode, so many reader processes can share one file.
+
+    Every thread uses its own connection.
+    """
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self.condition_fields = [
+            'actions',
+            'subjects',
+            'resources',
+        ]
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        """
+        Connection of the current thread
+        """
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.create_function('REGEXP', 2, regexp)
+            self._local.connection = conn
+        return conn
+
+    def add(self, policy):
+        try:
+            with self._transaction() as conn:
+                conn.execute(
+                    'INSERT INTO %s (uid, type, doc) VALUES (?, ?, ?)' % POLICIES_TABLE,
+                    (str(policy.uid), policy.type, policy.to_json())
+                )
+                self._insert_elements(conn, policy)
+        except sqlite3.IntegrityError:
+            log.error('Error trying to create already existing policy with UID=%s.', policy.uid)
+            raise PolicyExistsError(policy.uid)
+        log.info('Added Policy: %s', policy)
+
+    def get(self, uid):
+        row = self.connection.execute(
+            'SELECT doc FROM %s WHERE uid = ?' % POLICIES_TABLE, (str(uid),)
+        ).fetchone()
+        if not row:
+            return None
+        return Policy.from_json(row[0])
+
+    def get_all(self, limit, offset):
+        self._check_limit_and_offset(limit, offset)
+        if limit == 0:
+            return []
+        cur = self.connection.execute(
+            'SELECT doc FROM %s ORDER BY uid LIMIT ? OFFSET ?' % POLICIES_TABLE, (limit, offset)
+        )
+        return self.__feed_policies(cur)
+
+    def find_for_inquiry(self, inquiry, checker=None):
+        where, params = self._create_filter(inquiry, checker)
+        cur = self.connection.execute('SELECT doc FROM %s WHERE %s' % (POLICIES_TABLE, where), params)
+        return self.__feed_policies(cur)
+
+    def update(self, policy):
+        uid = str(policy.uid)
+        with self._transaction() as conn:
+            cur = conn.execute(
+                'UPDATE %s SET type = ?, doc = ? WHERE uid = ?' % POLICIES_TABLE,
+                (policy.type, policy.to_json(), uid)
+            )
+            if cur.rowcount == 0:
+                return
+            conn.execute('DELETE FROM %s WHERE uid = ?' % ELEMENTS_TABLE, (uid,))
+            self._insert_elements(conn, policy)
+        log.info('Updated Policy with UID=%s. New value is: %s', policy.uid, policy)
+
+    def delete(self, uid):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM %s WHERE uid = ?' % ELEMENTS_TABLE, (str(uid),))
+            conn.execute('DELETE FROM %s WHERE uid = ?' % POLICIES_TABLE, (str(uid),))
+        log.info('Deleted Policy with UID=%s.', uid)
+
+    def add_many(self, policies):
+        policies = list(policies)
+        try:
+            with self._transaction() as conn:
+                conn.executemany(
+                    'INSERT INTO %s (uid, type, doc) VALUES (?, ?, ?)' % POLICIES_TABLE,
+                    [(str(p.uid), p.type, p.to_json()) for p in policies]
+                )
+                for policy in policies:
+                    self._insert_elements(conn, policy)
+        except sqlite3.IntegrityError:
+            log.error('Error trying to create already existing policies.')
+            uid = self.__find_existing_uid(policies)
+            if uid is None:
+                raise
+            raise PolicyExistsError(uid)
+        log.info('Added %d Policies', len(policies))
+
+    def update_many(self, policies):
+        policies = list(policies)
+        with self._transaction() as conn:
+            updated = 0
+            for policy in policies:
+                uid = str(policy.uid)
+                cur = conn.execute(
+                    'UPDATE %s SET type = ?, doc = ? WHERE uid = ?' % POLICIES_TABLE,
+                    (policy.type, policy.to_json(), uid)
+                )
+                if cur.rowcount == 0:
+                    continue
+                conn.execute('DELETE FROM %s WHERE uid = ?' % ELEMENTS_TABLE, (uid,))
+                self._insert_elements(conn, policy)
+                updated += 1
+        log.info('Updated %d Policies', updated)
+
+    def delete_many(self, uids):
+        params = [(str(uid),) for uid in uids]
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM %s WHERE uid = ?' % ELEMENTS_TABLE, params)
+            conn.executemany('DELETE FROM %s WHERE uid = ?' % POLICIES_TABLE, params)
+        log.info('Deleted Policies with UIDs=%s.', [p[0] for p in params])
+
+    def __find_existing_uid(self, policies):
+        """
+        Get first uid of the given policies that is duplicated among them or already exists in the database.
+        """
+        seen = set()
+        for policy in policies:
+            uid = str(policy.uid)
+            if uid in seen:
+                return policy.uid
+            seen.add(uid)
+            if self.connection.execute('SELECT 1 FROM %s WHERE uid = ?' % POLICIES_TABLE, (uid,)).fetchone():
+                return policy.uid
+        return None
+
+    def _get_batch(self, limit, token):
+        self._check_limit_and_offset(limit, 0)
+        if limit == 0:
+            return [], None
+        rows = self.connection.execute(
+            'SELECT uid, doc FROM %s WHERE uid > ? ORDER BY uid LIMIT ?' % POLICIES_TABLE,
+            ('' if token is None else token, limit)
+        ).fetchall()
+        policies = [Policy.from_json(doc) for _, doc in rows]
+        return policies, rows[-1][0] if len(rows) == limit else None
+
+    def _create_filter(self, inquiry, checker):
+        """
+        Returns WHERE clause and its parameters based on the checker type.
+        """
+        if isinstance(checker, StringFuzzyChecker):
+            return self.__elements_query(inquiry, self.__string_condition('instr(string, ?) > 0'))
+        elif isinstance(checker, StringExactChecker):
+            return self.__elements_query(inquiry, self.__string_condition('string = ?'))
+        elif isinstance(checker, RegexChecker):
+            return self.__elements_query(inquiry, self.__regex_condition)
+        elif isinstance(checker, RulesChecker):
+            return 'type = ?', [TYPE_RULE_BASED]
+        elif not checker:
+            return '1 = 1', []
+        else:
+            log.error('Provided Checker type is not supported.')
+            raise UnknownCheckerType(checker)
+
+    def __elements_query(self, inquiry, condition):
+        """
+        Construct WHERE clause for string-based Checkers: every field of a policy should have at least
+        one element that satisfies the condition for a corresponding inquiry value.
+        """
+        clauses, params = ['type = ?'], [TYPE_STRING_BASED]
+        for field in self.condition_fields:
+            field_condition, field_params = condition(getattr(inquiry, field.rstrip('s')))
+            clauses.append(
+                'uid IN (SELECT uid FROM %s WHERE field = ? AND (%s))' % (ELEMENTS_TABLE, field_condition)
+            )
+            params.append(field)
+            params.extend(field_params)
+        return ' AND '.join(clauses), params
+
+    @staticmethod
+    def __string_condition(condition):
+        """
+        Condition for string checkers that compares elements with the value.
+        Non-string values can't be bound as parameters and no string element fits them.
+        """
+        return lambda value: (condition, [value]) if isinstance(value, str) else ('0 = 1', [])
+
+    @staticmethod
+    def __regex_condition(value):
+        """
+        Element either is a plain string equal to the value or is a regex that matches the value.
+        Regex is applied only to elements whose indexed literal prefix is a prefix of the value.
+        Non-string values can't be compared or matched in the database, so all the regexes are left to the checker.
+        """
+        if not isinstance(value, str):
+            return 'regex IS NOT NULL', []
+        prefixes = get_prefixes(value, PREFIX_LENGTH)
+        condition = '(regex IS NULL AND string = ?) OR (prefix IN (%s) AND ? REGEXP regex)' % \
+                    ', '.join('?' * len(prefixes))
+        return condition, [value] + prefixes + [value]
+
+    def _insert_elements(self, conn, policy):
+        """
+        Store index entries of string-based policy elements.
+        """
+        if policy.type != TYPE_STRING_BASED:
+            return
+        rows = []
+        for field in self.condition_fields:
+            for el in getattr(policy, field):
+                string, regex, prefix = el, None, None
+                if policy.start_tag in el and policy.end_tag in el:
+                    regex = compile_regex(el, policy.start_tag, policy.end_tag).pattern
+                    prefix = get_literal_prefix(el, policy.start_tag, PREFIX_LENGTH)
+                    # StringChecker compares values without enclosing tags
+                    if el[0] == policy.start_tag and el[-1] == policy.end_tag:
+                        string = el[1:-1]
+                rows.append((str(policy.uid), field, string, prefix, regex))
+        conn.executemany(
+            'INSERT INTO %s (uid, field, string, prefix, regex) VALUES (?, ?, ?, ?, ?)' % ELEMENTS_TABLE, rows
+        )
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Run statements in a write transaction.
+        """
+        conn = self.connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @staticmethod
+    def __feed_policies(cursor):
+        """
+        Yields Policies from the given cursor.
+        """
+        for row in cursor:
+            yield Policy.from_json(row[0])
+
+
+##############
+# Migrations #
+##############
+
+class SQLiteMigrationSet(MigrationSet):
+    """
+    Migrations Collection for SQLiteStorage
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.storage.connection.execute(
+            'CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, version INTEGER NOT NULL)' % MIGRATIONS_TABLE
+        )
+        self._index = 1
+
+    def migrations(self):
+        return [
+            Migration0To1x6x0(self.storage),
+        ]
+
+    def save_applied_number(self, number):
+        self.storage.connection.execute(
+            'INSERT OR REPLACE INTO %s (id, version) VALUES (?, ?)' % MIGRATIONS_TABLE, (self._index, number)
+        )
+
+    def last_applied(self):
+        row = self.storage.connection.execute(
+            'SELECT version FROM %s WHERE id = ?' % MIGRATIONS_TABLE, (self._index,)
+        ).fetchone()
+        if row:
+            return row[0]
+        return 0
+
+
+class Migration0To1x6x0(Migration):
+    """
+    Migration between versions 0 and 1.6.0.
+    This migration is initial.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    @property
+    def order(self):
+        return 1
+
+    def up(self):
+        with self.storage._transaction() as conn:
+            conn.execute(
+                'CREATE TABLE %s (uid TEXT PRIMARY KEY, type INTEGER NOT NULL, doc TEXT NOT NULL)' % POLICIES_TABLE
+            )
+            conn.execute(
+                'CREATE TABLE %s (uid TEXT NOT NULL, field TEXT NOT NULL, ' % ELEMENTS_TABLE +
+                'string TEXT, prefix TEXT, regex TEXT)'
+            )
+            conn.execute('CREATE INDEX vakt_policy_elements_uid_idx ON %s (uid)' % ELEMENTS_TABLE)
+            conn.execute('CREATE INDEX vakt_policy_elements_string_idx ON %s (field, string)' % ELEMENTS_TABLE)
+            conn.execute('CREATE INDEX vakt_policy_elements_prefix_idx ON %s (field, prefix)' % ELEMENTS_TABLE)
+
+    def down(self):
+        with self.storage._transaction() as conn:
+            conn.execute('DROP TABLE %s' % ELEMENTS_TABLE)
+            conn.execute('DROP TABLE %s' % POLICIES_TABLE)
@@ -3,9 +3,12 @@ Utility functions and classes for Vakt.
 """
 
 import logging
+import inspect
 from abc import ABCMeta, abstractmethod
 
 import jsonpickle
+import jsonpickle.pickler
+import jsonpickle.unpickler
 
 
 log = logging.getLogger(__name__)
@@ -23,6 +26,14 @@ class JsonSerializer:
         """
         return cls._parse(data)
 
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Create object from a dict of JSON-compatible data (as returned by `to_dict`)
+        Returns a new instance of a class
+        """
+        return cls._restore(data)
+
     def to_json(self, sort=False):
         """
         Get JSON representation of an object
@@ -30,6 +41,13 @@ class JsonSerializer:
         jsonpickle.set_encoder_options('json', sort_keys=sort)
         return jsonpickle.encode(self._data())
 
+    def to_dict(self):
+        """
+        Get JSON-compatible dict representation of an object.
+        It's the same data as `to_json` returns, but it isn't encoded into a string
+        """
+        return jsonpickle.pickler.Pickler().flatten(self._data())
+
     @classmethod
     def _parse(cls, data):
         """Parse JSON string and return data"""
@@ -39,6 +57,11 @@ class JsonSerializer:
             log.exception('Error creating %s from json.', cls.__name__)
             raise err
 
+    @classmethod
+    def _restore(cls, data):
+        """Restore data with all the objects in it from JSON-compatible data"""
+        return jsonpickle.unpickler.Unpickler().restore(data)
+
     def _data(self):
         """
         Get the object data. Is useful for overriding in custom classes
@@ -73,12 +96,31 @@ class Subject:
         """
         self._listeners.remove(listener)
 
-    def notify(self):
+    def notify(self, *args, **kwargs):
         """
-        Notify all attached listeners about event
+        Notify all attached listeners about event.
+        Arguments describing the event are passed to `update` of each listener that accepts them,
+        listeners whose `update` takes no arguments are just called.
         """
         for listener in self._listeners:
-            listener.update()
+            if self._accepts(listener.update, args, kwargs):
+                listener.update(*args, **kwargs)
+            else:
+                listener.update()
+
+    @staticmethod
+    def _accepts(func, args, kwargs):
+        """
+        Can function be called with the given arguments?
+        """
+        try:
+            inspect.signature(func).bind(*args, **kwargs)
+        except TypeError:
+            return False
+        except ValueError:
+            # signature of some built-in callables can't be inspected
+            return True
+        return True
 
 
 class Observer(metaclass=ABCMeta):
@@ -86,8 +128,9 @@ class Observer(metaclass=ABCMeta):
     Observer of the events in the pub-sub objects relation
     """
     @abstractmethod
-    def update(self):
+    def update(self, *args, **kwargs):
         """
-        Update observer on notify event
+        Update observer on notify event.
+        Receives arguments that the subject has passed to `notify`
         """
         pass